@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Illumina, Inc. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Fleet performance report over the per-job manifests (manifest.json) that dragen_qs
+# writes next to the outputs of every job. Reads them from an S3 prefix, or a local
+# directory holding copies, and reports the staging / compute / upload share of the job
+# time, the distribution of transfer throughput by instance type and by reference, the
+# staging cache hit rates and the job latency percentiles.
+#
+# Each manifest is reduced to one row of numbers as soon as it is read, so memory grows
+# with the number of jobs, not with the size of their manifests.
+#
+# Example:
+#   python3 fleet_report.py -s s3://my-bucket/results/
+#   python3 fleet_report.py -s ./manifests -o fleet.json
+#
+
+from __future__ import print_function
+
+import getopt
+import json
+import math
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+# CONSTANTS ....
+MANIFEST_FILE_NAME = 'manifest.json'
+FETCH_CONCURRENCY = 32
+MIN_RATE_BYTES = 16 * 1024 * 1024       # Smaller transfers are dominated by request latency
+MB = 1024 * 1024
+PERCENTILES = [5, 50, 95]
+
+# Job phases (DragenJob.set_phase) by category
+PHASE_CATEGORIES = {
+    'prepare_disk': 'staging',
+    'download_reference': 'staging',
+    'download_inputs': 'staging',
+    'staged': 'queued',
+    'prepare_board': 'compute',
+    'dragen': 'compute',
+    'dragen_done': 'compute',
+    'upload': 'upload',
+    'cleanup': 'upload'
+}
+CATEGORIES = ['staging', 'queued', 'compute', 'upload']
+
+
+#########################################################################################
+# printf - Print to stdout with flush
+#
+def printf(msg):
+    print(msg, file=sys.stdout)
+    sys.stdout.flush()
+
+
+#########################################################################################
+# percentile - Nearest-rank percentile of a list of numbers
+#
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(math.ceil(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+#########################################################################################
+# list_manifests - Locations of the manifests below source: an s3://bucket/prefix URL or
+# a local directory. Returns list of paths, or of (bucket, key) for S3
+#
+def list_manifests(source):
+    if not source.startswith('s3://'):
+        return [os.path.join(root, MANIFEST_FILE_NAME) for root, _, names in os.walk(source)
+                if MANIFEST_FILE_NAME in names]
+
+    import boto3
+    bucket, _, prefix = source[len('s3://'):].partition('/')
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    return [(bucket, x['Key']) for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for x in page.get('Contents', []) if x['Key'].split('/')[-1] == MANIFEST_FILE_NAME]
+
+
+#########################################################################################
+# job_row - Reduce a manifest to the numbers the report needs
+#
+def job_row(manifest):
+    phase_seconds = manifest.get('phase_seconds') or {}
+    row = dict((x, 0.0) for x in CATEGORIES)
+    for phase, seconds in phase_seconds.items():
+        category = PHASE_CATEGORIES.get(phase)
+        if category:
+            row[category] += seconds
+    if not phase_seconds and manifest.get('dragen_seconds'):
+        row['compute'] = manifest['dragen_seconds']
+
+    downloads = [x for x in manifest.get('transfers', []) if x.get('op') == 'download']
+    fetched = [x for x in downloads if not x.get('cached') and x.get('bytes', 0) >= MIN_RATE_BYTES]
+    uploaded = [x for x in manifest.get('objects', []) if x.get('size', 0) >= MIN_RATE_BYTES]
+
+    row.update({
+        'instance_type': manifest.get('instance_type') or 'unknown',
+        'reference': manifest.get('reference') or 'none',
+        'succeeded': manifest.get('exit_code') == 0,
+        'latency': sum(row[x] for x in CATEGORIES if x != 'queued'),
+        'download_count': len(downloads),
+        'cached_count': sum(1 for x in downloads if x.get('cached')),
+        'download_bytes': sum(x.get('bytes', 0) for x in downloads),
+        'cached_bytes': sum(x.get('bytes', 0) for x in downloads if x.get('cached')),
+        'reference_reused': bool(manifest.get('reference_reused')),
+        'download_mbps': None,
+        'upload_mbps': None
+    })
+    seconds = sum(x['seconds'] for x in fetched)
+    if seconds > 0:
+        row['download_mbps'] = sum(x['bytes'] for x in fetched) / MB / seconds
+    seconds = sum(x.get('upload_seconds', 0) for x in uploaded)
+    if seconds > 0:
+        row['upload_mbps'] = sum(x['size'] for x in uploaded) / MB / seconds
+    return row
+
+
+#########################################################################################
+# load_rows - Read every manifest concurrently and reduce each to its job row
+#
+def load_rows(source):
+    locations = list_manifests(source)
+    printf('Reading %d manifests from %s' % (len(locations), source))
+
+    client = None
+    if source.startswith('s3://'):
+        import boto3
+        client = boto3.client('s3')
+
+    def read_row(location):
+        try:
+            if client:
+                body = client.get_object(Bucket=location[0], Key=location[1])['Body'].read()
+            else:
+                with open(location, 'rb') as f:
+                    body = f.read()
+            return job_row(json.loads(body.decode('utf-8')))
+        except Exception as e:
+            printf('Warning: skipping %s (%s)' % (location, str(e)))
+            return None
+
+    pool = ThreadPool(FETCH_CONCURRENCY)
+    try:
+        rows = pool.map(read_row, locations, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+    return [x for x in rows if x]
+
+
+#########################################################################################
+# distribution - Percentiles of the non-empty values
+#
+def distribution(values):
+    values = [x for x in values if x is not None]
+    result = {'count': len(values)}
+    for pct in PERCENTILES:
+        value = percentile(values, pct)
+        result['p%d' % pct] = round(value, 1) if value is not None else None
+    return result
+
+
+#########################################################################################
+# summarize - Aggregates of a group of job rows
+#
+def summarize(rows):
+    totals = dict((x, sum(r[x] for r in rows)) for x in CATEGORIES)
+    busy = sum(totals[x] for x in CATEGORIES if x != 'queued')
+    download_count = sum(x['download_count'] for x in rows)
+    download_bytes = sum(x['download_bytes'] for x in rows)
+    return {
+        'jobs': len(rows),
+        'succeeded': sum(1 for x in rows if x['succeeded']),
+        'share': dict((x, round(totals[x] / busy, 3) if busy else None) for x in CATEGORIES if x != 'queued'),
+        'queued_seconds': round(totals['queued'], 1),
+        'latency_seconds': distribution([x['latency'] for x in rows]),
+        'download_mbps': distribution([x['download_mbps'] for x in rows]),
+        'upload_mbps': distribution([x['upload_mbps'] for x in rows]),
+        'cache_hit_rate': round(sum(x['cached_count'] for x in rows) / download_count, 3) if download_count else None,
+        'cache_byte_hit_rate': round(sum(x['cached_bytes'] for x in rows) / download_bytes, 3)
+        if download_bytes else None,
+        'reference_reuse_rate': round(sum(1 for x in rows if x['reference_reused']) / len(rows), 3) if rows else None
+    }
+
+
+#########################################################################################
+# build_report - Fleet summary plus the same aggregates by instance type and reference
+#
+def build_report(rows):
+    report = {'fleet': summarize(rows)}
+    for field in ('instance_type', 'reference'):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[field], []).append(row)
+        report['by_' + field] = dict((name, summarize(group)) for name, group in groups.items())
+    return report
+
+
+#########################################################################################
+# print_report - Human readable tables of the report
+#
+def print_report(report):
+    fleet = report['fleet']
+    printf('')
+    printf('Jobs: %d (%d succeeded)' % (fleet['jobs'], fleet['succeeded']))
+    printf('Time share: staging %s, compute %s, upload %s (plus %.1f hours queued after staging)'
+           % tuple(['%.0f%%' % (fleet['share'][x] * 100) if fleet['share'][x] is not None else '-'
+                    for x in ('staging', 'compute', 'upload')] + [fleet['queued_seconds'] / 3600]))
+    printf('Cache hit rate: %s of downloads, %s of bytes; reference reused by %s of jobs'
+           % tuple('%.0f%%' % (fleet[x] * 100) if fleet[x] is not None else '-'
+                   for x in ('cache_hit_rate', 'cache_byte_hit_rate', 'reference_reuse_rate')))
+
+    def fmt(dist):
+        return '/'.join('%.0f' % dist['p%d' % x] if dist['p%d' % x] is not None else '-' for x in PERCENTILES)
+
+    for field in ('instance_type', 'reference'):
+        printf('')
+        printf('%-40s %6s %18s %18s %18s' % ('By ' + field.replace('_', ' '), 'jobs',
+                                            'latency p5/50/95 s', 'down MB/s p5/50/95', 'up MB/s p5/50/95'))
+        groups = report['by_' + field]
+        for name in sorted(groups, key=lambda x: -groups[x]['jobs']):
+            entry = groups[name]
+            printf('%-40s %6d %18s %18s %18s' % (name[-40:], entry['jobs'], fmt(entry['latency_seconds']),
+                                                fmt(entry['download_mbps']), fmt(entry['upload_mbps'])))
+
+
+########################################################################################
+# usage
+#
+def usage():
+    print()
+    print("Usage: fleet_report.py -s <source> [options]")
+    print()
+    print("  -s <src>,--source=<src>       s3://bucket/prefix or local directory holding job manifests")
+    print("  -o <file>,--output=<file>     Write the JSON report to file")
+    print("  -h,--help                     This help message")
+    print()
+    sys.exit(1)
+
+
+#########################################################################################
+# main
+#
+def main():
+    source = None
+    output_path = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:o:h", ["source=", "output=", "help"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+
+    for o, v in opts:
+        if o in ("-s", "--source"):
+            source = v
+        elif o in ("-o", "--output"):
+            output_path = v
+        else:
+            usage()
+
+    if not source:
+        print("ERROR: Manifest source required!")
+        usage()
+
+    start_time = time.time()
+    rows = load_rows(source)
+    if not rows:
+        printf('No job manifests found')
+        sys.exit(1)
+
+    report = build_report(rows)
+    report['source'] = source
+    report['time'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    print_report(report)
+    printf('')
+    printf('Report over %d jobs built in %.1f secs' % (len(rows), time.time() - start_time))
+
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
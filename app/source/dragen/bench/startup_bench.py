@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Illumina, Inc. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Cold start benchmark of the d_haul and dragen_qs entry points. Each entry point is
+# started in a fresh interpreter several times and the wall time to exit is recorded,
+# along with which heavy modules (boto3, requests, future, ...) it imported, taken from
+# 'python -X importtime'. Results are written as JSON and can be compared against a
+# previous run.
+#
+# Example:
+#   python3 startup_bench.py -o results.json
+#   python3 startup_bench.py -n 20 --compare baseline.json
+#
+
+from __future__ import print_function
+
+import getopt
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# CONSTANTS ....
+DEFAULT_RUNS = 10
+REGRESSION_THRESHOLD = 0.25         # Flag startup time increases larger than 25% in --compare
+HEAVY_MODULES = ['boto3', 'botocore', 's3transfer', 'requests', 'urllib3', 'urllib.request', 'future',
+                 'past', 'multiprocessing', 'dateutil', 'zstandard']
+
+# Entry points: name -> command line run from SRC_DIR. Only paths that exit without
+# touching the network or the Dragen board
+ENTRY_POINTS = {
+    'python': [sys.executable, '-c', 'pass'],
+    'd_haul_usage': [sys.executable, 'd_haul', '-h'],
+    'd_haul_import': [sys.executable, '-c', 'import runpy; runpy.run_path("d_haul")'],
+    'dragen_qs_import': [sys.executable, '-c', 'import dragen_qs'],
+}
+
+
+#########################################################################################
+# printf - Print to stdout with flush
+#
+def printf(msg):
+    print(msg, file=sys.stdout)
+    sys.stdout.flush()
+
+
+#########################################################################################
+# time_run - Wall time in ms of one run of the command
+#
+def time_run(argv):
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        subprocess.call(argv, cwd=SRC_DIR, stdout=devnull, stderr=devnull)
+        return (time.time() - start) * 1000.0
+
+
+#########################################################################################
+# get_imports - Top level heavy modules imported by the command, and the cumulative
+#   import time in ms of each
+#
+def get_imports(argv):
+    argv = [argv[0], '-X', 'importtime'] + argv[1:]
+    with open(os.devnull, 'wb') as devnull:
+        p = subprocess.Popen(argv, cwd=SRC_DIR, stdout=devnull, stderr=subprocess.PIPE)
+        _, err = p.communicate()
+
+    imports = {}
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if name in HEAVY_MODULES:
+            imports[name] = round(int(cumulative) / 1000.0, 1)
+    return imports
+
+
+#########################################################################################
+# bench_entry_point - Run the command several times, first run excluded as warm-up of
+#   the page cache / .pyc files
+#
+def bench_entry_point(argv, runs):
+    time_run(argv)
+    times = sorted(time_run(argv) for _ in range(runs))
+    return {
+        'runs': runs,
+        'min_ms': round(times[0], 1),
+        'median_ms': round(times[len(times) // 2], 1),
+        'max_ms': round(times[-1], 1),
+        'heavy_imports_ms': get_imports(argv)
+    }
+
+
+#########################################################################################
+# compare_results - Print the median startup time of each entry point against a
+#   baseline run. Returns the number of regressions beyond REGRESSION_THRESHOLD
+#
+def compare_results(baseline, current):
+    regressions = 0
+    printf('%-22s %12s %12s %8s' % ('entry point', 'base ms', 'ms', 'ratio'))
+    for name, result in sorted(current['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if not base or not base.get('median_ms'):
+            continue
+        ratio = result['median_ms'] / base['median_ms']
+        flag = ''
+        if ratio > 1 + REGRESSION_THRESHOLD:
+            flag = '  REGRESSION'
+            regressions += 1
+        printf('%-22s %12.1f %12.1f %8.2f%s' % (name, base['median_ms'], result['median_ms'], ratio, flag))
+    return regressions
+
+
+########################################################################################
+# usage
+#
+def usage():
+    print()
+    print("Usage: startup_bench.py [options]")
+    print()
+    print("  -e <list>,--entry-points=<list>  Comma separated entry points (default: %s)"
+          % ','.join(sorted(ENTRY_POINTS)))
+    print("  -n <runs>,--runs=<runs>          Timed runs per entry point (default %d)" % DEFAULT_RUNS)
+    print("  -o <file>,--output=<file>        Write JSON results to file")
+    print("  -c <file>,--compare=<file>       Compare against a previous JSON result; exit 2 on regression")
+    print("  -h,--help                        This help message")
+    print()
+    sys.exit(1)
+
+
+#########################################################################################
+# main
+#
+def main():
+    entry_points = sorted(ENTRY_POINTS)
+    runs = DEFAULT_RUNS
+    output_path = None
+    compare_path = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "e:n:o:c:h",
+                                   ["entry-points=", "runs=", "output=", "compare=", "help"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+
+    for o, v in opts:
+        if o in ("-e", "--entry-points"):
+            entry_points = [x.strip() for x in v.split(',') if x.strip()]
+        elif o in ("-n", "--runs"):
+            runs = int(v)
+        elif o in ("-o", "--output"):
+            output_path = v
+        elif o in ("-c", "--compare"):
+            compare_path = v
+        else:
+            usage()
+
+    for name in entry_points:
+        if name not in ENTRY_POINTS:
+            print("ERROR: Unknown entry point %s" % name)
+            usage()
+
+    report = {
+        'version': {'python': platform.python_version(), 'host': platform.node()},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': {}
+    }
+    for name in entry_points:
+        report['results'][name] = bench_entry_point(ENTRY_POINTS[name], runs)
+        printf('%-22s median %7.1f ms  heavy imports: %s'
+               % (name, report['results'][name]['median_ms'],
+                  ', '.join(sorted(report['results'][name]['heavy_imports_ms'])) or '-'))
+
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if compare_path:
+        with open(compare_path, 'r') as f:
+            baseline = json.load(f)
+        if compare_results(baseline, report):
+            sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
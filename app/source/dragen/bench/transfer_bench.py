@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Illumina, Inc. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Benchmark harness for the d_haul transfer stack (aws_utils.s3_download_file,
+# s3_download_dir, s3_upload and DHaul.download_from_url). Runs against a local
+# S3-compatible server (an in-process moto server by default, or any endpoint such as
+# MinIO given with --endpoint) and a local HTTP server with byte-range support.
+# Results are written as JSON and can be compared against a previous run.
+#
+# Example:
+#   python3 transfer_bench.py -o results.json
+#   python3 transfer_bench.py -w small,mixed --compare baseline.json -o results.json
+#
+
+from __future__ import print_function
+
+import getopt
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+# CONSTANTS ....
+BENCH_BUCKET = 'dragen-bench'
+KB = 1024
+MB = 1024 * 1024
+REGRESSION_THRESHOLD = 0.15         # Flag throughput drops larger than 15% in --compare
+
+# Workload definitions: list of (count, size in bytes, prefix depth) file groups.
+# Sizes are multiplied by the --scale factor
+WORKLOADS = {
+    'small': [(500, 64 * KB, 1)],
+    'huge': [(2, 256 * MB, 1)],
+    'deep': [(200, 256 * KB, 12)],
+    'mixed': [(200, 32 * KB, 2), (20, 4 * MB, 3), (2, 128 * MB, 1)],
+}
+
+
+#########################################################################################
+# printf - Print to stdout with flush
+#
+def printf(msg):
+    print(msg, file=sys.stdout)
+    sys.stdout.flush()
+
+
+#########################################################################################
+# get_free_port - Ask the OS for an unused local TCP port
+#
+def get_free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+#########################################################################################
+# RangeRequestHandler - Static file handler that honours single 'Range: bytes=a-b' headers
+#
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        return
+
+    def send_head(self):
+        path = self.translate_path(self.path.split('?')[0])
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return None
+
+        size = os.path.getsize(path)
+        start, stop = 0, size - 1
+        range_hdr = self.headers.get('Range')
+        if range_hdr and range_hdr.startswith('bytes='):
+            first, last = range_hdr[len('bytes='):].split('-', 1)
+            start = int(first) if first else 0
+            stop = min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, stop, size))
+        else:
+            self.send_response(200)
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range_remaining = max(0, stop - start + 1)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(self.range_remaining))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        while self.range_remaining > 0:
+            chunk = source.read(min(MB, self.range_remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            self.range_remaining -= len(chunk)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+#########################################################################################
+# start_http_server - Serve root_dir over HTTP on a background thread. Returns base URL
+#
+def start_http_server(root_dir):
+    port = get_free_port()
+
+    class Handler(RangeRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(root_dir, path.lstrip('/'))
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, 'http://127.0.0.1:%d' % port
+
+
+#########################################################################################
+# start_s3_server - Start an in-process moto S3 server unless an endpoint was given.
+#   Returns (server or None, endpoint URL)
+#
+def start_s3_server(endpoint):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    server = None
+    if not endpoint:
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            printf('ERROR: moto[server] is not installed - install it or pass --endpoint for MinIO')
+            sys.exit(1)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        port = get_free_port()
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        server.start()
+        endpoint = 'http://127.0.0.1:%d' % port
+
+    # boto3 picks up the endpoint for every client created by aws_utils
+    os.environ['AWS_ENDPOINT_URL'] = endpoint
+    return server, endpoint
+
+
+#########################################################################################
+# generate_workload - Create the workload files under root_dir. Returns list of
+#   relative file paths
+#
+def generate_workload(name, root_dir, scale):
+    rel_paths = []
+    chunk = os.urandom(MB)
+    for group_no, (count, size, depth) in enumerate(WORKLOADS[name]):
+        size = max(1, int(size * scale))
+        for n in range(count):
+            subdirs = ['g%d' % group_no] + ['d%02d' % (level % 10) for level in range(1, depth)]
+            rel_path = '/'.join(subdirs + ['f%05d.bin' % n])
+            abs_path = os.path.join(root_dir, rel_path)
+            if not os.path.isdir(os.path.dirname(abs_path)):
+                os.makedirs(os.path.dirname(abs_path))
+            with open(abs_path, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    f.write(chunk[:min(remaining, MB)])
+                    remaining -= MB
+            rel_paths.append(rel_path)
+    return rel_paths
+
+
+#########################################################################################
+# Measure - Context manager recording wall time, CPU time and peak RSS of a benchmark
+#   step. Peak RSS of this process is reset through /proc/self/clear_refs when possible
+#
+class Measure(object):
+
+    def __enter__(self):
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except (IOError, OSError):
+            pass
+        self.usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        self.usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.time() - self.start
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.cpu = (usage_self.ru_utime - self.usage_self.ru_utime +
+                    usage_self.ru_stime - self.usage_self.ru_stime +
+                    usage_children.ru_utime - self.usage_children.ru_utime +
+                    usage_children.ru_stime - self.usage_children.ru_stime)
+        self.peak_rss_kb = get_peak_rss_kb()
+        self.children_peak_rss_kb = usage_children.ru_maxrss
+        return False
+
+
+#########################################################################################
+# get_peak_rss_kb - Peak resident set size of this process (VmHWM) in KB
+#
+def get_peak_rss_kb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+#########################################################################################
+# percentile - Nearest-rank percentile of a list of numbers
+#
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(math.ceil(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+#########################################################################################
+# make_result - Build the result record for one benchmark step
+#
+def make_result(m, tot_bytes, latencies=None, objects=None):
+    result = {
+        'seconds': round(m.wall, 4),
+        'bytes': tot_bytes,
+        'mb_per_sec': round(tot_bytes / MB / m.wall, 2) if m.wall else None,
+        'cpu_seconds': round(m.cpu, 3),
+        'peak_rss_kb': m.peak_rss_kb,
+        'children_peak_rss_kb': m.children_peak_rss_kb,
+    }
+    if objects is not None:
+        result['objects'] = objects
+    if latencies:
+        result['objects'] = len(latencies)
+        result['p50_latency_ms'] = round(percentile(latencies, 50) * 1000, 2)
+        result['p99_latency_ms'] = round(percentile(latencies, 99) * 1000, 2)
+    return result
+
+
+#########################################################################################
+# run_step - Run one benchmark step. fn() returns (bytes, per-object latencies or None,
+#   object count or None). A failing step is recorded with its error instead of aborting
+#   the whole run. A step that moved fewer (or more) bytes than the workload holds is
+#   recorded as failed too, keeping its numbers but without a throughput figure
+#
+def run_step(results, step, fn, expected_bytes=None):
+    try:
+        with Measure() as m:
+            tot_bytes, latencies, objects = fn()
+        results[step] = make_result(m, tot_bytes, latencies, objects)
+    except Exception as e:
+        printf('Step %s failed: %s' % (step, repr(e)))
+        results[step] = {'error': repr(e)}
+        return
+
+    if expected_bytes is not None and tot_bytes != expected_bytes:
+        error = 'Incomplete transfer: %s of %d bytes' % (tot_bytes, expected_bytes)
+        printf('Step %s failed: %s' % (step, error))
+        results[step].update({'error': error, 'expected_bytes': expected_bytes, 'mb_per_sec': None})
+
+
+#########################################################################################
+# run_workload - Run all transfer benchmarks for one workload. Returns dict of results
+#
+def run_workload(name, scale, work_dir, http_url, http_root):
+    import boto3
+    import scheduler.aws_utils as aws
+    import scheduler.transfer as transfer
+    from scheduler.logger import Logger
+
+    results = {}
+    src_dir = os.path.join(work_dir, 'src', name)
+    rel_paths = generate_workload(name, src_dir, scale)
+    tot_bytes = sum(os.path.getsize(os.path.join(src_dir, x)) for x in rel_paths)
+    printf('Workload %s: %d files, %.1f MB' % (name, len(rel_paths), tot_bytes / float(MB)))
+
+    # Seed the bucket directly so every download benchmark sees the full workload
+    client = boto3.client('s3')
+    prefix = 'bench/%s/' % name
+    for rel_path in rel_paths:
+        client.upload_file(os.path.join(src_dir, rel_path), BENCH_BUCKET, prefix + rel_path)
+
+    # -- s3_upload of the whole directory
+    def upload_dir():
+        up_bytes = aws.s3_upload(src_dir, BENCH_BUCKET, 'upload/%s/' % name)
+        uploaded = len(aws.s3_list_objects(BENCH_BUCKET, 'upload/%s/' % name))
+        return up_bytes, None, uploaded
+    run_step(results, 's3_upload', upload_dir, tot_bytes)
+
+    # -- s3_download_dir of the whole prefix
+    def download_dir():
+        tgt_dir = os.path.join(work_dir, 'dl_dir', name) + '/'
+        try:
+            dl_bytes = aws.s3_download_dir(BENCH_BUCKET, prefix, tgt_dir)
+            return dl_bytes, None, sum(len(x[2]) for x in os.walk(tgt_dir))
+        finally:
+            shutil.rmtree(tgt_dir, ignore_errors=True)
+    run_step(results, 's3_download_dir', download_dir, tot_bytes)
+
+    # -- s3_download_file one object at a time, for per-object latency
+    def download_files():
+        tgt_dir = os.path.join(work_dir, 'dl_file', name)
+        latencies = []
+        dl_bytes = 0
+        try:
+            for rel_path in rel_paths:
+                obj_info = {
+                    'bucket': BENCH_BUCKET,
+                    'obj_key': prefix + rel_path,
+                    'tgt_path': os.path.join(tgt_dir, rel_path),
+                    'region': 'us-east-1'
+                }
+                start = time.time()
+                dl_bytes += aws.s3_download_file(obj_info)
+                latencies.append(time.time() - start)
+        finally:
+            shutil.rmtree(tgt_dir, ignore_errors=True)
+        return dl_bytes, latencies, None
+    run_step(results, 's3_download_file', download_files, tot_bytes)
+
+    # -- DHaul.download_from_url against the local range server (single stream and multipart)
+    os.symlink(src_dir, os.path.join(http_root, name))
+    logger = Logger(logpath=os.path.join(work_dir, 'bench_d_haul.log'))
+
+    def download_urls(multipart):
+        tgt_dir = os.path.join(work_dir, 'dl_url', name)
+        latencies = []
+        dl_bytes = 0
+        try:
+            for rel_path in rel_paths:
+                dh = transfer.DHaul(logger, multipart=multipart)
+                dh.download_dir = os.path.join(tgt_dir, os.path.dirname(rel_path))
+                start = time.time()
+                dl_bytes += dh.download_from_url('%s/%s/%s' % (http_url, name, rel_path))
+                latencies.append(time.time() - start)
+        finally:
+            shutil.rmtree(tgt_dir, ignore_errors=True)
+        return dl_bytes, latencies, None
+    run_step(results, 'download_from_url', lambda: download_urls(False), tot_bytes)
+    run_step(results, 'download_from_url_multipart', lambda: download_urls(True), tot_bytes)
+
+    shutil.rmtree(src_dir, ignore_errors=True)
+    return results
+
+
+#########################################################################################
+# get_version_info - Identify the code under test
+#
+def get_version_info():
+    info = {'python': platform.python_version(), 'host': platform.node()}
+    try:
+        info['git_rev'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['git_rev'] = None
+    try:
+        import boto3
+        info['boto3'] = boto3.__version__
+    except ImportError:
+        pass
+    return info
+
+
+#########################################################################################
+# compare_results - Print the throughput ratio of each step against a baseline run.
+#   Returns the number of regressions beyond REGRESSION_THRESHOLD, counting steps that
+#   failed in the current run but not in the baseline
+#
+def compare_results(baseline, current):
+    regressions = 0
+    printf('%-10s %-30s %12s %12s %8s' % ('workload', 'step', 'base MB/s', 'MB/s', 'ratio'))
+    for workload, steps in sorted(current['results'].items()):
+        for step, result in sorted(steps.items()):
+            base = baseline.get('results', {}).get(workload, {}).get(step)
+            if base and result.get('error') and not base.get('error'):
+                printf('%-10s %-30s %s  FAILED' % (workload, step, result['error']))
+                regressions += 1
+                continue
+            if not base or not base.get('mb_per_sec') or not result.get('mb_per_sec'):
+                continue
+            ratio = result['mb_per_sec'] / base['mb_per_sec']
+            flag = ''
+            if ratio < 1 - REGRESSION_THRESHOLD:
+                flag = '  REGRESSION'
+                regressions += 1
+            printf('%-10s %-30s %12.2f %12.2f %8.2f%s'
+                   % (workload, step, base['mb_per_sec'], result['mb_per_sec'], ratio, flag))
+    return regressions
+
+
+########################################################################################
+# usage
+#
+def usage():
+    print()
+    print("Usage: transfer_bench.py [options]")
+    print()
+    print("  -w <list>,--workloads=<list>  Comma separated workloads (default: %s)" % ','.join(sorted(WORKLOADS)))
+    print("  -x <factor>,--scale=<factor>  Multiply workload file sizes by factor (default 1.0)")
+    print("  -e <url>,--endpoint=<url>     Use an existing S3 endpoint (e.g. MinIO) instead of moto")
+    print("  -d <dir>,--work-dir=<dir>     Scratch directory (default: a new temp dir)")
+    print("  -o <file>,--output=<file>     Write JSON results to file")
+    print("  -c <file>,--compare=<file>    Compare against a previous JSON result; exit 2 on regression")
+    print("  -h,--help                     This help message")
+    print()
+    sys.exit(1)
+
+
+#########################################################################################
+# main
+#
+def main():
+    workloads = sorted(WORKLOADS)
+    scale = 1.0
+    endpoint = None
+    work_dir = None
+    output_path = None
+    compare_path = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:x:e:d:o:c:h",
+                                   ["workloads=", "scale=", "endpoint=", "work-dir=", "output=",
+                                    "compare=", "help"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+
+    for o, v in opts:
+        if o in ("-w", "--workloads"):
+            workloads = [x.strip() for x in v.split(',') if x.strip()]
+        elif o in ("-x", "--scale"):
+            scale = float(v)
+        elif o in ("-e", "--endpoint"):
+            endpoint = v
+        elif o in ("-d", "--work-dir"):
+            work_dir = v
+        elif o in ("-o", "--output"):
+            output_path = v
+        elif o in ("-c", "--compare"):
+            compare_path = v
+        else:
+            usage()
+
+    for name in workloads:
+        if name not in WORKLOADS:
+            print("ERROR: Unknown workload %s" % name)
+            usage()
+
+    s3_server, endpoint = start_s3_server(endpoint)
+    work_dir = tempfile.mkdtemp(prefix='transfer_bench_', dir=work_dir)
+    http_root = os.path.join(work_dir, 'www')
+    os.makedirs(http_root)
+    http_server, http_url = start_http_server(http_root)
+
+    import boto3
+    client = boto3.client('s3')
+    try:
+        client.create_bucket(Bucket=BENCH_BUCKET)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    report = {
+        'version': get_version_info(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'endpoint': endpoint,
+        'scale': scale,
+        'results': {}
+    }
+    try:
+        for name in workloads:
+            report['results'][name] = run_workload(name, scale, work_dir, http_url, http_root)
+    finally:
+        http_server.shutdown()
+        if s3_server:
+            s3_server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if compare_path:
+        with open(compare_path, 'r') as f:
+            baseline = json.load(f)
+        if compare_results(baseline, report):
+            sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,20 +17,42 @@
 
 from __future__ import print_function
 
-from builtins import filter
-from builtins import str
-from builtins import object
 import copy
+import csv
 import datetime
 import glob
+import json
 import os
+import queue
 import resource
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
 import uuid
-import six
+import tempfile
+
+import scheduler.cleanup as cleanup
+import scheduler.disk_budget as disk_budget
+import scheduler.dragen_monitor as dragen_monitor
+import scheduler.fpga_slots as fpga_slots
+import scheduler.host_profiler as host_profiler
+import scheduler.http_transfer as http_transfer
+import scheduler.interruption as interruption
+import scheduler.local_fs as local_fs
+import scheduler.proc_runner as proc_runner
+import scheduler.scheduler_utils as utils
+import scheduler.stage_daemon as stage
+import scheduler.transfer as transfer
+from scheduler.logger import Logger
+
+# Modules pulling in boto3 are loaded on first use
+aws = utils.LazyModule('scheduler.aws_utils')
+compressed_ref = utils.LazyModule('scheduler.compressed_ref')
+job_plan = utils.LazyModule('scheduler.job_plan')
+ref_stager = utils.LazyModule('scheduler.ref_stager')
 
 
 #########################################################################################
@@ -77,46 +99,139 @@ def find_arg_in_list(arglist, *argv):
 
 
 #########################################################################################
-# exec_cmd - Execute command and return [stdout/stderr, exitstatus]
+# exec_cmd - Execute command and return the exit status. A list is run as argv without
+# a shell; a string is run by bash
 #
 def exec_cmd(cmd, shell=True):
-    printf("Executing %s" % cmd.strip())
-
-    if not shell:
+    if isinstance(cmd, list):
+        printf("Executing %s" % ' '.join(cmd))
+        try:
+            p = subprocess.Popen(cmd)
+        except OSError as e:
+            printf("Error: could not execute %s (%s)" % (cmd[0], str(e)))
+            return 127      # Same as bash for a missing command
+    elif not shell:
+        printf("Executing %s" % cmd.strip())
         p = subprocess.Popen(cmd.split())
     else:
+        printf("Executing %s" % cmd.strip())
         p = subprocess.Popen(cmd, shell=True, executable='/bin/bash')
 
     err = p.wait()
     return err
 
 
+#########################################################################################
+# get_instance_type - EC2 instance type of the host from the instance metadata service,
+# or None when not on EC2. Looked up once per process
+#
+def get_instance_type():
+    if DragenJob.instance_type is None:
+        try:
+            DragenJob.instance_type = interruption.read_imds_notice(DragenJob.IMDS_INSTANCE_TYPE_URL) or ''
+        except (IOError, OSError):
+            DragenJob.instance_type = ''
+    return DragenJob.instance_type or None
+
+
+#########################################################################################
+# load_node_ready - Load the node readiness record written by a reference prefetch
+#   Returns dict: {'fpga': <bool>, 'references': {<s3 url>: <local dir>}}
+#
+def load_node_ready(path):
+    ready = {'fpga': False, 'references': {}}
+    try:
+        with open(path, 'r') as f:
+            ready.update(json.load(f))
+    except (IOError, OSError, ValueError):
+        pass
+    return ready
+
+
+#########################################################################################
+# save_node_ready - Atomically write the node readiness record
+#
+def save_node_ready(path, ready):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(ready, f, indent=2)
+    os.rename(tmp_path, path)
+
+
 #########################################################################################
 # DragenJob - Dragen Job execution object
 #
 class DragenJob(object):
     DRAGEN_PATH = '/opt/edico/bin/dragen'
-    D_HAUL_UTIL = 'python3 /root/quickstart/d_haul'
     DRAGEN_LOG_FILE_NAME = 'dragen_log_%d.txt'
+    DRAGEN_USAGE_FILE_NAME = 'dragen_resource_usage.json'
+    DRAGEN_RESET_PATH = '/opt/edico/bin/dragen_reset'
+    DRAGEN_LOG_DIR = '/var/log/dragen'
+    DRAGEN_LOG_PREFIXES = ['dragen_run', 'hang_diag', 'pstack', 'dragen_info', 'dragen_replay']
     DEFAULT_DATA_FOLDER = '/ephemeral/'
     CLOUD_SPILL_FOLDER = '/ephemeral/'
 
-    FPGA_DOWNLOAD_STATUS_FILE = DEFAULT_DATA_FOLDER + 'fpga_dl_stat.txt'
-    REDIRECT_OUTPUT_CMD_SUFFIX = '> %s 2>&1'
+    FPGA_DOWNLOAD_STATUS_FILE = DEFAULT_DATA_FOLDER + 'fpga_dl_stat.txt'    # Slot 0, <name>_<N>.txt for slot N
+    FPGA_SLOT_OPT = '-Z'
+    NODE_READY_FILE = DEFAULT_DATA_FOLDER + 'node_ready.json'
+    PREFETCH_REFS_ENV_VAR = 'DRAGEN_PREFETCH_REFS'
+    SPEEDOMETER_FILE_NAME = 'job-speedometer.log'
+    STALL_TIMEOUT_ENV_VAR = 'DRAGEN_STALL_TIMEOUT_MINS'     # 0 disables stall detection
+    STALL_KILL_GRACE_SECS = 60
+    PROFILE_INTERVAL_ENV_VAR = 'DRAGEN_PROFILE_INTERVAL_SECS'   # 0 disables the host profiler
+    PROFILE_FILE_NAME = 'host_profile.csv'
+    PROFILE_SUMMARY_FILE_NAME = 'host_profile_summary.json'
+    COMPRESS_OUTPUTS_ENV_VAR = 'DRAGEN_COMPRESS_OUTPUTS'    # 'true' uploads text outputs as .zst
+    PACK_OUTPUTS_ENV_VAR = 'DRAGEN_PACK_OUTPUTS'            # 'true' packs small outputs in one archive
+    IMDS_INSTANCE_TYPE_URL = 'http://169.254.169.254/latest/meta-data/instance-type'
+
+    # Checkpoint and resume: on termination the latest reusable result (a complete BAM)
+    # and a checkpoint record are uploaded next to the outputs. A retry with the same
+    # arguments restarts from the BAM instead of the FASTQs
+    CHECKPOINT_FILE_NAME = 'dragen_checkpoint.json'
+    DRAGEN_STOP_GRACE_SECS = 15         # SIGKILL Dragen if it has not exited after SIGTERM
+    BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+    FASTQ_INPUT_OPTS = ['--fastq-list', '--fastq-list-sample-id', '--fastq-list-all-samples',
+                        '-1', '--fastq-file1', '-2', '--fastq-file2', '--RGID', '--RGSM']
+    MAP_ALIGN_OPTS = ['--enable-map-align', '--enable-map-align-output', '--enable-duplicate-marking']
+    RESUMABLE_OPTS = ['--enable-variant-caller', '--enable-cnv', '--enable-sv']
+
+    # Disk budgeting: outputs plus spill are estimated as a multiple of the FASTQ input size
+    OUTPUT_SPACE_FACTOR = 2.0
+    DEFAULT_OUTPUT_RESERVE_GB = 100         # Used when the FASTQ input size is unknown
+    ARCHIVE_EXPANSION_FACTOR = 3.0          # Estimated extracted size of a .tar.zst reference
+    OUTPUT_RESERVE_ENV_VAR = 'DRAGEN_OUTPUT_RESERVE_GB'
+    DISK_WAIT_ENV_VAR = 'DRAGEN_DISK_WAIT_MINS'
+    DEFAULT_DISK_WAIT_MINS = 10
+
+    # Attributes holding the URLs of the misc inputs downloaded by download_inputs
+    INPUT_URL_ATTRS = ['fastq_list_url', 'tumor_fastq_list_url', 'vc_tgt_bed_url', 'vc_depth_url',
+                       'cnv_normals_list_url', 'cnv_target_bed_url', 'dbsnp_url', 'cosmic_url',
+                       'qc_cross_cont_vcf_url', 'qc_coverage_region_1_url', 'qc_coverage_region_2_url',
+                       'qc_coverage_region_3_url', 'pedigree_file_url', 'vc_ml_url', 'bam_url']
+
+    staged_refs = {}        # Reference URL -> local dir, for complete references staged by this process
+    transfer_logger = None  # Logger shared by the in-process d_haul transfers of all jobs
+    ref_lock = threading.Lock()     # Concurrent jobs (slot mode) stage a shared reference once
+    watcher = None          # interruption.InterruptionWatcher of the process
+    instance_type = None    # EC2 instance type of the host, looked up once for the manifests
 
     ########################################################################################
     #
     def __init__(self, dragen_args):
 
+        self.job_args = copy.copy(dragen_args)     # As submitted, to match checkpoint records
         self.orig_args = dragen_args
         self.new_args = copy.copy(dragen_args)
 
         # Inputs needed for downloading
         self.ref_dir = None             # Create local directory to download reference
         self.input_dir = None           # Create local directory for Dragen input info
+        self.remove_input_dir = False   # Remove input_dir once the job is done (queue mode)
 
         self.ref_s3_url = None          # Determine from the -r or --ref-dir option
         self.ref_s3_index = -1
+        self.ref_stage_report = None    # Files staged/skipped by the reference stager
 
         self.fastq_list_url = None      # Determine from the --fastq-list option
         self.fastq_list_index = -1
@@ -160,16 +275,41 @@ class DragenJob(object):
         self.vc_ml_url = None           # Determine from --vc-ml-dir option
         self.vc_ml_index = -1
 
+        self.bam_url = None             # Determine from -b or --bam-input option
+        self.bam_index = -1
+
         # Output info
         self.output_s3_url = None       # Determine from the --output-directory field
         self.output_s3_index = -1
         self.output_dir = None          # Create local output directory for current dragen process
+        self.spill_dir = None           # Dragen intermediate results dir of the current process
+        self.dir_claims = {}            # Directory -> lock file marking it as owned by this job
 
         # Run-time variables
         self.input_dir = None          # Create local output directory for current dragen process
         self.process_start_time = None  # Process start time
         self.process_end_time = None    # Process end time
         self.global_exit_code = 0       # Global exit code. If any process fails then we exit with a non-zero status
+        self.dragen_proc = None         # ProcessRunner of the running Dragen process
+        self.dragen_output = {}         # Latest progress parsed from the Dragen output
+        self.dragen_usage = None        # Resource usage report of the last Dragen run
+        self.profiler = None            # Host resource profiler, started with the first phase
+        self.stalled = False            # Set when the speedometer monitor detected a hung run
+        self.staged = False             # Set once the reference and inputs are staged (queue mode)
+        self.disk_budget = disk_budget.DiskBudget(self.DEFAULT_DATA_FOLDER)
+        self.disk_reservation = None    # Space reserved on the data volume for this job
+        self.fpga_slot = None           # fpga_slots slot dict in slot mode, None runs on slot 0 unpinned
+        self.d_haul = None              # transfer.DHaul of this job, created on first transfer
+        self.transfers = []             # transfer.TransferResult of every completed transfer
+        self.fastq_bytes = None         # Size of the FASTQs in the fastq list(s), once resolved
+        self.ref_reused = False         # Set when the reference was already staged on the host
+        self.phase_times = []           # (phase, start time) of each phase, in order
+        self.interrupted = False        # Set when Dragen was stopped for termination
+        self.checkpoint = None          # Checkpoint record found at the output location
+        self.resume_bam_url = None      # S3 URL of the BAM this run resumed from
+
+        # Identify this job to the node-local staging daemon
+        os.environ[stage.OWNER_ENV_VAR] = stage.get_owner_id()
 
         self.set_resource_limits()
         self.parse_download_args()
@@ -269,6 +409,12 @@ class DragenJob(object):
             self.vc_ml_url = self.orig_args[opt_no + 1]
             self.vc_ml_index = opt_no + 1
 
+        # -b or --bam-input: URL for an input BAM, i.e. to resume from a checkpoint
+        opt_no = find_arg_in_list(self.orig_args, '-b', '--bam-input')
+        if opt_no >= 0:
+            self.bam_url = self.orig_args[opt_no + 1]
+            self.bam_index = opt_no + 1
+
         return
 
     ########################################################################################
@@ -297,7 +443,7 @@ class DragenJob(object):
             rlimit[resource.RLIMIT_NOFILE] = 65535
             rlimit[resource.RLIMIT_STACK] = 10240 * 1024
 
-        for res, limit in six.iteritems(rlimit):
+        for res, limit in rlimit.items():
             printf("Setting resource %s to %s" % (res, limit))
             try:
                 resource.setrlimit(res, (limit, limit))
@@ -317,47 +463,51 @@ class DragenJob(object):
     # /var/log/dragen_replay_<timestamp>_pid.json
     #
     def copy_var_log_dragen_files(self):
-        files = list(filter(os.path.isfile, glob.glob("/var/log/dragen/dragen_run*")))
-        if files:
-            newest_run_file = sorted(files, key=lambda x: os.path.getmtime(x), reverse=True)[0]
-            shutil.copy2(newest_run_file, self.output_dir)
-
-        files = list(filter(os.path.isfile, glob.glob("/var/log/dragen/hang_diag*")))
-        if files:
-            newest_hang_file = sorted(files, key=lambda x: os.path.getmtime(x), reverse=True)[0]
-            shutil.copy2(newest_hang_file, self.output_dir)
-
-        files = list(filter(os.path.isfile, glob.glob("/var/log/dragen/pstack*")))
-        if files:
-            newest_pstack_file = sorted(files, key=lambda x: os.path.getmtime(x), reverse=True)[0]
-            shutil.copy2(newest_pstack_file, self.output_dir)
-
-        files = list(filter(os.path.isfile, glob.glob("/var/log/dragen/dragen_info*")))
-        if files:
-            newest_info_file = sorted(files, key=lambda x: os.path.getmtime(x), reverse=True)[0]
-            shutil.copy2(newest_info_file, self.output_dir)
-
-        files = list(filter(os.path.isfile, glob.glob("/var/log/dragen/dragen_replay*")))
-        if files:
-            newest_replay_file = sorted(files, key=lambda x: os.path.getmtime(x), reverse=True)[0]
-            shutil.copy2(newest_replay_file, self.output_dir)
+        # One scan of the log dir, keeping the newest file of each kind
+        newest = {}
+        for path, st in local_fs.scan_files(self.DRAGEN_LOG_DIR, recursive=False):
+            name = os.path.basename(path)
+            for prefix in self.DRAGEN_LOG_PREFIXES:
+                if name.startswith(prefix) and (prefix not in newest or st.st_mtime > newest[prefix][1]):
+                    newest[prefix] = (path, st.st_mtime)
+
+        for prefix in self.DRAGEN_LOG_PREFIXES:
+            if prefix in newest:
+                shutil.copy2(newest[prefix][0], self.output_dir)
 
         return
 
+    ########################################################################################
+    # get_slot_number - FPGA slot the job runs on
+    #
+    def get_slot_number(self):
+        return self.fpga_slot['slot'] if self.fpga_slot else 0
+
+    ########################################################################################
+    # get_fpga_status_file - File marking the FPGA of the job's slot as programmed
+    #
+    def get_fpga_status_file(self):
+        slot = self.get_slot_number()
+        if not slot:
+            return self.FPGA_DOWNLOAD_STATUS_FILE
+        base, ext = os.path.splitext(self.FPGA_DOWNLOAD_STATUS_FILE)
+        return '%s_%d%s' % (base, slot, ext)
+
     ########################################################################################
     # download_dragen_fpga - Perform the 'partial reconfig' to download binary image to FPGA
-    #   NOTE: Should ONLY be called when self.FPGA_DOWNLOAD_STATUS_FILE does not exist
+    #   NOTE: Should ONLY be called when the get_fpga_status_file() file does not exist
     #
     def download_dragen_fpga(self):
         exit_code = \
-            exec_cmd("/opt/edico/bin/dragen --partial-reconfig DNA-MAPPER --ignore-version-check true -Z 0")
+            exec_cmd([self.DRAGEN_PATH, '--partial-reconfig', 'DNA-MAPPER', '--ignore-version-check', 'true',
+                      self.FPGA_SLOT_OPT, str(self.get_slot_number())])
 
         if not exit_code:
             # PR complete success. Write '1' into status file
-            f = open(self.FPGA_DOWNLOAD_STATUS_FILE, 'w')
+            f = open(self.get_fpga_status_file(), 'w')
             f.write('1')
             f.close()
-            printf('Completed Partial Reconfig for FPGA')
+            printf('Completed Partial Reconfig for FPGA slot %d' % self.get_slot_number())
             return True
 
         # Error!
@@ -368,43 +518,58 @@ class DragenJob(object):
     # check_board_state - Check dragen_board state and run reset (if needed)
     #
     def check_board_state(self):
-        exit_code = exec_cmd("/opt/edico/bin/dragen_reset -cv")
+        exit_code = exec_cmd(self.get_reset_cmd() + ['-cv'])
         if not exit_code:
             return
 
         printf("Dragen board is in a bad state - running dragen_reset")
-        exec_cmd("/opt/edico/bin/dragen_reset")
+        exec_cmd(self.get_reset_cmd())
         return
 
     ########################################################################################
-    # exec_download - Download a file from the given URL to the target directory
+    # get_reset_cmd - dragen_reset command of the job's FPGA slot (all boards if not in
+    #   slot mode)
     #
-    def exec_url_download(self, url, target_dir):
-        dl_cmd = '{bin} --mode download --url {url} --path {target}'.format(
-            bin=self.D_HAUL_UTIL,
-            url=url,
-            target=target_dir)
+    def get_reset_cmd(self):
+        if not self.fpga_slot:
+            return [self.DRAGEN_RESET_PATH]
+        return [self.DRAGEN_RESET_PATH, self.FPGA_SLOT_OPT, str(self.get_slot_number())]
 
-        exit_code = exec_cmd(dl_cmd)
+    ########################################################################################
+    # run_transfer - Run one d_haul transfer in this process: op is 'download' or 'upload'
+    #   and the arguments are those of transfer.DHaul.download / upload. Exits on failure,
+    #   otherwise records and returns the transfer.TransferResult
+    #
+    def run_transfer(self, op, *args, **kwargs):
+        if not self.d_haul:
+            if not DragenJob.transfer_logger:
+                DragenJob.transfer_logger = Logger(procname='d_haul', async_writer=False)
+            self.d_haul = transfer.DHaul(DragenJob.transfer_logger)
 
-        if exit_code:
-            printf('Error: Failure downloading from S3. Exiting with code %d' % exit_code)
-            sys.exit(exit_code)
+        try:
+            result = getattr(self.d_haul, op)(*args, **kwargs)
+        except Exception as e:
+            printf('Error: Failure in %s (%s: %s). Exiting with code 1' % (op, type(e).__name__, str(e)))
+            sys.exit(1)
+
+        self.transfers.append(result)
+        printf('%s complete: %d bytes in %.1f secs%s (%s -> %s)'
+               % (result.op.capitalize(), result.nbytes, result.seconds,
+                  ' from the staging cache' if result.cached else '', result.source, result.path))
+        return result
+
+    ########################################################################################
+    # exec_download - Download a file from the given URL to the target directory
+    #
+    def exec_url_download(self, url, target_dir):
+        self.run_transfer('download', target_dir, url=url)
         return
 
     ########################################################################################
     # download_s3_object: Download an object from S3 bucket/key to spefific target file path
     #
     def download_s3_object(self, bucket, key, target_path):
-        dl_cmd = '{bin} --mode download --bucket {bucket} --key {key} --path {target}'.format(
-            bin=self.D_HAUL_UTIL,
-            bucket=bucket,
-            key=key,
-            target=target_path)
-        exit_code = exec_cmd(dl_cmd)
-        if exit_code:
-            printf('Error: Failure downloading from S3. Exiting with code %d' % exit_code)
-            sys.exit(exit_code)
+        self.run_transfer('download', target_path, bucket=bucket, key=key)
 
     ########################################################################################
     # download_inputs: Download specific Dragen inputs needed from provided URLs, and
@@ -611,13 +776,29 @@ class DragenJob(object):
 
             self.new_args[self.vc_ml_index] = target_path
 
+            # -b input BAM download
+        if self.bam_url:
+            filename = self.bam_url.split('?')[0].split('/')[-1]
+            target_path = self.input_dir + str(filename)
+
+            s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.bam_url)
+            if s3_valid:
+                self.download_s3_object(s3_bucket, s3_key, target_path)
+            else:
+                # Try to download using http
+                self.exec_url_download(self.bam_url, self.input_dir)
+
+            self.new_args[self.bam_index] = target_path
+
         return
 
     ########################################################################################
     # download_ref_tables: Download directory of reference hash tables using the S3
     #  "directory" prefix self.ref_s3_url should be in format s3://bucket/ref_objects_prefix
+    #  all_artifacts - Stage the optional artifacts (CNV, RNA tables) whether or not this
+    #                  command line uses them, i.e. for a prefetch shared by later jobs
     #
-    def download_ref_tables(self):
+    def download_ref_tables(self, all_artifacts=False):
 
         if not self.ref_s3_url:
             printf('Warning: No reference HT directory URL specified!')
@@ -630,21 +811,289 @@ class DragenJob(object):
             printf('Error: could not get S3 bucket and key info from specified URL %s' % self.ref_s3_url)
             sys.exit(1)
 
+        # Skip the download if an earlier job in this process (queue mode) staged the complete
+        # reference. References staged for a specific command line are not recorded, since
+        # their optional artifacts depend on it
+        if self.ref_s3_url in DragenJob.staged_refs:
+            self.ref_dir = DragenJob.staged_refs[self.ref_s3_url]
+            self.ref_reused = True
+            self.new_args[self.ref_s3_index] = self.ref_dir
+            return
+
+        # Skip the download if the reference was already staged by a prefetch at instance boot.
+        # Prefetches stage every artifact, so the directory is complete for any command line
+        ready_dir = load_node_ready(self.NODE_READY_FILE)['references'].get(self.ref_s3_url)
+        if ready_dir and os.path.isdir(ready_dir):
+            printf('Reference %s already prefetched to %s - skip download' % (self.ref_s3_url, ready_dir))
+            self.ref_dir = ready_dir
+            self.ref_reused = True
+            self.new_args[self.ref_s3_index] = self.ref_dir
+            return
+
         target_path = self.DEFAULT_DATA_FOLDER  # Specifies the root
-        dl_cmd = '{bin} --mode download --bucket {bucket} --key {key} --path {target}'.format(
-            bin=self.D_HAUL_UTIL,
-            bucket=s3_bucket,
-            key=s3_key,
-            target=target_path)
 
-        exit_code = exec_cmd(dl_cmd)
+        if compressed_ref.is_archive_key(s3_key):
+            # Reference stored as a zstd compressed tar - stream, decompress and extract it
+            self.extract_ref_archive(s3_bucket, s3_key)
+            self.new_args[self.ref_s3_index] = self.ref_dir
+            DragenJob.staged_refs[self.ref_s3_url] = self.ref_dir
+            return
 
-        if exit_code:
-            printf('Error: Failure downloading from S3. Exiting with code %d' % exit_code)
-            sys.exit(exit_code)
+        if stage.get_socket_path():
+            # The node-local staging daemon shares the whole reference between jobs
+            self.run_transfer('download', target_path, bucket=s3_bucket, key=s3_key)
+        else:
+            # Stage only the hash table files this command line needs, metadata first. Files
+            # already staged by an earlier job are skipped, so this is cheap when repeated
+            try:
+                self.ref_stage_report = ref_stager.stage_ref_tables(
+                    s3_bucket, s3_key, target_path, None if all_artifacts else self.orig_args)
+            except Exception as e:
+                printf('Error: Failure downloading reference from S3 (%s). Exiting with code 1' % str(e))
+                sys.exit(1)
+
+            printf('Staged %d reference files (%d bytes downloaded) in %.1f secs'
+                   % (len(self.ref_stage_report['needed']), self.ref_stage_report['bytes'],
+                      self.ref_stage_report['seconds']))
+            printf('Reference files needed by this run: %s' % ', '.join(self.ref_stage_report['needed']))
+            if self.ref_stage_report['skipped']:
+                printf('Reference files skipped as unused: %s' % ', '.join(self.ref_stage_report['skipped']))
 
         self.ref_dir = self.DEFAULT_DATA_FOLDER + s3_key
         self.new_args[self.ref_s3_index] = self.ref_dir
+        if stage.get_socket_path() or all_artifacts:
+            DragenJob.staged_refs[self.ref_s3_url] = self.ref_dir
+        return
+
+    ########################################################################################
+    # get_url_size - Size in bytes of the object behind an s3:// or http(s) URL, or 0 if
+    #   it can not be determined
+    #
+    def get_url_size(self, url):
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(url)
+        try:
+            if s3_valid:
+                return aws.s3_get_object_info(s3_bucket, s3_key)['ContentLength']
+            # Probed over the keep-alive session the download reuses later
+            return http_transfer.probe_url(url)[0] or 0
+        except Exception as e:
+            printf('Warning: could not get size of %s (%s)' % (url, str(e)))
+            return 0
+
+    ########################################################################################
+    # estimate_ref_bytes - Bytes still to be written to stage the reference, and the local
+    #   directory it is staged to (None if the job has no reference)
+    #
+    def estimate_ref_bytes(self):
+        if not self.ref_s3_url:
+            return 0, None
+        if self.ref_s3_url in DragenJob.staged_refs:
+            # Staged by an earlier job, but still protected from eviction while this one runs
+            return 0, DragenJob.staged_refs[self.ref_s3_url]
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.ref_s3_url)
+        if not s3_valid or not s3_key:
+            return 0, None
+
+        local_dir = self.DEFAULT_DATA_FOLDER + compressed_ref.strip_compressed_suffix(s3_key)
+        if compressed_ref.is_archive_key(s3_key):
+            if os.path.isdir(local_dir):
+                return 0, local_dir
+            return int(self.get_url_size(self.ref_s3_url) * self.ARCHIVE_EXPANSION_FACTOR), local_dir
+
+        try:
+            tot_bytes = sum(x['Size'] for x in aws.s3_list_objects(s3_bucket, s3_key.rstrip('/') + '/'))
+        except Exception as e:
+            printf('Warning: could not list reference %s (%s)' % (self.ref_s3_url, str(e)))
+            return 0, local_dir
+        return max(0, tot_bytes - disk_budget.get_tree_size(local_dir)), local_dir
+
+    ########################################################################################
+    # get_fastq_urls - URLs of the FASTQs listed in the fastq list(s)
+    #
+    def get_fastq_urls(self):
+        urls = []
+        for list_url in [self.fastq_list_url, self.tumor_fastq_list_url]:
+            s3_valid, s3_bucket, s3_key = get_s3_bucket_key(list_url or '')
+            if not s3_valid:
+                continue
+            try:
+                lines = aws.s3_get_object_body(s3_bucket, s3_key).decode('utf-8').splitlines()
+            except Exception as e:
+                printf('Warning: could not read fastq list %s (%s)' % (list_url, str(e)))
+                continue
+            for row in csv.DictReader(lines):
+                urls.extend(row[x] for x in ('Read1File', 'Read2File') if row.get(x))
+        return urls
+
+    ########################################################################################
+    # estimate_output_bytes - Outputs plus intermediate spill, from the FASTQ sizes listed
+    #   in the fastq list(s). The FASTQs of a run usually share a prefix, so they are sized
+    #   with one listing rather than a HEAD each
+    #
+    def estimate_output_bytes(self):
+        sizes = job_plan.resolve_sizes(self.get_fastq_urls())
+        for url in [x for x, size in sizes.items() if size is None]:
+            printf('Warning: could not get size of %s' % url)
+        self.fastq_bytes = sum(x for x in sizes.values() if x)
+
+        if os.environ.get(self.OUTPUT_RESERVE_ENV_VAR):
+            return int(float(os.environ[self.OUTPUT_RESERVE_ENV_VAR]) * disk_budget.GB)
+        if self.fastq_bytes:
+            return int(self.fastq_bytes * self.OUTPUT_SPACE_FACTOR)
+        return self.DEFAULT_OUTPUT_RESERVE_GB * disk_budget.GB
+
+    ########################################################################################
+    # reserve_disk - Estimate the space the job needs on the data volume and reserve it
+    #   before anything is staged. Exits with a clear error if it can not fit
+    #
+    def reserve_disk(self):
+        ref_bytes, ref_dir = self.estimate_ref_bytes()
+        input_bytes = sum(self.get_url_size(getattr(self, x)) for x in self.INPUT_URL_ATTRS if getattr(self, x))
+        output_bytes = self.estimate_output_bytes()
+        tot_bytes = ref_bytes + input_bytes + output_bytes
+        printf('Disk estimate: reference %.1f GB, inputs %.1f GB, outputs and spill %.1f GB'
+               % (ref_bytes / disk_budget.GB, input_bytes / disk_budget.GB, output_bytes / disk_budget.GB))
+
+        wait_mins = float(os.environ.get(self.DISK_WAIT_ENV_VAR, self.DEFAULT_DISK_WAIT_MINS))
+        try:
+            self.disk_reservation = self.disk_budget.reserve(
+                tot_bytes, 'reference, inputs and outputs', paths=[ref_dir] if ref_dir else [],
+                wait_secs=wait_mins * 60)
+        except disk_budget.DiskBudgetError as e:
+            printf('Error: %s' % str(e))
+            sys.exit(1)
+        return
+
+    ########################################################################################
+    # plan_job - Dry run: estimate the bytes, time and disk space of each phase of the job
+    #   from the sizes of its inputs, without staging anything or touching the FPGA
+    #   model - job_plan throughput model (default: job_plan.load_model())
+    #   Returns dict {'phases': [{'phase', 'bytes', 'seconds'}], 'disk_bytes', 'cost'}
+    #
+    def plan_job(self, model=None):
+        model = model or job_plan.load_model(printf)
+
+        # Reference: only the files this command line needs, or the whole archive
+        ref_bytes = ref_disk_bytes = 0
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.ref_s3_url or '')
+        if s3_valid and s3_key:
+            try:
+                if compressed_ref.is_archive_key(s3_key):
+                    ref_bytes = self.get_url_size(self.ref_s3_url)
+                    ref_disk_bytes = int(ref_bytes * self.ARCHIVE_EXPANSION_FACTOR)
+                else:
+                    plan = ref_stager.plan_ref_staging(s3_bucket, s3_key, self.orig_args)
+                    ref_bytes = ref_disk_bytes = sum(x['Size'] for kind in ('metadata', 'small', 'large')
+                                                     for x in plan[kind])
+            except Exception as e:
+                printf('Warning: could not size reference %s (%s)' % (self.ref_s3_url, str(e)))
+
+        input_sizes = job_plan.resolve_sizes([getattr(self, x) for x in self.INPUT_URL_ATTRS])
+        for url in [x for x, size in input_sizes.items() if size is None]:
+            printf('Warning: could not get size of %s' % url)
+        input_bytes = sum(x for x in input_sizes.values() if x)
+        output_disk_bytes = self.estimate_output_bytes()
+        upload_bytes = int((self.fastq_bytes or 0) * model['output_ratio'])
+        dragen_secs = None
+        if self.fastq_bytes and model['dragen_secs_per_gb']:
+            dragen_secs = self.fastq_bytes / disk_budget.GB * model['dragen_secs_per_gb']
+
+        phases = [
+            {'phase': 'reference', 'bytes': ref_bytes,
+             'seconds': job_plan.transfer_seconds(ref_bytes, model['download_mbps'])},
+            {'phase': 'inputs', 'bytes': input_bytes,
+             'seconds': job_plan.transfer_seconds(input_bytes, model['download_mbps'])},
+            {'phase': 'dragen', 'bytes': self.fastq_bytes or 0, 'seconds': dragen_secs},
+            {'phase': 'upload', 'bytes': upload_bytes,
+             'seconds': job_plan.transfer_seconds(upload_bytes, model['upload_mbps'])}
+        ]
+        disk_bytes = ref_disk_bytes + input_bytes + output_disk_bytes
+        known_secs = sum(x['seconds'] for x in phases if x['seconds'] is not None)
+        cost = known_secs / 3600 * job_plan.get_hourly_cost()
+
+        printf('Plan for %s' % (self.output_s3_url or ' '.join(self.job_args)))
+        for entry in phases:
+            printf('  %-10s %9.2f GB  %s' % (entry['phase'], entry['bytes'] / disk_budget.GB,
+                                            job_plan.format_secs(entry['seconds'])
+                                            if entry['seconds'] is not None else 'unknown'))
+        printf('  disk       %9.2f GB  (reference %.2f, inputs %.2f, outputs and spill %.2f)'
+               % (disk_bytes / disk_budget.GB, ref_disk_bytes / disk_budget.GB, input_bytes / disk_budget.GB,
+                  output_disk_bytes / disk_budget.GB))
+        printf('  cost       $%.2f%s' % (cost, '' if dragen_secs is not None else ' plus the Dragen run'))
+        return {'phases': phases, 'disk_bytes': disk_bytes, 'cost': cost}
+
+    ########################################################################################
+    # release_disk - Give back the disk space reservation of the job
+    #
+    def release_disk(self):
+        if self.disk_reservation:
+            self.disk_budget.release(self.disk_reservation)
+            self.disk_reservation = None
+        return
+
+    ########################################################################################
+    # stage_inputs: Download the reference and all other inputs of the job
+    #
+    def stage_inputs(self):
+        self.set_phase('prepare_disk')
+        self.resume_from_checkpoint()
+
+        # Reclaim output and spill directories left behind by crashed jobs on this host
+        stale_dirs = cleanup.reclaim_stale(self.DEFAULT_DATA_FOLDER)
+        if stale_dirs:
+            printf('Reclaiming stale directories: %s' % ', '.join(stale_dirs))
+        cleanup.purge_in_background(self.DEFAULT_DATA_FOLDER)
+
+        printf('Reserving disk space')
+        self.reserve_disk()
+
+        printf('Downloading reference files')
+        self.set_phase('download_reference')
+        with DragenJob.ref_lock:
+            self.download_ref_tables()
+        if self.ref_dir and os.path.isdir(self.ref_dir):
+            # The reference stays on disk for later jobs but may be evicted when cold. It
+            # may have been staged elsewhere than estimated (i.e. by a prefetch), so make
+            # sure the reservation protects the directory Dragen actually reads
+            self.disk_budget.register_cache_entry(self.ref_dir)
+            if self.disk_reservation:
+                self.disk_budget.add_paths(self.disk_reservation, [self.ref_dir])
+
+        printf('Downloading misc inputs (csv, bed)')
+        self.set_phase('download_inputs')
+        self.download_inputs()
+        self.set_phase('staged')
+        return
+
+    ########################################################################################
+    # extract_ref_archive - Stage a reference stored as s3://bucket/<ref>.tar.zst into
+    #  DEFAULT_DATA_FOLDER/<ref>/. The archive is extracted to a temp dir and renamed into
+    #  place, so a reference dir that exists is always complete and can be reused as-is
+    #
+    def extract_ref_archive(self, s3_bucket, s3_key):
+        self.ref_dir = self.DEFAULT_DATA_FOLDER + compressed_ref.strip_compressed_suffix(s3_key)
+        if os.path.isdir(self.ref_dir):
+            printf('Reference %s already extracted - skip download' % self.ref_dir)
+            return
+
+        tmp_dir = '%s.%d.tmp' % (self.ref_dir, os.getpid())
+        start_time = time.time()
+        try:
+            tot_bytes = compressed_ref.s3_download_extract(s3_bucket, s3_key, tmp_dir)
+            os.rename(tmp_dir, self.ref_dir)
+        except OSError as e:
+            # Another job on this host may have finished extracting first
+            if not os.path.isdir(self.ref_dir):
+                printf('Error: Failure extracting reference archive (%s). Exiting with code 1' % str(e))
+                sys.exit(1)
+            tot_bytes = 0
+        except Exception as e:
+            printf('Error: Failure downloading reference archive (%s). Exiting with code 1' % str(e))
+            sys.exit(1)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        printf('Extracted %d reference bytes to %s in %.1f secs' % (tot_bytes, self.ref_dir, time.time() - start_time))
         return
 
     ########################################################################################
@@ -657,25 +1106,32 @@ class DragenJob(object):
             printf('Error: Output S3 location not specified!')
             return
 
-        # Generate the command to upload the results
+        # Get the S3 location to upload the results to
         s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.output_s3_url)
 
         if not s3_valid or not s3_key or not s3_bucket:
             printf('Error: could not get S3 bucket and key info from specified URL %s' % self.output_s3_url)
             sys.exit(1)
 
-        ul_cmd = '{bin} --mode upload --bucket {bucket} --key {key} --path {file} -s'.format(
-            bin=self.D_HAUL_UTIL,
-            bucket=s3_bucket,
-            key=s3_key,
-            file=self.output_dir.rstrip('/'))
-
-        exit_code = exec_cmd(ul_cmd)
-
-        if exit_code:
-            printf('Error: Failure uploading outputs. Exiting with code %d' % exit_code)
-            sys.exit(exit_code)
+        # Optionally compress the logs, metrics and other text outputs on the way, and pack
+        # the small files into one indexed archive
+        compress = os.environ.get(self.COMPRESS_OUTPUTS_ENV_VAR, '').lower() in ('1', 'true', 'yes')
+        pack = os.environ.get(self.PACK_OUTPUTS_ENV_VAR, '').lower() in ('1', 'true', 'yes')
+        self.run_transfer('upload', self.output_dir.rstrip('/'), s3_bucket, s3_key, compress=compress, pack=pack)
+        return
 
+    ########################################################################################
+    # release_staged_inputs - Drop this job's references on shared staging cache entries so
+    #   the daemon may evict them. No-op if the staging daemon is not running
+    #
+    def release_staged_inputs(self):
+        if not stage.get_socket_path():
+            return
+        try:
+            reply = stage.stage_request({'op': 'release', 'owner': stage.get_owner_id()})
+            printf('Released %s staging cache entries' % reply.get('released', 0))
+        except (IOError, OSError) as e:
+            printf('Warning: could not release staging cache entries (%s)' % str(e))
         return
 
     ########################################################################################
@@ -687,8 +1143,8 @@ class DragenJob(object):
             self.output_dir = self.DEFAULT_DATA_FOLDER + str(uuid.uuid4())
             printf("Output directory does not exist - creating %s" % self.output_dir)
             try:
-                os.makedirs(self.output_dir)
-            except os.error:
+                self.claim_dir(self.output_dir)
+            except (IOError, OSError):
                 # dragen execution will fail
                 printf("Error: Could not create output_directory %s" % self.output_dir)
                 sys.exit(1)
@@ -701,60 +1157,244 @@ class DragenJob(object):
 
         return
 
+    ########################################################################################
+    # claim_dir - Create a job directory and mark it as owned by this job, so that it is
+    #   only reclaimed by another job if this one dies without cleaning up
+    #
+    def claim_dir(self, path):
+        self.dir_claims[path] = cleanup.claim_dir(self.DEFAULT_DATA_FOLDER, path)
+
+    ########################################################################################
+    # create_spill_dir - Create a unique Dragen intermediate results directory for this run
+    #
+    def create_spill_dir(self):
+        self.spill_dir = os.path.join(cleanup.get_spill_root(self.CLOUD_SPILL_FOLDER), str(uuid.uuid4()))
+        try:
+            self.claim_dir(self.spill_dir)
+        except (IOError, OSError):
+            printf("Error: Could not create intermediate results directory %s" % self.spill_dir)
+            sys.exit(1)
+        return
+
+    ########################################################################################
+    # discard_job_dirs - Move the output, spill and (queue mode) input directories out of
+    #   the way. They are deleted by a later cleanup.purge()
+    #
+    def discard_job_dirs(self):
+        job_dirs = [self.output_dir, self.spill_dir]
+        if self.remove_input_dir:
+            job_dirs.append(self.input_dir)
+        for path in job_dirs:
+            if path and os.path.exists(path):
+                printf("Removing %s" % path)
+                cleanup.discard(self.DEFAULT_DATA_FOLDER, path)
+            if path in self.dir_claims:
+                cleanup.unclaim_dir(self.DEFAULT_DATA_FOLDER, path, self.dir_claims.pop(path))
+        return
+
+    ########################################################################################
+    # report_progress - Speedometer monitor callback: print the latest Dragen progress
+    #
+    def report_progress(self, status):
+        elapsed = (datetime.datetime.utcnow() - self.process_start_time).total_seconds()
+        usage = self.dragen_proc.get_live_usage() if self.dragen_proc else None
+        printf("Dragen progress after %s: stage=%s percent=%s reads/sec=%s%s"
+               % (utils.seconds_to_hr_min_sec(elapsed), status.get('stage', '-'), status.get('percent', '-'),
+                  status.get('reads_per_sec', '-'),
+                  (' cpu=%.0fs rss=%.1fGB' % (usage['cpu_seconds'], usage['rss_bytes'] / 1024.0 ** 3))
+                  if usage else ''))
+
+    ########################################################################################
+    # handle_dragen_output - Line callback of the Dragen process runner: keep the latest
+    #   progress found in the output and echo errors as they happen
+    #
+    def handle_dragen_output(self, stream, line):
+        status = dragen_monitor.parse_status_line(line)
+        if status and 'percent' in status:
+            self.dragen_output = status
+        if stream == 'stderr' or 'ERROR' in line:
+            printf("[dragen %s] %s" % (stream, line))
+
+    ########################################################################################
+    # handle_stall - Speedometer monitor callback: Dragen made no progress for too long.
+    #   Save the diagnostics and stop the process instead of burning FPGA hours on a
+    #   hung board. run_job resets the board once the process has exited
+    #
+    def handle_stall(self, idle_secs):
+        printf("Error: No Dragen progress for %d minutes - stopping the job" % (idle_secs // 60))
+        self.stalled = True
+        self.copy_var_log_dragen_files()
+
+        # Dragen was started with setsid, so its process group id is its pid. The process
+        # may exit (and be reaped by the main thread) at any point in between
+        try:
+            os.killpg(self.dragen_proc.pid, signal.SIGTERM)
+            deadline = time.time() + self.STALL_KILL_GRACE_SECS
+            while self.dragen_proc.poll() is None and time.time() < deadline:
+                time.sleep(1)
+            if self.dragen_proc.poll() is None:
+                os.killpg(self.dragen_proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            printf("Dragen process already exited")
+        return
+
+    ########################################################################################
+    # get_stall_timeout - Stall timeout in seconds from $DRAGEN_STALL_TIMEOUT_MINS, falling
+    #   back to the default if it is not a number
+    #
+    def get_stall_timeout(self):
+        default_mins = dragen_monitor.DEFAULT_STALL_TIMEOUT_SECS / 60
+        value = os.environ.get(self.STALL_TIMEOUT_ENV_VAR)
+        if value is None:
+            return default_mins * 60
+        try:
+            return max(0.0, float(value)) * 60
+        except ValueError:
+            printf("Warning: invalid %s=%s - using the default of %d minutes"
+                   % (self.STALL_TIMEOUT_ENV_VAR, value, default_mins))
+            return default_mins * 60
+
     ########################################################################################
     # run_job - Create the command line for the given process, launch it, and monitor
     # it for completion.
     #
     def run_job(self):
+        exit_code = self.execute_dragen()
+        self.finish_job(exit_code)
+
+        # Delete the discarded directories after this job exits, without delaying it
+        cleanup.spawn_purge(self.DEFAULT_DATA_FOLDER)
+        return
+
+    ########################################################################################
+    # execute_dragen - Prepare the board, run the Dragen process to completion and return
+    #   its exit code
+    #   check_board - Set False to skip the board state check, i.e. when the previous
+    #                 Dragen run on this board exited cleanly
+    #
+    def execute_dragen(self, check_board=True):
+        if DragenJob.watcher and DragenJob.watcher.interrupted:
+            printf("Termination requested (%s) - not starting Dragen" % DragenJob.watcher.reason)
+            self.interrupted = True
+            return 128 + signal.SIGTERM
+
+        self.set_phase('prepare_board')
 
         # Check if FPGA image download is needed
-        if not os.path.isfile(self.FPGA_DOWNLOAD_STATUS_FILE):
+        if not os.path.isfile(self.get_fpga_status_file()):
             self.download_dragen_fpga()
 
         # If board is in bad state, run dragen_reset before next process starts
-        self.check_board_state()
+        if check_board:
+            self.check_board_state()
 
-        # Setup unique output directory
+        # Setup unique output and intermediate results directories
         self.create_output_dir()
+        self.create_spill_dir()
+        if self.disk_reservation:
+            self.disk_budget.add_paths(self.disk_reservation, [self.output_dir, self.spill_dir])
 
         # Add some internally defined parameters
+        status_path = self.output_dir + '/' + self.SPEEDOMETER_FILE_NAME
         self.new_args.extend(
-            ['--output_status_file', self.output_dir + '/job-speedometer.log']
+            ['--output_status_file', status_path]
         )
         self.new_args.extend(
-            ['--intermediate-results-dir', self.CLOUD_SPILL_FOLDER]
+            ['--intermediate-results-dir', self.spill_dir]
         )
         self.new_args.extend(
             ['--lic-no-print']
         )
+        if self.fpga_slot:
+            self.new_args.extend(
+                [self.FPGA_SLOT_OPT, str(self.get_slot_number())]
+            )
 
-        # expand the Dragen args to construct the full command
-        dragen_opts = ' '.join(self.new_args)
+        # Save the Dragen output to a (size rotated) file instead of stdout
+        output_log_path = self.output_dir + '/' + self.DRAGEN_LOG_FILE_NAME % round(time.time())
+        self.dragen_proc = proc_runner.ProcessRunner([self.DRAGEN_PATH] + self.new_args,
+                                                     log_path=output_log_path,
+                                                     on_line=self.handle_dragen_output,
+                                                     cpu_set=self.fpga_slot['cpus'] if self.fpga_slot else None)
+
+        # Run the Dragen process, tailing its status file for progress and stalls
+        monitor = dragen_monitor.SpeedometerMonitor(status_path,
+                                                    on_progress=self.report_progress,
+                                                    on_stall=self.handle_stall,
+                                                    stall_timeout=self.get_stall_timeout())
+        self.process_start_time = datetime.datetime.utcnow()
+        printf("Executing %s" % ' '.join(self.dragen_proc.argv))
+        self.set_phase('dragen')
+        self.dragen_proc.start()
+        if DragenJob.watcher and DragenJob.watcher.interrupted:
+            self.handle_interrupt(DragenJob.watcher.reason)
+        monitor.start()
+        exit_code = self.dragen_proc.wait()
+        monitor.stop()
+        self.set_phase('dragen_done')
+        self.save_dragen_usage()
+
+        if self.stalled:
+            # Leave the board usable for the next job
+            exec_cmd(self.get_reset_cmd())
+
+        # Include the Dragen diagnostics with the outputs of a failed run. Done here, before
+        # the next Dragen run (queue mode) writes newer /var/log/dragen files
+        if exit_code and not self.stalled:
+            self.copy_var_log_dragen_files()
 
-        # Construct the 'main' Dragen command
-        dragen_cmd = "%s %s " % (self.DRAGEN_PATH, dragen_opts)
+        return exit_code
 
-        # Save the Dragen output to a file instead of stdout
-        output_log_path = self.output_dir + '/' + self.DRAGEN_LOG_FILE_NAME % round(time.time())
-        redirect_cmd = self.REDIRECT_OUTPUT_CMD_SUFFIX % output_log_path
-        dragen_cmd = "%s %s" % (dragen_cmd, redirect_cmd)
+    ########################################################################################
+    # save_dragen_usage - Print the resource usage of the Dragen run and save it with the
+    #   outputs
+    #
+    def save_dragen_usage(self):
+        self.dragen_usage = self.dragen_proc.get_usage_report()
+        if not self.dragen_usage:
+            return
+        printf("Dragen resource usage: wall=%.0fs user=%.0fs sys=%.0fs avg cores=%s peak RSS=%.1fGB"
+               % (self.dragen_usage['wall_seconds'], self.dragen_usage['user_cpu_seconds'],
+                  self.dragen_usage['system_cpu_seconds'], self.dragen_usage['avg_cpu_cores'],
+                  self.dragen_usage['peak_rss_kb'] / 1024.0 ** 2))
+        try:
+            with open(os.path.join(self.output_dir, self.DRAGEN_USAGE_FILE_NAME), 'w') as f:
+                json.dump(self.dragen_usage, f, indent=2)
+        except (IOError, OSError) as e:
+            printf("Warning: could not save Dragen resource usage (%s)" % str(e))
+        return
 
-        # Run the Dragen process
-        self.process_start_time = datetime.datetime.utcnow()
-        exit_code = exec_cmd(dragen_cmd)
+    ########################################################################################
+    # finish_job - Upload the outputs of a completed Dragen run, clean up and record the
+    #   exit code
+    #   release_inputs - Set False to keep shared staging cache references (queue mode
+    #                    releases them once the whole queue is done)
+    #
+    def finish_job(self, exit_code, release_inputs=True):
 
-        # Upload the results to S3 output bucket
-        self.upload_job_outputs()
+        # Upload the results to S3 output bucket. When terminated, upload the reusable
+        # results and the checkpoint first, in the time left
+        self.set_phase('upload')
+        if self.interrupted:
+            self.checkpoint_job()
+        else:
+            self.upload_job_outputs()
+            if self.checkpoint:
+                # Supersede the checkpoint of the interrupted run
+                self.save_checkpoint('complete', None)
+        self.set_phase('cleanup')
 
-        # Delete the output results directory, i.e. /staging/<uuid4>
+        # Discard the output results directory, i.e. /ephemeral/<uuid4>, and the spill
         # NOTE: Do not delete the reference directory enable re-use with another job
-        rm_out_path = self.output_dir
-        printf("Removing Output dir %s" % rm_out_path)
-        shutil.rmtree(rm_out_path, ignore_errors=True)
+        self.discard_job_dirs()
+        self.release_disk()
+
+        # Staged inputs are no longer in use by this job
+        if release_inputs:
+            self.release_staged_inputs()
 
         # Handle error code
         if exit_code:
-            self.copy_var_log_dragen_files()
             self.global_exit_code = exit_code
             if self.global_exit_code > 128 or self.global_exit_code < 0:
                 if self.global_exit_code > 128:
@@ -764,6 +1404,263 @@ class DragenJob(object):
                 printf("Job terminated due to signal %s" % signum)
 
         self.process_end_time = datetime.datetime.utcnow()
+        self.save_host_profile()
+
+        # Last, so the manifest covers every uploaded object and marks the upload complete
+        if not self.interrupted:
+            self.write_manifest(exit_code)
+        return
+
+    ########################################################################################
+    # write_manifest - Upload transfer.MANIFEST_FILE_NAME next to the job outputs, listing
+    #   every object the job uploaded (size, checksum, content type, upload time) with the
+    #   Dragen exit code, the FASTQ size and the job's transfers, which calibrate --plan
+    #
+    def write_manifest(self, exit_code):
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.output_s3_url or '')
+        if not s3_valid or not s3_bucket or not s3_key:
+            return
+        objects = [x for result in self.transfers if result.op == 'upload' for x in result.objects]
+        try:
+            self.run_transfer('upload_manifest', s3_bucket, s3_key, objects,
+                              args=self.job_args,
+                              exit_code=exit_code,
+                              status='succeeded' if not exit_code else 'failed',
+                              start_time=self.process_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+                              if self.process_start_time else None,
+                              end_time=self.process_end_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                              dragen_seconds=self.dragen_usage['wall_seconds'] if self.dragen_usage else None,
+                              fastq_bytes=self.fastq_bytes,
+                              transfers=[x.to_dict() for x in self.transfers],
+                              phase_seconds=self.get_phase_seconds(),
+                              reference=self.ref_s3_url,
+                              reference_reused=self.ref_reused,
+                              instance_type=get_instance_type())
+        except SystemExit:
+            printf('Warning: could not upload the output manifest')
+        return
+
+    ########################################################################################
+    # handle_interrupt - Interruption watcher callback: stop the running Dragen process so
+    #   that finish_job checkpoints the job in the time left. Called from the SIGTERM
+    #   handler or the notice polling thread, so only signals the process
+    #
+    def handle_interrupt(self, reason):
+        if not self.dragen_proc or not self.dragen_proc.pid or self.dragen_proc.poll() is not None:
+            return
+        printf("Termination requested (%s) - stopping Dragen to checkpoint the job" % reason)
+        self.interrupted = True
+        try:
+            os.killpg(self.dragen_proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+
+        def kill_dragen():
+            if self.dragen_proc.poll() is None:
+                try:
+                    os.killpg(self.dragen_proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        timer = threading.Timer(self.DRAGEN_STOP_GRACE_SECS, kill_dragen)
+        timer.daemon = True
+        timer.start()
+        return
+
+    ########################################################################################
+    # find_reusable_bam - Complete BAM in the output directory: indexed, and ending with the
+    #   BGZF EOF block. Returns its path or None
+    #
+    def find_reusable_bam(self):
+        if not self.output_dir:
+            return None
+        for path in sorted(glob.glob(os.path.join(self.output_dir, '*.bam'))):
+            if not os.path.isfile(path + '.bai') or os.path.getsize(path) < len(self.BGZF_EOF):
+                continue
+            with open(path, 'rb') as f:
+                f.seek(-len(self.BGZF_EOF), os.SEEK_END)
+                if f.read() == self.BGZF_EOF:
+                    return path
+        return None
+
+    ########################################################################################
+    # checkpoint_job - Upload the reusable result and the checkpoint record of a terminated
+    #   job, then as many of the other outputs as the remaining time allows, smallest first
+    #
+    def checkpoint_job(self):
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.output_s3_url or '')
+        if not s3_valid or not s3_bucket or not s3_key:
+            printf('Error: no S3 output location to checkpoint the job to')
+            return
+        prefix = s3_key.rstrip('/') + '/'
+        printf('Checkpointing the job to s3://%s/%s (%.0fs left)'
+               % (s3_bucket, prefix, DragenJob.watcher.remaining() if DragenJob.watcher else 0))
+
+        resume_url = self.resume_bam_url
+        bam_path = self.find_reusable_bam()
+        uploaded = []
+        if bam_path:
+            try:
+                for path in [bam_path, bam_path + '.bai']:
+                    self.run_transfer('upload', path, s3_bucket, prefix)
+                    uploaded.append(path)
+                resume_url = 's3://%s/%s%s' % (s3_bucket, prefix, os.path.basename(bam_path))
+            except SystemExit:
+                printf('Warning: could not upload %s - a retry starts from the FASTQs' % bam_path)
+        self.save_checkpoint('interrupted', resume_url)
+
+        if not self.output_dir or not os.path.isdir(self.output_dir):
+            return
+        files = [(path, st.st_size) for path, st in local_fs.scan_files(self.output_dir, include_hidden=True)
+                 if path not in uploaded]
+        for path, _ in sorted(files, key=lambda x: x[1]):
+            if DragenJob.watcher and DragenJob.watcher.remaining() < 1:
+                printf('Out of time - remaining outputs are not uploaded')
+                break
+            try:
+                self.run_transfer('upload', path, s3_bucket, prefix)
+            except SystemExit:
+                continue
+        return
+
+    ########################################################################################
+    # save_checkpoint - Upload the checkpoint record of the job next to its outputs
+    #   status     - 'interrupted' or 'complete'
+    #   resume_url - S3 URL of the BAM a retry may start from, or None
+    #
+    def save_checkpoint(self, status, resume_url):
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.output_s3_url or '')
+        if not s3_valid or not s3_bucket or not s3_key:
+            return
+        record = {
+            'status': status,
+            'reason': DragenJob.watcher.reason if DragenJob.watcher and status == 'interrupted' else None,
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'args': self.job_args,
+            'resume_bam': resume_url
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.DEFAULT_DATA_FOLDER, suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(record, f, indent=2)
+            self.run_transfer('upload', tmp_path, s3_bucket, s3_key.rstrip('/') + '/' + self.CHECKPOINT_FILE_NAME)
+        except SystemExit:
+            printf('Warning: could not upload the checkpoint record')
+        finally:
+            os.remove(tmp_path)
+        return
+
+    ########################################################################################
+    # resume_from_checkpoint - If an earlier run of the same job was terminated after
+    #   uploading a complete BAM, run the downstream stages from that BAM instead of
+    #   mapping the FASTQs again
+    #
+    def resume_from_checkpoint(self):
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.output_s3_url or '')
+        if not s3_valid or not s3_bucket or not s3_key:
+            return
+        try:
+            body = aws.s3_get_object_body(s3_bucket, s3_key.rstrip('/') + '/' + self.CHECKPOINT_FILE_NAME)
+            self.checkpoint = json.loads(body.decode('utf-8'))
+        except Exception:
+            # No checkpoint - a fresh job
+            return
+
+        if self.checkpoint.get('status') != 'interrupted' or self.checkpoint.get('args') != self.job_args:
+            return
+        bam_url = self.checkpoint.get('resume_bam')
+        if not bam_url or self.tumor_fastq_list_url:
+            printf('Earlier run was interrupted without a reusable result - starting from the inputs')
+            return
+        if not any(self.get_option_value(x) == 'true' for x in self.RESUMABLE_OPTS):
+            return
+
+        printf('Earlier run was interrupted (%s) - resuming from %s' % (self.checkpoint.get('reason'), bam_url))
+        args = []
+        idx = 0
+        while idx < len(self.job_args):
+            if self.job_args[idx] in self.FASTQ_INPUT_OPTS + self.MAP_ALIGN_OPTS + ['-b', '--bam-input']:
+                idx += 2
+                continue
+            args.append(self.job_args[idx])
+            idx += 1
+        args.extend(['-b', bam_url, '--enable-map-align', 'false', '--enable-map-align-output', 'false'])
+
+        self.orig_args = args
+        self.new_args = copy.copy(args)
+        for attr in self.INPUT_URL_ATTRS:
+            setattr(self, attr, None)
+        self.parse_download_args()
+        self.resume_bam_url = bam_url
+        return
+
+    ########################################################################################
+    # get_option_value - Value following the option in the job arguments, or None
+    #
+    def get_option_value(self, option):
+        opt_no = find_arg_in_list(self.job_args, option)
+        if opt_no < 0 or opt_no + 1 >= len(self.job_args):
+            return None
+        return self.job_args[opt_no + 1].lower()
+
+    ########################################################################################
+    # set_phase - Tag the host profile samples from now on with the given job phase. The
+    #   profiler is started with the first phase unless disabled by PROFILE_INTERVAL_ENV_VAR
+    #
+    def set_phase(self, phase):
+        self.phase_times.append((phase, time.time()))
+        if not self.profiler:
+            interval = float(os.environ.get(self.PROFILE_INTERVAL_ENV_VAR, host_profiler.DEFAULT_INTERVAL_SECS))
+            if interval <= 0:
+                return
+            self.profiler = host_profiler.HostProfiler(interval)
+            self.profiler.set_phase(phase)
+            self.profiler.start()
+            return
+        self.profiler.set_phase(phase)
+
+    ########################################################################################
+    # get_phase_seconds - Time spent in each phase so far: {phase: seconds}
+    #
+    def get_phase_seconds(self):
+        ends = [x[1] for x in self.phase_times[1:]] + [time.time()]
+        seconds = {}
+        for (phase, start), end in zip(self.phase_times, ends):
+            seconds[phase] = round(seconds.get(phase, 0) + end - start, 3)
+        return seconds
+
+    ########################################################################################
+    # save_host_profile - Stop the host profiler, print the per phase summary and upload
+    #   the time series and summary next to the job outputs
+    #
+    def save_host_profile(self):
+        if not self.profiler:
+            return
+        self.profiler.stop()
+        summary = self.profiler.get_summary()
+        for entry in summary['phases']:
+            printf("Host profile %s: %.0fs cpu=%.0f%% (peak %.0f%%) iowait=%.0f%% mem peak=%.1fGB "
+                   "disk r/w=%.0f/%.0fMB/s (util peak %.0f%%) net rx/tx=%.0f/%.0fMB/s"
+                   % (entry['phase'], entry['seconds'], entry['cpu_pct']['mean'], entry['cpu_pct']['peak'],
+                      entry['iowait_pct']['mean'], entry['mem_used_gb']['peak'],
+                      entry['disk_read_mbps']['mean'], entry['disk_write_mbps']['mean'],
+                      entry['disk_util_pct']['peak'], entry['net_rx_mbps']['mean'], entry['net_tx_mbps']['mean']))
+
+        if not self.output_s3_url:
+            return
+        s3_valid, s3_bucket, s3_key = get_s3_bucket_key(self.output_s3_url)
+        if not s3_valid or not s3_bucket or not s3_key:
+            return
+
+        # The outputs directory is already uploaded and discarded, so upload on its own
+        profile_dir = tempfile.mkdtemp(dir=self.DEFAULT_DATA_FOLDER)
+        try:
+            self.profiler.save(os.path.join(profile_dir, self.PROFILE_FILE_NAME),
+                               os.path.join(profile_dir, self.PROFILE_SUMMARY_FILE_NAME))
+            self.run_transfer('upload', profile_dir, s3_bucket, s3_key.rstrip('/') + '/')
+        except (Exception, SystemExit) as e:
+            printf("Warning: could not upload the host profile (%s)" % str(e))
+        finally:
+            shutil.rmtree(profile_dir, ignore_errors=True)
         return
 
     ########################################################################################
@@ -792,6 +1689,223 @@ class DragenJob(object):
         sys.exit(0)
 
 
+#########################################################################################
+# prefetch_node - Warm up a freshly booted node ahead of the first job: download the
+# given reference HT directories into the /ephemeral cache and program the FPGA. The
+# results are recorded in DragenJob.NODE_READY_FILE so later jobs skip both steps.
+#   ref_urls - list of s3://bucket/ref_prefix URLs. If empty, taken from the comma
+#              separated DragenJob.PREFETCH_REFS_ENV_VAR environment variable
+#
+def prefetch_node(ref_urls):
+    if not ref_urls:
+        ref_urls = [x.strip() for x in os.environ.get(DragenJob.PREFETCH_REFS_ENV_VAR, '').split(',')
+                    if x.strip()]
+
+    ready = load_node_ready(DragenJob.NODE_READY_FILE)
+
+    for ref_url in ref_urls:
+        printf('Prefetching reference %s' % ref_url)
+        dragen_job = DragenJob(['-r', ref_url])
+        dragen_job.download_ref_tables(all_artifacts=True)
+        ready['references'][ref_url] = dragen_job.ref_dir
+        save_node_ready(DragenJob.NODE_READY_FILE, ready)
+
+    # Program the FPGA of every slot of the host (slot 0 only on single FPGA hosts)
+    ready['fpga'] = True
+    for slot in fpga_slots.detect_slots():
+        dragen_job = DragenJob([])
+        if slot['slot']:
+            dragen_job.fpga_slot = slot
+        if not os.path.isfile(dragen_job.get_fpga_status_file()):
+            dragen_job.download_dragen_fpga()
+        ready['fpga'] = ready['fpga'] and os.path.isfile(dragen_job.get_fpga_status_file())
+    ready['time'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    save_node_ready(DragenJob.NODE_READY_FILE, ready)
+
+    printf('Node prefetch complete: %d reference(s), FPGA ready=%s' % (len(ref_urls), ready['fpga']))
+    sys.exit(0 if ready['fpga'] else 1)
+
+
+#########################################################################################
+# load_job_queue - Load the list of Dragen argument lists to run in queue mode from
+#   - a JSON file holding a list of jobs, or
+#   - a spool directory of JSON files, one job per file, run in file name order
+#   Each job is either a list of Dragen arguments or a dict with an 'args' list
+#
+def load_job_queue(queue_path):
+    if os.path.isdir(queue_path):
+        jobs = []
+        for name in sorted(os.listdir(queue_path)):
+            if name.endswith('.json'):
+                with open(os.path.join(queue_path, name), 'r') as f:
+                    jobs.append(json.load(f))
+    else:
+        with open(queue_path, 'r') as f:
+            jobs = json.load(f)
+
+    return [x['args'] if isinstance(x, dict) else x for x in jobs]
+
+
+#########################################################################################
+# plan_jobs - Print the dry-run plan of each job (see DragenJob.plan_job) and the totals,
+# then exit. Nothing is staged and the FPGA is not touched
+#
+def plan_jobs(job_args):
+    model = job_plan.load_model(printf)
+    printf('Throughput model from %d past jobs: download %.0f MB/s, upload %.0f MB/s, outputs %.2fx FASTQ size'
+           % (model['jobs'], model['download_mbps'], model['upload_mbps'], model['output_ratio']))
+
+    plans = [DragenJob(args).plan_job(model) for args in job_args]
+    staging_secs = sum(x['seconds'] for plan in plans for x in plan['phases'] if x['phase'] in ('reference', 'inputs'))
+    printf('Total for %d jobs: %.2f GB staged in %s, peak disk %.2f GB, cost $%.2f'
+           % (len(plans), sum(x['bytes'] for plan in plans for x in plan['phases']
+                              if x['phase'] in ('reference', 'inputs')) / disk_budget.GB,
+              job_plan.format_secs(staging_secs), max([x['disk_bytes'] for x in plans] or [0]) / disk_budget.GB,
+              sum(x['cost'] for x in plans)))
+
+    if os.path.isdir(DragenJob.DEFAULT_DATA_FOLDER):
+        free_bytes = disk_budget.DiskBudget(DragenJob.DEFAULT_DATA_FOLDER).get_free_bytes() - disk_budget.HEADROOM_BYTES
+        for idx, plan in enumerate(plans):
+            if plan['disk_bytes'] > free_bytes:
+                printf('Warning: job %d needs %.2f GB, only %.2f GB free on %s'
+                       % (idx + 1, plan['disk_bytes'] / disk_budget.GB, free_bytes / disk_budget.GB,
+                          DragenJob.DEFAULT_DATA_FOLDER))
+    sys.exit(0)
+
+
+#########################################################################################
+# run_queue - Run several samples back-to-back in one container, keeping the FPGA and
+# reference staged. While sample N runs on the FPGA, the inputs of sample N+1 are
+# downloaded and the outputs of sample N-1 are uploaded in background threads.
+#   slots - fpga_slots slot dicts to run concurrent lanes on (one Dragen process per FPGA,
+#           pinned to the CPUs of its NUMA node), or None for a single lane on slot 0
+#
+def run_queue(queue_path, slots=None):
+    job_args = load_job_queue(queue_path)
+    printf('Queue mode: %d jobs from %s' % (len(job_args), queue_path))
+    if not job_args:
+        sys.exit(0)
+
+    # Each job gets its own inputs dir since the next job stages while the current one runs
+    jobs = []
+    pending = queue.Queue()
+    for idx, args in enumerate(job_args):
+        dragen_job = DragenJob(args)
+        dragen_job.input_dir = '%sinputs/%03d/' % (DragenJob.DEFAULT_DATA_FOLDER, idx)
+        dragen_job.remove_input_dir = True
+        jobs.append(dragen_job)
+        pending.put(dragen_job)
+
+    # On termination stop the running jobs (to checkpoint them) and start no new ones
+    def stop_jobs(reason):
+        for dragen_job in jobs:
+            dragen_job.handle_interrupt(reason)
+    DragenJob.watcher = interruption.InterruptionWatcher(stop_jobs).start()
+
+    def next_job():
+        if DragenJob.watcher.interrupted:
+            return None
+        try:
+            return pending.get_nowait()
+        except queue.Empty:
+            return None
+
+    def stage_job(dragen_job):
+        try:
+            dragen_job.stage_inputs()
+            dragen_job.staged = True
+        except SystemExit as e:
+            printf('Error: staging failed with status %s' % e.code)
+            dragen_job.staged = False
+
+    def finish_job(dragen_job, exit_code):
+        try:
+            dragen_job.finish_job(exit_code, release_inputs=False)
+        except SystemExit as e:
+            dragen_job.global_exit_code = e.code or 1
+        # Delete the discarded directories while the next sample runs
+        cleanup.purge(DragenJob.DEFAULT_DATA_FOLDER)
+
+    def start_thread(target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.start()
+        return t
+
+    # One lane per FPGA slot, each taking the next job of the shared queue
+    def run_lane(slot):
+        lane = 'slot %d' % slot['slot'] if slot else 'lane'
+        dragen_job = next_job()
+        if not dragen_job:
+            return
+        dragen_job.fpga_slot = slot
+        stage_thread = start_thread(stage_job, dragen_job)
+        upload_thread = None
+        check_board = True
+        while dragen_job:
+            stage_thread.join()
+            following = next_job()
+            if following:
+                following.fpga_slot = slot
+                stage_thread = start_thread(stage_job, following)
+
+            if not dragen_job.staged:
+                dragen_job.global_exit_code = 1
+                dragen_job = following
+                continue
+
+            printf('Run Analysis job %d of %d (%s)' % (jobs.index(dragen_job) + 1, len(jobs), lane))
+            try:
+                exit_code = dragen_job.execute_dragen(check_board=check_board)
+            except SystemExit as e:
+                dragen_job.global_exit_code = e.code or 1
+                dragen_job = following
+                continue
+            # A clean exit leaves the board in a good state for the next sample
+            check_board = bool(exit_code)
+
+            # Upload one sample at a time, overlapping with the next sample's Dragen run
+            if upload_thread:
+                upload_thread.join()
+            upload_thread = start_thread(finish_job, dragen_job, exit_code)
+            dragen_job = following
+
+        if upload_thread:
+            upload_thread.join()
+
+    if not slots:
+        run_lane(None)
+    else:
+        # Claim the slots so other containers on the host do not use the same FPGAs
+        locks, claimed = [], []
+        for slot in slots:
+            lock = fpga_slots.claim_slot(slot['slot'])
+            if not lock:
+                printf('FPGA slot %d is in use by another job - skipping' % slot['slot'])
+                continue
+            locks.append(lock)
+            claimed.append(slot)
+            printf('Claimed FPGA slot %d (NUMA node %d, CPUs %s)'
+                   % (slot['slot'], slot['numa_node'], ','.join(str(x) for x in slot['cpus'])))
+        if not claimed:
+            printf('Error: no free FPGA slot on this host')
+            sys.exit(1)
+        lanes = [start_thread(run_lane, slot) for slot in claimed]
+        for t in lanes:
+            t.join()
+        for lock in locks:
+            lock.close()
+    jobs[0].release_staged_inputs()
+
+    # Jobs left in the queue on termination did not run
+    while not pending.empty():
+        pending.get_nowait().global_exit_code = 128 + signal.SIGTERM
+
+    failed = [idx + 1 for idx, x in enumerate(jobs) if x.global_exit_code]
+    printf('Queue complete: %d of %d jobs succeeded%s'
+           % (len(jobs) - len(failed), len(jobs), (' (failed: %s)' % failed) if failed else ''))
+    sys.exit(1 if failed else 0)
+
+
 #########################################################################################
 # main
 #
@@ -800,16 +1914,37 @@ def main():
     # Configure command line arguments
     dragen_args = sys.argv[1:]
 
+    # Node warm-up mode, i.e. 'dragen_qs.py --prefetch-only [s3://bucket/ref ...]'
+    if dragen_args and dragen_args[0] == '--prefetch-only':
+        prefetch_node(dragen_args[1:])
+
+    # Dry run, i.e. 'dragen_qs.py --plan <Dragen arguments>' or 'dragen_qs.py --plan --queue <jobs>'
+    if dragen_args and dragen_args[0] == '--plan':
+        if dragen_args[1:2] == ['--queue'] and len(dragen_args) == 3:
+            plan_jobs(load_job_queue(dragen_args[2]))
+        plan_jobs([dragen_args[1:]])
+
+    # Multi-sample mode, i.e. 'dragen_qs.py --queue <jobs.json or spool dir> [--slots N|all]'
+    if '--queue' in dragen_args:
+        slots = None
+        if dragen_args[2:3] == ['--slots'] and len(dragen_args) == 4:
+            slots = fpga_slots.detect_slots()
+            if dragen_args[3] != 'all':
+                slots = slots[:int(dragen_args[3])]
+            dragen_args = dragen_args[:2]
+        if len(dragen_args) != 2 or dragen_args[0] != '--queue':
+            printf('Error: usage is dragen_qs.py --queue <jobs.json or spool dir> [--slots N|all], '
+                   'with no Dragen arguments')
+            sys.exit(2)
+        run_queue(dragen_args[1], slots)
+
     # Debug print (remove later)
     printf("[DEBUG] Dragen input commands: %s" % ' '.join(dragen_args))
 
     dragen_job = DragenJob(dragen_args)
+    DragenJob.watcher = interruption.InterruptionWatcher(dragen_job.handle_interrupt).start()
 
-    printf('Downloading reference files')
-    dragen_job.download_ref_tables()
-
-    printf('Downloading misc inputs (csv, bed)')
-    dragen_job.download_inputs()
+    dragen_job.stage_inputs()
 
     printf('Run Analysis job')
     dragen_job.run()
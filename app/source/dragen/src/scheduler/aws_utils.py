@@ -17,12 +17,10 @@
 from __future__ import absolute_import
 from __future__ import division
 
-from builtins import map
-from builtins import str
-from past.utils import old_div
+import mimetypes
 import os
-from glob import glob
-from multiprocessing import Pool
+import threading
+import time
 
 import boto3
 from boto3.s3.transfer import S3Transfer
@@ -31,43 +29,191 @@ from botocore import UNSIGNED
 from botocore import exceptions
 from botocore.config import Config
 
+from . import local_fs
 from . import scheduler_utils as utils
 
 # CONSTANTS ....
 DOWNLOAD_THREAD_COUNT = 4
+STREAM_PART_SIZE = 16 * 1024 * 1024     # Parts buffered in memory by s3_upload_stream
+STREAM_CONCURRENCY = 4
+DELETE_BATCH_SIZE = 1000             # Keys per DeleteObjects request (S3 limit)
+DELETE_CONCURRENCY = 8
+UPLOAD_EXTRA_ARGS = {'ServerSideEncryption': 'AES256', 'ChecksumAlgorithm': 'SHA256'}
+
+# Bandwidth classes, highest priority first
+PRIORITY_INPUT = 'input'            # Critical path: inputs of the sample about to run
+PRIORITY_OUTPUT = 'output'          # Results of finished samples
+PRIORITY_PREFETCH = 'prefetch'      # Background cache warm-up
+PRIORITY_CLASSES = [PRIORITY_INPUT, PRIORITY_OUTPUT, PRIORITY_PREFETCH]
+BANDWIDTH_ENV_VAR = 'DRAGEN_BANDWIDTH_MBPS'             # Global cap in MB/s, unset or 0 for none
+CLASS_BANDWIDTH_ENV_VAR = 'DRAGEN_BANDWIDTH_%s_MBPS'    # Class cap, i.e. DRAGEN_BANDWIDTH_PREFETCH_MBPS
+BANDWIDTH_BURST_SECS = 0.5          # Bucket depth, in seconds of the rate
+BANDWIDTH_POLL_SECS = 0.05
+
+
+########################################################################################
+# TokenBucket - Rate limiter refilled at rate bytes/sec up to burst bytes. A consumer may
+#   overdraw the bucket and then sleeps off the debt
+#
+class TokenBucket(object):
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate * BANDWIDTH_BURST_SECS, 1)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    ########################################################################################
+    # take - Withdraw nbytes. Returns the seconds to sleep to pay back any debt
+    #
+    def take(self, nbytes):
+        self.refill()
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+########################################################################################
+# BandwidthScheduler - Shares the transfer bandwidth of the process between the priority
+#   classes. Each class may have its own cap. Under the global cap the input class may
+#   always overdraw the shared bucket, while the lower classes only take bytes the bucket
+#   has in store and nobody of a higher class is waiting for, so background work uses
+#   whatever the critical path leaves spare
+#   rates - {class: bytes/sec or None}, plus the global rate under key None
+#
+class BandwidthScheduler(object):
+
+    def __init__(self, rates):
+        self.lock = threading.Lock()
+        self.buckets = dict((k, TokenBucket(v)) for k, v in rates.items() if v)
+        self.waiting = dict((x, 0) for x in PRIORITY_CLASSES)
+
+    @property
+    def enabled(self):
+        return bool(self.buckets)
+
+    ########################################################################################
+    # consume - Account for nbytes transferred by the class, sleeping as long as needed to
+    #   keep within its cap and its share of the global cap
+    #
+    def consume(self, priority, nbytes):
+        if priority not in self.waiting:
+            priority = PRIORITY_INPUT
+        with self.lock:
+            wait = self.buckets[priority].take(nbytes) if priority in self.buckets else 0
+        if wait:
+            time.sleep(wait)
+
+        bucket = self.buckets.get(None)
+        if not bucket:
+            return
+        rank = PRIORITY_CLASSES.index(priority)
+        if not rank:
+            with self.lock:
+                wait = bucket.take(nbytes)
+            if wait:
+                time.sleep(wait)
+            return
+
+        with self.lock:
+            self.waiting[priority] += 1
+        try:
+            while True:
+                with self.lock:
+                    bucket.refill()
+                    higher_waiting = any(self.waiting[x] for x in PRIORITY_CLASSES[:rank])
+                    if not higher_waiting and bucket.tokens >= min(nbytes, bucket.burst):
+                        bucket.tokens -= nbytes
+                        break
+                time.sleep(BANDWIDTH_POLL_SECS)
+        finally:
+            with self.lock:
+                self.waiting[priority] -= 1
+
+
+bandwidth_scheduler = None
+bandwidth_lock = threading.Lock()
+
+
+########################################################################################
+# get_bandwidth_scheduler - The scheduler of the process, configured from the
+#   environment on first use (rates in MB/s)
+#
+def get_bandwidth_scheduler():
+    global bandwidth_scheduler
+    with bandwidth_lock:
+        if bandwidth_scheduler is None:
+            def get_rate(env_var):
+                mbps = float(os.environ.get(env_var) or 0)
+                return mbps * 1024 * 1024 if mbps > 0 else None
+
+            rates = dict((x, get_rate(CLASS_BANDWIDTH_ENV_VAR % x.upper())) for x in PRIORITY_CLASSES)
+            rates[None] = get_rate(BANDWIDTH_ENV_VAR)
+            bandwidth_scheduler = BandwidthScheduler(rates)
+    return bandwidth_scheduler
+
+
+########################################################################################
+# get_bandwidth_callback - boto3 transfer progress callback throttling the transfer to the
+#   bandwidth of its priority class, or None if no cap is configured
+#
+def get_bandwidth_callback(priority):
+    scheduler = get_bandwidth_scheduler()
+    if not scheduler.enabled:
+        return None
+    return lambda nbytes: scheduler.consume(priority, nbytes)
+
+
+########################################################################################
+# s3_create_client - Create an S3 client on its own boto3 session. boto3.client() goes
+#   through the shared default session, which is not thread safe; a client created here
+#   may be created in any thread and then shared by several threads
+def s3_create_client(region='us-east-1', nosign=False):
+    session = boto3.session.Session()
+    if nosign:
+        return session.client('s3', region, config=Config(signature_version=UNSIGNED))
+    return session.client('s3', region)
 
 
 ########################################################################################
 # s3_download_file - Download a file from given "req_info" dict. Before actually downloading
 #   the object see if it already exists locally
 # req_info = {"bucket": <str>, "obj_key":<str>, "tgt_path":<str>, "region":<str>}
+# config - optional boto3 TransferConfig, i.e. to give a large object more concurrency
+# client - optional S3 client to use, i.e. one shared by the threads of a pool
+# priority - bandwidth class of the transfer (PRIORITY_*)
+# make_dir - False if the caller already created the target directory
 # Return: Downloaded file size
-def s3_download_file(req_info, nosign=False):
+def s3_download_file(req_info, nosign=False, config=None, client=None, priority=PRIORITY_INPUT, make_dir=True):
     # If region is missing fill in default
     if not req_info['region']:
         req_info['region'] = 'us-east-1'
 
     # Configure the download
-    if nosign:
-        client = boto3.client('s3', req_info['region'], config=Config(signature_version=UNSIGNED))
-    else:
-        client = boto3.client('s3', req_info['region'])
+    if not client:
+        client = s3_create_client(req_info['region'], nosign)
 
     # Make sure the target directory exists
-    tgt_dir = req_info['tgt_path'].rsplit('/', 1)[0]  # get the directory part
-    utils.check_create_dir(tgt_dir)
+    if make_dir:
+        tgt_dir = req_info['tgt_path'].rsplit('/', 1)[0]  # get the directory part
+        utils.check_create_dir(tgt_dir)
 
     # Check if the object already exists locally and get the size on disk
     if os.path.exists(req_info['tgt_path']):
         loc_size = os.path.getsize(req_info['tgt_path'])
         # Check if the S3 object length matches the local file size
-        obj_info = s3_get_object_info(req_info['bucket'], req_info['obj_key'])
+        obj_info = client.head_object(Bucket=req_info['bucket'], Key=req_info['obj_key'])
         if obj_info['ContentLength'] == loc_size:
             return loc_size
 
-    # Perform the download
-    transfer = S3Transfer(client)
-    transfer.download_file(req_info['bucket'], req_info['obj_key'], req_info['tgt_path'])
+    # Perform the download. S3Transfer writes to a temp file renamed into place once complete
+    transfer = S3Transfer(client, config)
+    transfer.download_file(req_info['bucket'], req_info['obj_key'], req_info['tgt_path'],
+                           callback=get_bandwidth_callback(priority))
 
     # Once download is complete, get the file info to check the size
     return os.path.getsize(req_info['tgt_path'])
@@ -82,21 +228,13 @@ def s3_download_file(req_info, nosign=False):
 #   Return: Total number of bytes downloaded
 def s3_download_dir(bucket, src_dir, tgt_dir, region='us-east-1', nosign=False):
     # Get the list of objects specified within the "dir"
-    if nosign:
-        client = boto3.client('s3', region, config=Config(signature_version=UNSIGNED))
-    else:
-        client = boto3.client('s3', region)
-    response = client.list_objects(Bucket=bucket, Prefix=src_dir)
-
-    if not response['Contents']:
-        return 0
+    client = s3_create_client(region, nosign)
+    object_list = s3_list_objects(bucket, src_dir, region=region, nosign=nosign)
 
     # Filter out any results that are "dirs" by checking for ending '/'
-    object_list = [x for x in response['Contents'] if not x['Key'].endswith('/')]
-
-    # To avoid a race condition for parallel downloads, make sure each has a directory created
-    # - Create the full dir path of each object and make sure the dir exists
-    list([utils.check_create_dir(str(tgt_dir.rstrip('/') + '/' + x['Key']).rsplit('/', 1)[0]) for x in object_list])
+    object_list = [x for x in object_list if not x['Key'].endswith('/')]
+    if not object_list:
+        return 0
 
     # Convert the list of objects to a dict we can pass to the download function
     download_dict_list = [{
@@ -106,11 +244,17 @@ def s3_download_dir(bucket, src_dir, tgt_dir, region='us-east-1', nosign=False):
             'region': region
         } for x in object_list]
 
-    # Create a thread pools to handle the downloads faster
-    pool = Pool(DOWNLOAD_THREAD_COUNT)
+    # To avoid a race condition for parallel downloads, create every target directory up
+    # front - once per distinct directory, however many objects it holds
+    local_fs.make_parent_dirs(x['tgt_path'] for x in download_dict_list)
+
+    # Create a thread pool sharing one client to handle the downloads faster
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(DOWNLOAD_THREAD_COUNT)
 
-    # Use the multiple thread pools to divvy up the downloads
-    results = pool.map(s3_download_file, download_dict_list)
+    # Use the multiple threads to divvy up the downloads
+    results = pool.map(lambda x: s3_download_file(x, nosign=nosign, client=client, make_dir=False),
+                       download_dict_list)
 
     # Close the pool and wait for the work to finish
     pool.close()
@@ -120,6 +264,19 @@ def s3_download_dir(bucket, src_dir, tgt_dir, region='us-east-1', nosign=False):
     return sum(results)
 
 
+########################################################################################
+# s3_list_objects - List all objects below the given prefix, following continuation
+#   tokens so that prefixes with more than 1000 objects are listed completely
+#   Return: List of object info dicts ('Key', 'Size', 'LastModified', 'ETag', ...)
+def s3_list_objects(bucket, prefix, region='us-east-1', nosign=False):
+    client = s3_create_client(region, nosign)
+    paginator = client.get_paginator('list_objects_v2')
+    object_list = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        object_list.extend(page.get('Contents', []))
+    return object_list
+
+
 ########################################################################################
 # s3_get_object_info - Get information about an S3 object without downloading it
 #   Inputs:
@@ -127,7 +284,7 @@ def s3_download_dir(bucket, src_dir, tgt_dir, region='us-east-1', nosign=False):
 #       obj_path - The key for the object (aka the 'path')
 #   Return: Total number of bytes downloaded, or raise a Client Error exception
 def s3_get_object_info(bucket, obj_path):
-    client = boto3.client('s3')
+    client = s3_create_client()
     info = client.head_object(
         Bucket=bucket,
         Key=obj_path
@@ -135,49 +292,159 @@ def s3_get_object_info(bucket, obj_path):
     return info
 
 
+########################################################################################
+# s3_get_object_body - Read a (small) object into memory
+#   Inputs:
+#       bucket - object bucket
+#       obj_path - The key for the object (aka the 'path')
+#   Return: The object content as bytes, or raise a Client Error exception
+def s3_get_object_body(bucket, obj_path):
+    client = s3_create_client()
+    resp = client.get_object(Bucket=bucket, Key=obj_path)
+    return resp['Body'].read()
+
+
 ########################################################################################
 # s3_delete_object - Delete the specified object from S3 bucket
 #   Inputs:
 #       bucket - object bucket
 #       obj_path - The key for the object (aka the 'path')
-#   Return: Total number of bytes downloaded, or raise a Client Error exception
+#   Return: (number of objects deleted, list of (key, error message))
 def s3_delete_object(bucket, obj_path):
-    client = boto3.client('s3')
-    resp = client.delete_objects(
-        Bucket=bucket,
-        Delete={
-            'Objects': [
-                {'Key': obj_path}
-            ]
-        }
-    )
-    return resp
+    return s3_delete_objects(bucket, [obj_path])
+
+
+########################################################################################
+# s3_delete_objects - Delete the given keys with DeleteObjects requests of up to
+#   DELETE_BATCH_SIZE keys, concurrency batches in parallel
+#   Return: (number of objects deleted, list of (key, error message))
+def s3_delete_objects(bucket, keys, client=None, concurrency=DELETE_CONCURRENCY):
+    client = client or boto3.client('s3')
+    batches = [keys[idx:idx + DELETE_BATCH_SIZE] for idx in range(0, len(keys), DELETE_BATCH_SIZE)]
+    if len(batches) < 2:
+        results = [_s3_delete_batch(client, bucket, x) for x in batches]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(concurrency, len(batches)))
+        try:
+            results = pool.map(lambda x: _s3_delete_batch(client, bucket, x), batches)
+        finally:
+            pool.close()
+            pool.join()
+    return sum(x[0] for x in results), [e for x in results for e in x[1]]
+
+
+########################################################################################
+# s3_delete_prefix - Delete every object below the prefix. Each listing page (up to 1000
+#   keys) is deleted with one DeleteObjects request while the next page is listed, with
+#   up to concurrency requests in flight
+#   modified_before - Only delete objects last modified before this (aware) datetime
+#   dry_run         - List only, delete nothing
+#   Return: (number of objects, bytes, list of (key, error message))
+def s3_delete_prefix(bucket, prefix, modified_before=None, dry_run=False, concurrency=DELETE_CONCURRENCY):
+    client = s3_create_client(s3_get_bucket_region(bucket))
+    paginator = client.get_paginator('list_objects_v2')
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(concurrency)
+    pending = []
+    count = 0
+    tot_bytes = 0
+    try:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': DELETE_BATCH_SIZE}):
+            objects = [x for x in page.get('Contents', [])
+                       if modified_before is None or x['LastModified'] < modified_before]
+            count += len(objects)
+            tot_bytes += sum(x['Size'] for x in objects)
+            if objects and not dry_run:
+                pending.append(pool.apply_async(_s3_delete_batch, (client, bucket, [x['Key'] for x in objects])))
+        results = [x.get() for x in pending]
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = [e for x in results for e in x[1]]
+    return count - len(errors) if not dry_run else count, tot_bytes, errors
 
 
 ########################################################################################
 # s3_upload - Recursively upload source file(s) residing in the given input
 # location (abs_src_path) to the bucket and S3 base path (key) provided as input
-def s3_upload(abs_src_path, bucket, key):
+# priority - bandwidth class of the transfer (PRIORITY_*)
+# exclude - paths of files below a source directory not to upload
+# records - optional list to append the s3_object_record of every uploaded object to
+def s3_upload(abs_src_path, bucket, key, priority=PRIORITY_OUTPUT, exclude=None, records=None):
     # Configure the upload
     s3_client, transfer_client = _s3_initialize_client(bucket)
+    callback = get_bandwidth_callback(priority)
     if os.path.isdir(abs_src_path):
-        up_size = _s3_upload_files_recursively(abs_src_path, bucket, key, s3_client, transfer_client)
+        up_size = _s3_upload_files_recursively(abs_src_path, bucket, key, s3_client, transfer_client, callback,
+                                               exclude, records)
     elif os.path.isfile(abs_src_path):
-        up_size = _s3_upload_file(abs_src_path, bucket, key, s3_client, transfer_client)
+        up_size = _s3_upload_file(abs_src_path, bucket, key, s3_client, transfer_client, callback, records)
     else:
         raise ValueError(
             '{0} MUST be either a file or a directory'.format(abs_src_path))
     return up_size
 
 
+########################################################################################
+# s3_upload_stream - Upload the content of a readable stream (i.e. a compressing reader)
+#   to bucket/key as a multipart upload, without staging it on disk
+#   client - optional S3 client of the bucket region, i.e. shared by the threads of a pool
+#   records - optional list to append the s3_object_record of the object to
+#   Return: Uploaded object size
+def s3_upload_stream(stream, bucket, key, client=None, priority=PRIORITY_OUTPUT, records=None):
+    if not client:
+        client = s3_create_client(s3_get_bucket_region(bucket))
+    config = TransferConfig(multipart_chunksize=STREAM_PART_SIZE, max_concurrency=STREAM_CONCURRENCY)
+    extra_args = dict(UPLOAD_EXTRA_ARGS, ContentType=get_content_type(key))
+    start_time = time.time()
+    client.upload_fileobj(stream, bucket, key, ExtraArgs=extra_args, Callback=get_bandwidth_callback(priority),
+                          Config=config)
+    seconds = time.time() - start_time
+    response = client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    if records is not None:
+        records.append(s3_object_record(key, response, seconds))
+    return response['ContentLength']
+
+
+########################################################################################
+# get_content_type - Content type to store an object under, from its name
+def get_content_type(name):
+    if name.endswith('.zst'):
+        return 'application/zstd'
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+########################################################################################
+# s3_object_record - Description of an uploaded object from its head_object response
+#   (requested with ChecksumMode='ENABLED'), i.e. for a job output manifest. The SHA-256
+#   checksum of a multipart upload is a checksum of the part checksums ('<b64>-<parts>')
+def s3_object_record(key, head, seconds):
+    return {
+        'key': key,
+        'size': head['ContentLength'],
+        'etag': head.get('ETag', '').strip('"'),
+        'checksum_sha256': head.get('ChecksumSHA256'),
+        'content_type': head.get('ContentType'),
+        'upload_seconds': round(seconds, 3)
+    }
+
+
+########################################################################################
+# s3_get_bucket_region - Region of the bucket
+def s3_get_bucket_region(bucket):
+    return _s3_get_bucket_location(bucket)
+
+
 ########################################################################################
 # ############################# LOCAL FUNCTIONS ########################################
 
-def _s3_upload_files_recursively(dir_path, bucket, obj_key, s3_client, transfer_client):
-    filenames = [fpath for dirpath in os.walk(dir_path) for fpath in
-                 glob(os.path.join(dirpath[0], '*'))]
-    # upload a finite number of files for safety
-    filenames = filenames[:100]
+def _s3_upload_files_recursively(dir_path, bucket, obj_key, s3_client, transfer_client, callback=None,
+                                 exclude=None, records=None):
+    # One scandir pass: regular, non hidden files of the whole tree
+    filenames = [path for path, _ in local_fs.scan_files(dir_path)]
     tot_bytes = 0
 
     # make sure there is a trailing '/' in obj_key to indicate it is 'root' and not actual keyname
@@ -185,30 +452,48 @@ def _s3_upload_files_recursively(dir_path, bucket, obj_key, s3_client, transfer_
         obj_key += '/'
 
     for filename in filenames:
-        if os.path.isfile(filename):
-            size = _s3_upload_file(filename, bucket, obj_key, s3_client, transfer_client)
-            if size:
-                tot_bytes += size
+        if exclude and filename in exclude:
+            continue
+        size = _s3_upload_file(filename, bucket, obj_key, s3_client, transfer_client, callback, records)
+        if size:
+            tot_bytes += size
     return tot_bytes
 
 
-def _s3_upload_file(file_path, bucket, obj_key, s3_client, transfer_client):
+def _s3_upload_file(file_path, bucket, obj_key, s3_client, transfer_client, callback=None, records=None):
     # Check if the key is a 'root' instead of full key name
     if obj_key.endswith('/'):
         name_only = file_path.rsplit('/', 1)[1]  # strip out the leading directory path
         obj_key = obj_key + name_only
+    start_time = time.time()
     transfer_client.upload_file(
         file_path,
         bucket,
         obj_key,
-        extra_args={'ServerSideEncryption': 'AES256'}
+        callback=callback,
+        extra_args=dict(UPLOAD_EXTRA_ARGS, ContentType=get_content_type(file_path))
     )
+    seconds = time.time() - start_time
 
     # Once Upload is complete, get the object info to check the size
-    response = s3_client.head_object(Bucket=bucket, Key=obj_key)
+    response = s3_client.head_object(Bucket=bucket, Key=obj_key, ChecksumMode='ENABLED')
+    if response and records is not None:
+        records.append(s3_object_record(obj_key, response, seconds))
     return response['ContentLength'] if response else None
 
 
+def _s3_delete_batch(client, bucket, keys):
+    resp = client.delete_objects(
+        Bucket=bucket,
+        Delete={
+            'Objects': [{'Key': x} for x in keys],
+            'Quiet': True
+        }
+    )
+    errors = [(x['Key'], '%s: %s' % (x.get('Code'), x.get('Message'))) for x in resp.get('Errors', [])]
+    return len(keys) - len(errors), errors
+
+
 def _s3_initialize_client(s3_bucket):
     client = boto3.client('s3', region_name=_s3_get_bucket_location(s3_bucket))
     config = boto3.s3.transfer.TransferConfig(
@@ -0,0 +1,267 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Fast cleanup of job directories on the shared /ephemeral volume. A directory that is
+# no longer needed is renamed into a trash directory on the same volume (instant), and
+# the trash is deleted later by a thread pool, either in the background of a running
+# job or by a detached process once the job has exited.
+#
+# Each job holds a flock on a lock file per output/spill directory it owns, so that the
+# uuid4 directories left behind by crashed jobs can be told apart from those of jobs
+# still running on the host, and reclaimed.
+#
+# Only depends on the standard library, so it can be run as a script:
+#   python3 cleanup.py <root>      - reclaim stale directories and empty the trash
+#
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+# CONSTANTS ....
+CLEANUP_DIR_NAME = '.cleanup'
+TRASH_DIR_NAME = 'trash'
+LOCKS_DIR_NAME = 'locks'
+SPILL_DIR_NAME = 'spill'
+PURGE_LOCK_FILE_NAME = '.purge.lock'
+DELETE_THREAD_COUNT = 16
+UNLOCKED_STALE_SECS = 24 * 3600     # Age after which a directory without a lock file is stale
+UUID4_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}$')
+
+
+########################################################################################
+# Paths of the cleanup bookkeeping below the volume root
+#
+def get_trash_dir(root):
+    return os.path.join(root, CLEANUP_DIR_NAME, TRASH_DIR_NAME)
+
+
+def get_lock_path(root, path):
+    return os.path.join(root, CLEANUP_DIR_NAME, LOCKS_DIR_NAME, os.path.basename(path.rstrip('/')) + '.lock')
+
+
+def get_spill_root(root):
+    return os.path.join(root, SPILL_DIR_NAME)
+
+
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+########################################################################################
+# claim_dir - Create the directory (if needed) and take the lock marking it as owned by
+#   a running job. The lock is held as long as the returned file object is open
+#
+def claim_dir(root, path):
+    make_dirs(path)
+    lock_path = get_lock_path(root, path)
+    make_dirs(os.path.dirname(lock_path))
+    fd = open(lock_path, 'a')
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return fd
+
+
+########################################################################################
+# unclaim_dir - Release the ownership lock taken by claim_dir
+#
+def unclaim_dir(root, path, fd):
+    try:
+        os.remove(get_lock_path(root, path))
+    except OSError:
+        pass
+    fd.close()
+
+
+########################################################################################
+# is_dir_in_use - True if a running job holds the lock of the directory. Directories
+#   without a lock file (i.e. created by older versions) count as in use until they are
+#   UNLOCKED_STALE_SECS old
+#
+def is_dir_in_use(root, path):
+    lock_path = get_lock_path(root, path)
+    if not os.path.exists(lock_path):
+        try:
+            return time.time() - os.path.getmtime(path) < UNLOCKED_STALE_SECS
+        except OSError:
+            return False
+    try:
+        with open(lock_path, 'a') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return True
+    return False
+
+
+########################################################################################
+# discard - Move the directory into the trash. Returns the trash path, or None if the
+#   path does not exist
+#
+def discard(root, path):
+    if not path or not os.path.exists(path):
+        return None
+    trash_dir = get_trash_dir(root)
+    make_dirs(trash_dir)
+    trash_path = os.path.join(trash_dir, '%s.%s' % (os.path.basename(path.rstrip('/')), uuid.uuid4().hex[:8]))
+    try:
+        os.rename(path, trash_path)
+    except OSError:
+        # Not on the same filesystem - delete in place
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    return trash_path
+
+
+########################################################################################
+# find_stale_dirs - uuid4 named output dirs in root and spill dirs below root/spill/
+#   that no running job owns
+#
+def find_stale_dirs(root):
+    stale = []
+    for parent in (root, get_spill_root(root)):
+        try:
+            names = os.listdir(parent)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(parent, name)
+            if UUID4_RE.match(name) and os.path.isdir(path) and not is_dir_in_use(root, path):
+                stale.append(path)
+    return stale
+
+
+########################################################################################
+# reclaim_stale - Move stale directories of crashed jobs into the trash. Returns the list
+#   of directories reclaimed
+#
+def reclaim_stale(root):
+    stale = find_stale_dirs(root)
+    for path in stale:
+        discard(root, path)
+        try:
+            os.remove(get_lock_path(root, path))
+        except OSError:
+            pass
+    return stale
+
+
+########################################################################################
+# delete_tree - Delete a directory tree, unlinking its files with the given thread pool.
+#   Returns number of files deleted
+#
+def delete_tree(path, pool):
+    if not os.path.isdir(path) or os.path.islink(path):
+        unlink_quiet(path)
+        return 1
+
+    dirs = []
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirs.append(dirpath)
+        files.extend(os.path.join(dirpath, x) for x in filenames)
+        # Symlinks to directories are removed as files, never followed
+        files.extend(os.path.join(dirpath, x) for x in dirnames if os.path.islink(os.path.join(dirpath, x)))
+
+    for _ in pool.imap_unordered(unlink_quiet, files, chunksize=64):
+        pass
+    for dirpath in reversed(dirs):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+    return len(files)
+
+
+def unlink_quiet(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+########################################################################################
+# purge - Delete everything in the trash. Only one purge runs at a time on a host; if
+#   another one holds the purge lock this returns at once, or with wait=True waits for it
+#   to finish and then purges whatever is left. Returns number of files deleted
+#
+def purge(root, thread_count=DELETE_THREAD_COUNT, wait=False):
+    trash_dir = get_trash_dir(root)
+    make_dirs(trash_dir)
+    lock_fd = open(os.path.join(trash_dir, PURGE_LOCK_FILE_NAME), 'a')
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock_fd.close()
+        return 0
+
+    from multiprocessing.pool import ThreadPool
+    count = 0
+    pool = ThreadPool(thread_count)
+    try:
+        # Keep going until the trash is empty, picking up entries discarded meanwhile. Each
+        # entry is tried once, so anything that can not be deleted does not spin forever
+        attempted = set()
+        while True:
+            entries = [x for x in os.listdir(trash_dir) if x != PURGE_LOCK_FILE_NAME and x not in attempted]
+            if not entries:
+                break
+            for name in entries:
+                attempted.add(name)
+                count += delete_tree(os.path.join(trash_dir, name), pool)
+    finally:
+        pool.close()
+        pool.join()
+        lock_fd.close()
+    return count
+
+
+########################################################################################
+# purge_in_background - Purge the trash in a background thread. Returns the thread
+#
+def purge_in_background(root, thread_count=DELETE_THREAD_COUNT):
+    t = threading.Thread(target=purge, args=(root, thread_count), name='cleanup-purge')
+    t.daemon = True
+    t.start()
+    return t
+
+
+########################################################################################
+# spawn_purge - Purge the trash (and reclaim stale directories) in a detached process
+#   that outlives the caller. If the container is torn down before it is done, the next
+#   job on the host finishes the purge. Returns the Popen object
+#
+def spawn_purge(root):
+    with open(os.devnull, 'wb') as devnull:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), root],
+                                stdin=devnull, stdout=devnull, stderr=devnull,
+                                preexec_fn=os.setsid, close_fds=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: cleanup.py <root>')
+        sys.exit(1)
+    reclaim_stale(sys.argv[1])
+    purge(sys.argv[1], wait=True)
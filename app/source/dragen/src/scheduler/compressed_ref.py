@@ -0,0 +1,308 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Support for references stored compressed at rest in S3, either as a single zstd
+# compressed tar archive (<ref>.tar.zst) or as per-file zstd objects (<file>.zst).
+# Objects are fetched with parallel byte-range GETs and decompressed as a stream, so the
+# download, the decompression and the writes to local disk all overlap. Outputs may be
+# uploaded the same way in reverse: compressed with multi-threaded zstd straight into a
+# multipart upload, without a compressed copy on disk.
+#
+
+from __future__ import division
+
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from . import aws_utils as aws
+from . import local_fs
+from . import scheduler_utils as utils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None    # Fall back to the zstd command line tool
+
+# CONSTANTS ....
+ZSTD_SUFFIX = '.zst'
+ARCHIVE_SUFFIXES = ['.tar.zst', '.tzst']
+RANGE_PART_SIZE = 32 * 1024 * 1024      # Size of each ranged GET
+RANGE_CONCURRENCY = 8                   # Number of ranged GETs kept in flight per object
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+ZSTD_LEVEL = 3                          # Fast level, compresses text outputs ~5-10x
+DIR_THREAD_COUNT = 4                    # Objects of a prefix transferred at once
+
+
+########################################################################################
+# is_archive_key / is_zstd_key - Check for the compressed object naming conventions
+#
+def is_archive_key(key):
+    return any(key.endswith(x) for x in ARCHIVE_SUFFIXES)
+
+
+def is_zstd_key(key):
+    return key.endswith(ZSTD_SUFFIX)
+
+
+########################################################################################
+# strip_compressed_suffix - Name of the object once decompressed/extracted
+#
+def strip_compressed_suffix(key):
+    for suffix in ARCHIVE_SUFFIXES + [ZSTD_SUFFIX]:
+        if key.endswith(suffix):
+            return key[:-len(suffix)]
+    return key
+
+
+########################################################################################
+# ParallelRangeReader - Read-only file-like object over an S3 object. Keeps several
+# ranged GETs in flight and hands the parts back strictly in order
+#
+class ParallelRangeReader(object):
+
+    def __init__(self, bucket, key, region='us-east-1', nosign=False,
+                 part_size=RANGE_PART_SIZE, concurrency=RANGE_CONCURRENCY, client=None):
+        self.client = client or aws.s3_create_client(region, nosign)
+        self.bucket = bucket
+        self.key = key
+        self.size = self.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.pool = ThreadPool(concurrency)
+        self.parts = deque()
+        self.next_offset = 0
+        self.buf = b''
+        self.buf_pos = 0
+        self.fill()
+
+    def fill(self):
+        while len(self.parts) < self.concurrency and self.next_offset < self.size:
+            start = self.next_offset
+            stop = min(self.size, start + self.part_size) - 1
+            self.parts.append(self.pool.apply_async(self.get_range, (start, stop)))
+            self.next_offset = stop + 1
+
+    def get_range(self, start, stop):
+        resp = self.client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=%d-%d' % (start, stop))
+        return resp['Body'].read()
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            if self.buf_pos >= len(self.buf):
+                if not self.parts:
+                    break
+                self.buf = self.parts.popleft().get()
+                self.buf_pos = 0
+                self.fill()
+            if size < 0:
+                take = len(self.buf) - self.buf_pos
+            else:
+                take = min(remaining, len(self.buf) - self.buf_pos)
+                remaining -= take
+            chunks.append(self.buf[self.buf_pos:self.buf_pos + take])
+            self.buf_pos += take
+        return b''.join(chunks)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+########################################################################################
+# ZstdCliReader - Decompressed stream produced by piping a reader through 'zstd -dc'.
+# Used only when the zstandard module is not installed
+#
+class ZstdCliReader(object):
+
+    def __init__(self, reader):
+        self.proc = subprocess.Popen(['zstd', '-dcq'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.pump_error = None
+        self.pump = threading.Thread(target=self.pump_input, args=(reader,))
+        self.pump.daemon = True
+        self.pump.start()
+
+    def pump_input(self, reader):
+        try:
+            while True:
+                chunk = reader.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.proc.stdin.write(chunk)
+        except Exception as e:
+            self.pump_error = e
+        finally:
+            self.proc.stdin.close()
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.pump.join()
+        self.proc.stdout.close()
+        exit_code = self.proc.wait()
+        if self.pump_error:
+            raise self.pump_error
+        if exit_code:
+            raise IOError('zstd decompression failed with exit code %d' % exit_code)
+
+
+########################################################################################
+# ZstdCliCompressReader - Compressed stream of a file produced by 'zstd -c'. Used only
+# when the zstandard module is not installed
+#
+class ZstdCliCompressReader(object):
+
+    def __init__(self, path, level=ZSTD_LEVEL, threads=0):
+        self.proc = subprocess.Popen(['zstd', '-cq', '-%d' % level, '-T%d' % threads, path], stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and self.proc.wait():
+            raise IOError('zstd compression failed with exit code %d' % self.proc.returncode)
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+########################################################################################
+# open_compressed - Readable zstd compressed stream of a local file
+#   threads - Compression worker threads, 0 for one per core
+#
+def open_compressed(path, level=ZSTD_LEVEL, threads=0):
+    if zstandard:
+        cctx = zstandard.ZstdCompressor(level=level, threads=threads or -1)
+        return cctx.stream_reader(open(path, 'rb'), size=os.path.getsize(path), read_size=STREAM_CHUNK_SIZE,
+                                  closefd=True)
+    return ZstdCliCompressReader(path, level=level, threads=threads)
+
+
+########################################################################################
+# s3_upload_compress - Compress the local file on the fly into bucket/key (a .zst object)
+#   client - optional S3 client of the bucket region, i.e. shared by the threads of a pool
+#   Return: Size of the uploaded (compressed) object
+#
+def s3_upload_compress(path, bucket, key, threads=0, client=None, priority=aws.PRIORITY_OUTPUT, records=None):
+    stream = open_compressed(path, threads=threads)
+    try:
+        return aws.s3_upload_stream(stream, bucket, key, client=client, priority=priority, records=records)
+    finally:
+        stream.close()
+
+
+########################################################################################
+# open_decompressed - Wrap a compressed reader in a streaming zstd decompressor
+#
+def open_decompressed(reader):
+    if zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(reader, read_size=STREAM_CHUNK_SIZE)
+    return ZstdCliReader(reader)
+
+
+########################################################################################
+# s3_download_decompress - Download bucket/key (a .zst object) and decompress it on the
+#   fly to tgt_path. The data is written to a temp file and renamed into place
+#   client   - optional S3 client, i.e. one shared by the threads of a pool
+#   make_dir - False if the caller already created the target directory
+#   Return: Number of decompressed bytes written
+#
+def s3_download_decompress(bucket, key, tgt_path, region='us-east-1', nosign=False, client=None, make_dir=True):
+    if make_dir:
+        utils.check_create_dir(os.path.dirname(tgt_path))
+    reader = ParallelRangeReader(bucket, key, region=region, nosign=nosign, client=client)
+    stream = open_decompressed(reader)
+    try:
+        with local_fs.atomic_path(tgt_path) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, STREAM_CHUNK_SIZE)
+            stream.close()
+    finally:
+        reader.close()
+    return os.path.getsize(tgt_path)
+
+
+########################################################################################
+# s3_download_dir_decompress - Download every object below the prefix to tgt_dir + key
+#   (the layout of aws_utils.s3_download_dir), decompressing .zst objects on the fly to
+#   the name without the suffix. Objects already present locally are skipped
+#   Return: Total number of bytes written
+#
+def s3_download_dir_decompress(bucket, prefix, tgt_dir, region='us-east-1', nosign=False):
+    client = aws.s3_create_client(region, nosign)
+    objects = [x for x in aws.s3_list_objects(bucket, prefix, region=region, nosign=nosign)
+               if not x['Key'].endswith('/')]
+
+    def download(obj):
+        tgt_path = tgt_dir.rstrip('/') + '/' + strip_compressed_suffix(obj['Key'])
+        if is_zstd_key(obj['Key']):
+            if os.path.isfile(tgt_path):
+                return os.path.getsize(tgt_path)
+            return s3_download_decompress(bucket, obj['Key'], tgt_path, region=region, nosign=nosign,
+                                          client=client, make_dir=False)
+        req = {'bucket': bucket, 'obj_key': obj['Key'], 'tgt_path': tgt_path, 'region': region}
+        return aws.s3_download_file(req, nosign=nosign, client=client, make_dir=False)
+
+    local_fs.make_parent_dirs(tgt_dir.rstrip('/') + '/' + x['Key'] for x in objects)
+
+    pool = ThreadPool(DIR_THREAD_COUNT)
+    try:
+        return sum(pool.map(download, objects))
+    finally:
+        pool.close()
+        pool.join()
+
+
+########################################################################################
+# s3_download_extract - Download bucket/key (a .tar.zst archive) and extract it on the
+#   fly below tgt_dir, without ever storing the archive itself
+#   Return: Total number of bytes extracted
+#
+def s3_download_extract(bucket, key, tgt_dir, region='us-east-1', nosign=False):
+    utils.check_create_dir(tgt_dir)
+    reader = ParallelRangeReader(bucket, key, region=region, nosign=nosign)
+    stream = open_decompressed(reader)
+    tot_bytes = 0
+    try:
+        tar = tarfile.open(fileobj=stream, mode='r|')
+        for member in tar:
+            # Refuse absolute paths and parent references in the archive
+            name = os.path.normpath(member.name)
+            if name.startswith('/') or name.startswith('..') or not (member.isfile() or member.isdir()):
+                continue
+            if hasattr(tarfile, 'data_filter'):
+                tar.extract(member, tgt_dir, filter='data')
+            else:
+                tar.extract(member, tgt_dir)
+            tot_bytes += member.size if member.isfile() else 0
+        tar.close()
+        stream.close()
+    finally:
+        reader.close()
+    return tot_bytes
@@ -0,0 +1,245 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Disk budget manager for the shared /ephemeral volume. References, inputs, job outputs
+# and Dragen spill all live on the same NVMe volume, shared by every job container on
+# the host. Jobs reserve the space they expect to need before staging anything; the
+# reservations are kept in a ledger file on the volume itself (guarded by flock) so all
+# containers see them. Since statvfs free space already drops as a job writes its data,
+# only the part of each reservation not yet written to the job's directories is held
+# back from other jobs. When a reservation does not fit, cold cache entries are evicted,
+# and if that is not enough the request waits for other jobs to release space and is
+# finally refused with a DiskBudgetError.
+#
+
+from __future__ import division
+
+import fcntl
+import json
+import os
+import shutil
+import time
+import uuid
+
+from . import local_fs
+from . import stage_daemon as stage
+
+# CONSTANTS ....
+LEDGER_FILE_NAME = '.disk_budget.json'
+LOCK_FILE_NAME = '.disk_budget.lock'
+HEADROOM_BYTES = 10 * 1024 ** 3             # Never plan to fill the volume beyond this
+RESERVATION_TTL_SECS = 48 * 3600            # Reservations of crashed jobs expire after this
+WAIT_POLL_SECS = 30
+GB = 1024 ** 3
+
+
+########################################################################################
+# DiskBudgetError - Raised when a reservation can not be satisfied
+#
+class DiskBudgetError(Exception):
+    pass
+
+
+########################################################################################
+# get_tree_size - Size in bytes of a file or all files below a directory
+#
+def get_tree_size(path):
+    return local_fs.tree_size(path)
+
+
+########################################################################################
+# is_same_or_nested - True if the two paths are the same, or one is below the other
+#
+def is_same_or_nested(path, other):
+    path = path.rstrip('/') + '/'
+    other = other.rstrip('/') + '/'
+    return path.startswith(other) or other.startswith(path)
+
+
+########################################################################################
+# DiskBudget - Host-wide space accounting for one volume
+#
+class DiskBudget(object):
+
+    def __init__(self, root, headroom=HEADROOM_BYTES):
+        self.root = root.rstrip('/') + '/'
+        self.ledger_path = self.root + LEDGER_FILE_NAME
+        self.lock_path = self.root + LOCK_FILE_NAME
+        self.headroom = headroom
+
+    ########################################################################################
+    # Ledger access - every read-modify-write happens with the flock held
+    #
+    def lock(self):
+        fd = open(self.lock_path, 'a')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def load_ledger(self):
+        ledger = {'reservations': {}, 'cache': {}}
+        try:
+            with open(self.ledger_path, 'r') as f:
+                ledger.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            pass
+        # Drop reservations of jobs that died without releasing them
+        now = time.time()
+        ledger['reservations'] = dict((k, v) for k, v in ledger['reservations'].items()
+                                      if now - v['time'] < RESERVATION_TTL_SECS)
+        return ledger
+
+    def save_ledger(self, ledger):
+        tmp_path = '%s.%d.tmp' % (self.ledger_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(ledger, f, indent=2)
+        os.rename(tmp_path, self.ledger_path)
+
+    ########################################################################################
+    # get_free_bytes - Free space on the volume as reported by the filesystem
+    #
+    def get_free_bytes(self):
+        st = os.statvfs(self.root)
+        return st.f_bavail * st.f_frsize
+
+    ########################################################################################
+    # get_outstanding - Part of a reservation not written yet: the reserved bytes minus the
+    #   growth of its directories since they were added to the reservation
+    #
+    def get_outstanding(self, reservation):
+        written = sum(get_tree_size(path) - base for path, base in reservation['paths'].items())
+        return max(0, reservation['bytes'] - written)
+
+    ########################################################################################
+    # get_available - Space that can still be promised: free space minus the headroom and
+    #   the outstanding part of every reservation
+    #
+    def get_available(self, ledger):
+        reserved = sum(self.get_outstanding(x) for x in ledger['reservations'].values())
+        return self.get_free_bytes() - self.headroom - reserved
+
+    ########################################################################################
+    # register_cache_entry - Record a reusable directory (i.e. a staged reference) that may
+    #   be evicted when no reservation is using it
+    #
+    def register_cache_entry(self, path, nbytes=None):
+        fd = self.lock()
+        try:
+            ledger = self.load_ledger()
+            ledger['cache'][path] = {
+                'bytes': get_tree_size(path) if nbytes is None else nbytes,
+                'last_used': time.time()
+            }
+            self.save_ledger(ledger)
+        finally:
+            fd.close()
+
+    ########################################################################################
+    # evict - Free at least nbytes by removing cold cache entries, least recently used
+    #   first. Entries that are, contain or lie below any reservation's 'paths' are in
+    #   use and never evicted. Caller must hold the lock. Returns number of bytes freed
+    #
+    def evict(self, ledger, nbytes):
+        freed = 0
+
+        # Shared staging daemon cache first - it tracks its own references
+        if stage.get_socket_path():
+            try:
+                reply = stage.stage_request({'op': 'evict_lru', 'bytes': nbytes})
+                freed += reply.get('freed', 0)
+            except (IOError, OSError):
+                pass
+
+        in_use = set(p for x in ledger['reservations'].values() for p in x.get('paths', []))
+        for path, entry in sorted(ledger['cache'].items(), key=lambda x: x[1]['last_used']):
+            if freed >= nbytes:
+                break
+            if any(is_same_or_nested(path, x) for x in in_use):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            del ledger['cache'][path]
+            freed += entry['bytes']
+        return freed
+
+    ########################################################################################
+    # reserve - Reserve nbytes for the calling job
+    #   label     - Description used in messages, i.e. 'reference + inputs'
+    #   paths     - Directories the job writes to, used to measure how much of the
+    #               reservation is used. Cache entries among them are protected from
+    #               eviction while reserved
+    #   wait_secs - How long to wait for other jobs to release space before giving up
+    #   Returns the reservation id, or raises DiskBudgetError
+    #
+    def reserve(self, nbytes, label, paths=None, wait_secs=0):
+        deadline = time.time() + wait_secs
+        while True:
+            fd = self.lock()
+            try:
+                ledger = self.load_ledger()
+                available = self.get_available(ledger)
+                if available < nbytes:
+                    self.evict(ledger, nbytes - available)
+                    available = self.get_available(ledger)
+
+                if available >= nbytes:
+                    rid = str(uuid.uuid4())
+                    ledger['reservations'][rid] = {
+                        'bytes': nbytes,
+                        'label': label,
+                        'owner': stage.get_owner_id(),
+                        'paths': dict((x, get_tree_size(x)) for x in paths or []),
+                        'time': time.time()
+                    }
+                    for path in paths or []:
+                        if path in ledger['cache']:
+                            ledger['cache'][path]['last_used'] = time.time()
+                    self.save_ledger(ledger)
+                    return rid
+                self.save_ledger(ledger)
+            finally:
+                fd.close()
+
+            if time.time() >= deadline:
+                raise DiskBudgetError(
+                    'Not enough space on %s for %s: need %.1f GB, %.1f GB available '
+                    '(%.1f GB free, %.1f GB reserved by %d other job(s), %.1f GB headroom)'
+                    % (self.root, label, nbytes / GB, max(0, available) / GB, self.get_free_bytes() / GB,
+                       sum(self.get_outstanding(x) for x in ledger['reservations'].values()) / GB,
+                       len(ledger['reservations']), self.headroom / GB))
+            time.sleep(WAIT_POLL_SECS)
+
+    ########################################################################################
+    # add_paths - Add directories created after the reservation was made (i.e. the job
+    #   output directory) to the ones measured for it
+    #
+    def add_paths(self, rid, paths):
+        fd = self.lock()
+        try:
+            ledger = self.load_ledger()
+            if rid in ledger['reservations']:
+                for path in paths:
+                    ledger['reservations'][rid]['paths'].setdefault(path, get_tree_size(path))
+                self.save_ledger(ledger)
+        finally:
+            fd.close()
+
+    ########################################################################################
+    # release - Give back a reservation
+    #
+    def release(self, rid):
+        fd = self.lock()
+        try:
+            ledger = self.load_ledger()
+            ledger['reservations'].pop(rid, None)
+            self.save_ledger(ledger)
+        finally:
+            fd.close()
@@ -0,0 +1,146 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Live monitor for a running Dragen process. Tails the file given to Dragen with
+# --output_status_file (job-speedometer.log) as it grows, parses stage progress and
+# reads/sec, reports progress periodically and detects stalls, i.e. no new status
+# output for a configurable amount of time.
+#
+
+from __future__ import division
+
+import os
+import re
+import threading
+import time
+
+# CONSTANTS ....
+POLL_INTERVAL_SECS = 15
+REPORT_INTERVAL_SECS = 300
+DEFAULT_STALL_TIMEOUT_SECS = 60 * 60
+
+PERCENT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*%')
+READS_PER_SEC_RE = re.compile(r'([\d.,]+)\s*([kKmM]?)\s*reads?\s*/\s*s(?:ec)?', re.IGNORECASE)
+STAGE_RE = re.compile(r'^\s*(?:[\d:\-/.T ]+\s+)?([A-Za-z][A-Za-z _\-/()]*?)\s*[:\[]')
+SCALE = {'': 1, 'k': 1e3, 'm': 1e6}
+
+
+########################################################################################
+# parse_status_line - Extract what we can from one speedometer line
+#   Returns dict with any of 'stage', 'percent', 'reads_per_sec', or None if nothing found
+#
+def parse_status_line(line):
+    status = {}
+    m = STAGE_RE.match(line)
+    if m:
+        status['stage'] = m.group(1).strip()
+    m = PERCENT_RE.search(line)
+    if m:
+        status['percent'] = float(m.group(1))
+    m = READS_PER_SEC_RE.search(line)
+    if m:
+        status['reads_per_sec'] = float(m.group(1).replace(',', '')) * SCALE[m.group(2).lower()]
+    return status or None
+
+
+########################################################################################
+# SpeedometerMonitor - Background thread tailing the Dragen status file
+#   on_progress(status) - called every report_interval with the latest parsed status
+#   on_stall(idle_secs) - called once when the file has not grown for stall_timeout secs
+#
+class SpeedometerMonitor(threading.Thread):
+
+    def __init__(self, status_path, on_progress=None, on_stall=None,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT_SECS, poll_interval=POLL_INTERVAL_SECS,
+                 report_interval=REPORT_INTERVAL_SECS):
+        threading.Thread.__init__(self, name='speedometer-monitor')
+        self.daemon = True
+        self.status_path = status_path
+        self.on_progress = on_progress
+        self.on_stall = on_stall
+        self.stall_timeout = stall_timeout
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+
+        self.stop_event = threading.Event()
+        self.offset = 0
+        self.partial_line = ''
+        self.status = {}
+        self.lines_seen = 0
+        self.last_progress_time = time.time()
+        self.last_report_time = time.time()
+        self.stalled = False
+
+    ########################################################################################
+    # stop - Ask the monitor to exit and wait for it
+    #
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    ########################################################################################
+    # read_new_lines - Return the complete lines appended since the last call
+    #
+    def read_new_lines(self):
+        try:
+            size = os.path.getsize(self.status_path)
+        except OSError:
+            return []
+        if size < self.offset:
+            # File was truncated or replaced - start over
+            self.offset = 0
+            self.partial_line = ''
+        if size == self.offset:
+            return []
+
+        with open(self.status_path, 'r') as f:
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+
+        lines = (self.partial_line + data).split('\n')
+        self.partial_line = lines.pop()
+        return lines
+
+    ########################################################################################
+    # poll - One monitoring step. Returns True if new status output was seen
+    #
+    def poll(self):
+        lines = self.read_new_lines()
+        now = time.time()
+        for line in lines:
+            status = parse_status_line(line)
+            if status:
+                self.status.update(status)
+            self.status['line'] = line.strip()
+            self.lines_seen += 1
+
+        if lines:
+            self.last_progress_time = now
+            self.stalled = False
+        elif self.stall_timeout and not self.stalled and now - self.last_progress_time >= self.stall_timeout:
+            self.stalled = True
+            if self.on_stall:
+                self.on_stall(now - self.last_progress_time)
+
+        if self.on_progress and self.status and now - self.last_report_time >= self.report_interval:
+            self.last_report_time = now
+            self.on_progress(dict(self.status))
+        return bool(lines)
+
+    def run(self):
+        while not self.stop_event.wait(self.poll_interval):
+            self.poll()
+        # Pick up whatever was written just before the process exited
+        self.poll()
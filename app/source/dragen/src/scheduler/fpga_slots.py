@@ -0,0 +1,140 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# FPGA slot discovery for hosts with several FPGAs (i.e. f1.16xlarge has 8). Each slot
+# is described with the NUMA node its PCI device is attached to and the set of CPUs of
+# that node it gets, so concurrent Dragen processes each run next to their own FPGA.
+# A slot is claimed with a flock, so that jobs in several containers on one host never
+# share a slot.
+#
+
+from __future__ import division
+
+import errno
+import fcntl
+import glob
+import os
+
+# CONSTANTS ....
+SLOTS_ENV_VAR = 'DRAGEN_FPGA_SLOTS'         # Comma separated slot numbers, overrides detection
+PCI_DEVICES_DIR = '/sys/bus/pci/devices'
+NUMA_NODES_DIR = '/sys/devices/system/node'
+FPGA_VENDOR_ID = '0x1d0f'                   # Amazon
+FPGA_DEVICE_IDS = ['0xf000', '0xf001', '0xf010']  # F1 FPGA application physical functions
+DEFAULT_LOCK_DIR = '/ephemeral/.fpga_slots/'
+
+
+########################################################################################
+# read_sysfs - First line of a sysfs file, or None
+#
+def read_sysfs(path):
+    try:
+        with open(path, 'r') as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+########################################################################################
+# parse_cpu_list - Expand a kernel cpu list, i.e. '0-3,8-11' -> [0, 1, 2, 3, 8, 9, 10, 11]
+#
+def parse_cpu_list(text):
+    cpus = []
+    for part in (text or '').split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
+########################################################################################
+# get_numa_cpus - CPUs of each NUMA node: {node: [cpus]}. A single node holding every
+#   CPU if the host does not expose NUMA information
+#
+def get_numa_cpus():
+    nodes = {}
+    for path in glob.glob(os.path.join(NUMA_NODES_DIR, 'node[0-9]*')):
+        cpus = parse_cpu_list(read_sysfs(os.path.join(path, 'cpulist')))
+        if cpus:
+            nodes[int(os.path.basename(path)[len('node'):])] = cpus
+    if not nodes:
+        nodes[0] = list(range(os.cpu_count() or 1))
+    return nodes
+
+
+########################################################################################
+# find_fpga_devices - PCI addresses and NUMA nodes of the FPGAs, in slot order
+#   Returns list of (pci address, numa node)
+#
+def find_fpga_devices():
+    devices = []
+    for path in sorted(glob.glob(os.path.join(PCI_DEVICES_DIR, '*'))):
+        if read_sysfs(os.path.join(path, 'vendor')) != FPGA_VENDOR_ID:
+            continue
+        if read_sysfs(os.path.join(path, 'device')) not in FPGA_DEVICE_IDS:
+            continue
+        node = read_sysfs(os.path.join(path, 'numa_node'))
+        devices.append((os.path.basename(path), int(node) if node and int(node) >= 0 else 0))
+    return devices
+
+
+########################################################################################
+# detect_slots - Available FPGA slots, each a dict {'slot', 'numa_node', 'cpus'}. The
+#   CPUs of each NUMA node are split evenly among the slots attached to it. Slot numbers
+#   may be forced with the SLOTS_ENV_VAR environment variable. Returns at least slot 0
+#
+def detect_slots():
+    numa_cpus = get_numa_cpus()
+    devices = find_fpga_devices()
+
+    forced = os.environ.get(SLOTS_ENV_VAR, '').strip()
+    if forced:
+        slot_nodes = [(int(x), devices[int(x)][1] if int(x) < len(devices) else 0)
+                      for x in forced.split(',') if x.strip()]
+    elif devices:
+        slot_nodes = [(idx, node) for idx, (_, node) in enumerate(devices)]
+    else:
+        slot_nodes = [(0, 0)]
+
+    # Nodes without CPUs (or unknown) fall back to the first node
+    slot_nodes = [(slot, node if node in numa_cpus else min(numa_cpus)) for slot, node in slot_nodes]
+
+    slots = []
+    for slot, node in slot_nodes:
+        peers = [x for x, n in slot_nodes if n == node]
+        cpus = numa_cpus[node]
+        share = len(cpus) // len(peers) or 1
+        idx = peers.index(slot)
+        slots.append({'slot': slot, 'numa_node': node, 'cpus': cpus[idx * share:(idx + 1) * share] or cpus})
+    return slots
+
+
+########################################################################################
+# claim_slot - Take the lock of the slot, so no other job on the host uses it. Returns
+#   the lock file object (held until closed), or None if another job holds the slot
+#
+def claim_slot(slot, lock_dir=DEFAULT_LOCK_DIR):
+    try:
+        os.makedirs(lock_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd = open(os.path.join(lock_dir, 'slot%d.lock' % slot), 'a')
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        fd.close()
+        return None
+    return fd
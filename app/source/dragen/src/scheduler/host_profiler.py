@@ -0,0 +1,243 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Lightweight host resource profiler. A background thread reads /proc/stat,
+# /proc/meminfo, /proc/diskstats and /proc/net/dev at a fixed interval and records one
+# row per sample, tagged with the phase of the job at that time (i.e. download, dragen,
+# upload). The time series is saved as CSV and the peak and mean of each metric per
+# phase as JSON, which shows whether a slow phase was CPU, disk or network bound.
+#
+
+from __future__ import division
+
+import csv
+import json
+import os
+import threading
+import time
+
+# CONSTANTS ....
+DEFAULT_INTERVAL_SECS = 5
+MB = 1024 * 1024
+GB = 1024 * MB
+SECTOR_BYTES = 512
+METRICS = ['cpu_pct', 'iowait_pct', 'mem_used_gb', 'mem_pct', 'disk_read_mbps', 'disk_write_mbps',
+           'disk_util_pct', 'net_rx_mbps', 'net_tx_mbps']
+CSV_FIELDS = ['time', 'elapsed', 'phase'] + METRICS
+
+
+########################################################################################
+# read_cpu_times - (busy, iowait, total) jiffies of all CPUs from /proc/stat
+#
+def read_cpu_times():
+    with open('/proc/stat', 'r') as f:
+        values = [int(x) for x in f.readline().split()[1:]]
+    # user nice system idle iowait irq softirq steal [guest guest_nice - included in user]
+    idle, iowait = values[3], values[4]
+    total = sum(values[:8])
+    return total - idle - iowait, iowait, total
+
+
+########################################################################################
+# read_meminfo - (total, available) memory bytes from /proc/meminfo
+#
+def read_meminfo():
+    info = {}
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            info[name] = int(value.split()[0]) * 1024
+    available = info.get('MemAvailable', info.get('MemFree', 0) + info.get('Cached', 0))
+    return info['MemTotal'], available
+
+
+########################################################################################
+# read_diskstats - (read bytes, written bytes, max busy ms) summed over the whole disks
+#   (partitions, loop and ram devices are skipped so I/O is not counted twice)
+#
+def read_diskstats():
+    read_bytes = write_bytes = 0
+    busy_ms = {}
+    with open('/proc/diskstats', 'r') as f:
+        for line in f:
+            fields = line.split()
+            name = fields[2]
+            if name.startswith(('loop', 'ram')) or not os.path.isdir('/sys/block/' + name):
+                continue
+            read_bytes += int(fields[5]) * SECTOR_BYTES
+            write_bytes += int(fields[9]) * SECTOR_BYTES
+            busy_ms[name] = int(fields[12])
+    return read_bytes, write_bytes, busy_ms
+
+
+########################################################################################
+# read_netdev - (received, transmitted) bytes of all interfaces except loopback
+#
+def read_netdev():
+    rx_bytes = tx_bytes = 0
+    with open('/proc/net/dev', 'r') as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(':', 1)
+            if name.strip() == 'lo':
+                continue
+            fields = data.split()
+            rx_bytes += int(fields[0])
+            tx_bytes += int(fields[8])
+    return rx_bytes, tx_bytes
+
+
+########################################################################################
+# read_counters - Snapshot of all the cumulative counters
+#
+def read_counters():
+    return {
+        'time': time.time(),
+        'cpu': read_cpu_times(),
+        'mem': read_meminfo(),
+        'disk': read_diskstats(),
+        'net': read_netdev()
+    }
+
+
+########################################################################################
+# HostProfiler - Sample the host usage in a background thread
+#   interval - Seconds between samples
+#
+class HostProfiler(object):
+
+    def __init__(self, interval=DEFAULT_INTERVAL_SECS):
+        self.interval = interval
+        self.phase = 'init'
+        self.samples = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.start_time = None
+        self.last = None
+
+    ########################################################################################
+    # start - Start sampling. Does nothing if /proc can not be read (i.e. not Linux)
+    #
+    def start(self):
+        if self.thread:
+            return self
+        try:
+            self.last = read_counters()
+        except (IOError, OSError, ValueError, IndexError, KeyError):
+            return self
+        self.start_time = self.last['time']
+        self.thread = threading.Thread(target=self.run, name='host-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    ########################################################################################
+    # set_phase - Tag the following samples with the given phase. The sample in progress
+    #   is taken first, so that it is accounted to the phase that just ended
+    #
+    def set_phase(self, phase):
+        if self.thread and phase != self.phase:
+            self.take_sample()
+        self.phase = phase
+
+    ########################################################################################
+    # stop - Take a last sample and stop the thread
+    #
+    def stop(self):
+        if not self.thread:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.take_sample()
+        self.thread = None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.take_sample()
+
+    ########################################################################################
+    # take_sample - Compute the usage since the previous sample and record it
+    #
+    def take_sample(self):
+        with self.lock:
+            try:
+                cur = read_counters()
+            except (IOError, OSError, ValueError, IndexError, KeyError):
+                return
+            prev, self.last = self.last, cur
+            secs = cur['time'] - prev['time']
+            if secs <= 0:
+                return
+
+            cpu_busy = cur['cpu'][0] - prev['cpu'][0]
+            cpu_iowait = cur['cpu'][1] - prev['cpu'][1]
+            cpu_total = (cur['cpu'][2] - prev['cpu'][2]) or 1
+            mem_total, mem_avail = cur['mem']
+            disk_busy = [ms - prev['disk'][2].get(name, ms) for name, ms in cur['disk'][2].items()]
+
+            self.samples.append({
+                'time': round(cur['time'], 1),
+                'elapsed': round(cur['time'] - self.start_time, 1),
+                'phase': self.phase,
+                'cpu_pct': round(100.0 * cpu_busy / cpu_total, 1),
+                'iowait_pct': round(100.0 * cpu_iowait / cpu_total, 1),
+                'mem_used_gb': round((mem_total - mem_avail) / GB, 2),
+                'mem_pct': round(100.0 * (mem_total - mem_avail) / mem_total, 1),
+                'disk_read_mbps': round((cur['disk'][0] - prev['disk'][0]) / MB / secs, 1),
+                'disk_write_mbps': round((cur['disk'][1] - prev['disk'][1]) / MB / secs, 1),
+                'disk_util_pct': round(min(100.0, max(disk_busy or [0]) / 10.0 / secs), 1),
+                'net_rx_mbps': round((cur['net'][0] - prev['net'][0]) / MB / secs, 1),
+                'net_tx_mbps': round((cur['net'][1] - prev['net'][1]) / MB / secs, 1)
+            })
+
+    ########################################################################################
+    # get_summary - Duration plus peak and mean of every metric, per phase in the order
+    #   the phases were entered
+    #
+    def get_summary(self):
+        with self.lock:
+            samples = list(self.samples)
+        phases = []
+        for sample in samples:
+            if sample['phase'] not in phases:
+                phases.append(sample['phase'])
+
+        # Each sample covers the time since the previous one
+        durations = [x['elapsed'] - y['elapsed'] for x, y in zip(samples, [{'elapsed': 0}] + samples)]
+
+        summary = {'interval_secs': self.interval, 'phases': []}
+        for phase in phases:
+            rows = [x for x in samples if x['phase'] == phase]
+            entry = {
+                'phase': phase,
+                'samples': len(rows),
+                'seconds': round(sum(d for x, d in zip(samples, durations) if x['phase'] == phase), 1)
+            }
+            for metric in METRICS:
+                values = [x[metric] for x in rows]
+                entry[metric] = {'peak': max(values), 'mean': round(sum(values) / len(values), 1)}
+            summary['phases'].append(entry)
+        return summary
+
+    ########################################################################################
+    # save - Write the time series as CSV and the per phase summary as JSON
+    #
+    def save(self, csv_path, summary_path):
+        with self.lock:
+            samples = list(self.samples)
+        with open(csv_path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(samples)
+        with open(summary_path, 'w') as f:
+            json.dump(self.get_summary(), f, indent=2)
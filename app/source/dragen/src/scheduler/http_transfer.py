@@ -0,0 +1,179 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# HTTP(S) transfer backend for presigned and public URL inputs. All requests of the
+# process go through one requests.Session with a pooled keep-alive connection per host,
+# so that the size probe, the byte ranges of a multipart download and the following
+# inputs reuse the same TCP/TLS connections. The size is probed with HEAD (falling back
+# to a 'Range: bytes=0-0' GET, as presigned S3 URLs are signed for GET only) and the
+# final location after redirects is remembered, so ranged GETs go straight to it.
+#
+
+from __future__ import division
+
+import os
+import threading
+
+from . import local_fs
+from . import scheduler_utils as utils
+
+# CONSTANTS ....
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_THREAD_COUNT = 8
+MIN_PART_SIZE = 8 * 1024 * 1024         # Smaller downloads use a single GET
+POOL_SIZE = 32                          # Keep-alive connections kept per host
+CONNECT_TIMEOUT_SECS = 30
+READ_TIMEOUT_SECS = 300
+RETRY_COUNT = 3
+
+session = None
+session_lock = threading.Lock()
+redirects = {}                          # URL -> final URL after redirects
+
+
+########################################################################################
+# get_session - The shared session of the process, created on first use. Failed
+#   connections and 5xx replies are retried with backoff
+#
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(total=RETRY_COUNT, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+    return session
+
+
+########################################################################################
+# resolve_url - Final location of the URL if an earlier request was redirected
+#
+def resolve_url(url):
+    return redirects.get(url, url)
+
+
+def remember_redirect(url, response):
+    if response.history and response.url != url:
+        redirects[url] = response.url
+
+
+########################################################################################
+# probe_url - Size of the object behind the URL and whether byte ranges are supported.
+#   Returns (size or None, accepts_ranges)
+#
+def probe_url(url):
+    s = get_session()
+    r = s.head(resolve_url(url), allow_redirects=True, timeout=(CONNECT_TIMEOUT_SECS, READ_TIMEOUT_SECS))
+    if r.status_code < 400 and 'content-length' in r.headers:
+        remember_redirect(url, r)
+        return int(r.headers['content-length']), r.headers.get('accept-ranges', '').lower() == 'bytes'
+
+    # HEAD not allowed (i.e. presigned for GET) - fetch the first byte instead
+    r = s.get(resolve_url(url), headers={'Range': 'bytes=0-0'}, allow_redirects=True, stream=True,
+              timeout=(CONNECT_TIMEOUT_SECS, READ_TIMEOUT_SECS))
+    try:
+        r.raise_for_status()
+        remember_redirect(url, r)
+        if r.status_code == 206 and '/' in r.headers.get('content-range', ''):
+            total = r.headers['content-range'].rsplit('/', 1)[1]
+            return (int(total) if total != '*' else None), True
+        if 'content-length' in r.headers:
+            return int(r.headers['content-length']), False
+        return None, False
+    finally:
+        r.close()
+
+
+########################################################################################
+# download_range - GET one byte range into its place in the (preallocated) target file.
+#   Returns the number of bytes written
+#
+def download_range(url, tgt_path, start, end):
+    r = get_session().get(resolve_url(url), headers={'Range': 'bytes=%d-%d' % (start, end)}, stream=True,
+                          timeout=(CONNECT_TIMEOUT_SECS, READ_TIMEOUT_SECS))
+    try:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError('Server ignored the byte range request for %s' % url)
+        tot_bytes = 0
+        with open(tgt_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                tot_bytes += len(chunk)
+    finally:
+        r.close()
+    if tot_bytes != end - start + 1:
+        raise IOError('Short read of bytes %d-%d of %s (%d bytes)' % (start, end, url, tot_bytes))
+    return tot_bytes
+
+
+########################################################################################
+# download_single - Stream the URL with one GET. Returns the number of bytes written
+#
+def download_single(url, tgt_path):
+    r = get_session().get(resolve_url(url), stream=True, timeout=(CONNECT_TIMEOUT_SECS, READ_TIMEOUT_SECS))
+    try:
+        r.raise_for_status()
+        remember_redirect(url, r)
+        tot_bytes = 0
+        with open(tgt_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                tot_bytes += len(chunk)
+    finally:
+        r.close()
+
+    expected = r.headers.get('content-length')
+    if expected is not None and 'content-encoding' not in r.headers and int(expected) != tot_bytes:
+        raise IOError('Short read of %s (%d of %s bytes)' % (url, tot_bytes, expected))
+    return tot_bytes
+
+
+########################################################################################
+# download_url - Download the URL to tgt_path. With more than one thread, objects of at
+#   least MIN_PART_SIZE on a server accepting byte ranges are fetched as parallel ranges
+#   over the pooled connections, each written in place (no part files to concatenate).
+#   The file is written under a temp name and renamed to tgt_path once complete
+#   Returns the number of bytes written
+#
+def download_url(url, tgt_path, thread_count=1):
+    utils.check_create_dir(os.path.dirname(tgt_path) or '.')
+
+    size, accepts_ranges = None, False
+    if thread_count > 1:
+        size, accepts_ranges = probe_url(url)
+
+    with local_fs.atomic_path(tgt_path) as tmp_path:
+        if not size or not accepts_ranges or size < MIN_PART_SIZE:
+            return download_single(url, tmp_path)
+
+        from multiprocessing.pool import ThreadPool
+
+        part_size = max(MIN_PART_SIZE, -(-size // thread_count))
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        with open(tmp_path, 'wb') as f:
+            f.truncate(size)
+
+        pool = ThreadPool(min(thread_count, len(ranges)))
+        try:
+            return sum(pool.map(lambda x: download_range(url, tmp_path, x[0], x[1]), ranges))
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,165 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Termination watcher for Dragen jobs. A job is about to be stopped when the container
+# gets SIGTERM (Batch job termination, docker stop) or when the spot instance gets its
+# two minute interruption notice from the instance metadata service. The notice source
+# is polled, and may be replaced with a local file holding the same JSON document, i.e.
+# '{"action": "terminate", "time": "2018-01-01T00:00:00Z"}', to test the job on demand.
+#
+
+from __future__ import division
+
+import calendar
+import json
+import os
+import signal
+import threading
+import time
+
+# CONSTANTS ....
+NOTICE_ENV_VAR = 'DRAGEN_INTERRUPTION_NOTICE'   # Notice URL or local file, 'none' to disable polling
+IMDS_TOKEN_URL = 'http://169.254.169.254/latest/api/token'
+IMDS_NOTICE_URL = 'http://169.254.169.254/latest/meta-data/spot/instance-action'
+IMDS_TIMEOUT_SECS = 1
+DEFAULT_POLL_SECS = 5
+SIGTERM_GRACE_SECS = 30         # ECS stop timeout: SIGKILL follows SIGTERM after 30 seconds by default
+SPOT_NOTICE_SECS = 120
+
+
+########################################################################################
+# parse_notice - Deadline (epoch seconds) of an instance-action notice document, or None
+#   if it holds no stop/terminate action
+#
+def parse_notice(text):
+    try:
+        notice = json.loads(text)
+    except ValueError:
+        return None
+    if notice.get('action') not in ('stop', 'terminate', 'hibernate'):
+        return None
+    try:
+        return calendar.timegm(time.strptime(notice['time'], '%Y-%m-%dT%H:%M:%SZ'))
+    except (KeyError, ValueError):
+        return time.time() + SPOT_NOTICE_SECS
+
+
+########################################################################################
+# read_imds_notice - Spot instance-action document from the instance metadata service
+#   (IMDSv2, falling back to v1). Returns None if there is no notice (404), raises
+#   IOError if the service can not be reached
+#
+def read_imds_notice(url=IMDS_NOTICE_URL):
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    headers = {}
+    try:
+        req = Request(IMDS_TOKEN_URL, method='PUT', headers={'X-aws-ec2-metadata-token-ttl-seconds': '300'})
+        headers['X-aws-ec2-metadata-token'] = urlopen(req, timeout=IMDS_TIMEOUT_SECS).read().decode('utf-8')
+    except HTTPError:
+        pass
+    try:
+        return urlopen(Request(url, headers=headers), timeout=IMDS_TIMEOUT_SECS).read().decode('utf-8')
+    except HTTPError as e:
+        if e.code == 404:
+            return None
+        raise IOError('Metadata service replied %d' % e.code)
+
+
+########################################################################################
+# InterruptionWatcher - Calls on_interrupt(reason) once, from the main thread on SIGTERM
+#   or from the polling thread on an interruption notice
+#   on_interrupt  - Callback; must return quickly (i.e. stop the Dragen process)
+#   notice_source - URL or local file of the instance-action notice (default: from
+#                   NOTICE_ENV_VAR, else the instance metadata service)
+#
+class InterruptionWatcher(object):
+
+    def __init__(self, on_interrupt, notice_source=None, poll_interval=DEFAULT_POLL_SECS):
+        self.on_interrupt = on_interrupt
+        self.notice_source = notice_source or os.environ.get(NOTICE_ENV_VAR) or IMDS_NOTICE_URL
+        self.poll_interval = poll_interval
+        self.reason = None
+        self.deadline = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def interrupted(self):
+        return self.reason is not None
+
+    ########################################################################################
+    # remaining - Seconds left before the container is killed, None if not interrupted
+    #
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    ########################################################################################
+    # start - Install the SIGTERM handler (main thread only) and start polling for a notice
+    #
+    def start(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.handle_signal)
+        if self.notice_source.lower() != 'none':
+            self.thread = threading.Thread(target=self.poll_loop)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def handle_signal(self, signum, frame):
+        self.interrupt('signal %d' % signum, time.time() + SIGTERM_GRACE_SECS)
+
+    ########################################################################################
+    # read_notice - Deadline of the pending interruption notice, or None
+    #
+    def read_notice(self):
+        source = self.notice_source
+        if source.startswith('http://') or source.startswith('https://'):
+            text = read_imds_notice(source)
+        else:
+            if source.startswith('file://'):
+                source = source[len('file://'):]
+            if not os.path.isfile(source):
+                return None
+            with open(source, 'r') as f:
+                text = f.read()
+        return parse_notice(text) if text else None
+
+    def poll_loop(self):
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                deadline = self.read_notice()
+            except (IOError, OSError):
+                # Not on EC2 (or no metadata access) - nothing to poll
+                return
+            if deadline:
+                self.interrupt('spot interruption notice', deadline)
+                return
+
+    ########################################################################################
+    # interrupt - Record the first interruption and notify the callback
+    #
+    def interrupt(self, reason, deadline):
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            self.deadline = deadline
+        self.on_interrupt(reason)
@@ -0,0 +1,195 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Dry-run planning of Dragen jobs: the size of every input is resolved with as few
+# requests as possible (one listing per S3 prefix holding several inputs, a HEAD
+# otherwise), and the staging and upload times are estimated with a throughput model
+# calibrated from the manifests (transfer.MANIFEST_FILE_NAME) of past jobs.
+#
+
+from __future__ import division
+
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+from . import aws_utils as aws
+from . import http_transfer
+
+# CONSTANTS ....
+HISTORY_ENV_VAR = 'DRAGEN_PLAN_HISTORY'     # s3://bucket/prefix holding the outputs of past jobs
+HISTORY_MAX_MANIFESTS = 50                  # Most recent manifests used for calibration
+HOURLY_COST_ENV_VAR = 'DRAGEN_PLAN_HOURLY_USD'
+DEFAULT_HOURLY_COST = 1.65                  # f1.2xlarge on-demand, us-east-1
+DEFAULT_DOWNLOAD_MBPS = 200.0               # Used until past jobs calibrate the model
+DEFAULT_UPLOAD_MBPS = 150.0
+DEFAULT_OUTPUT_RATIO = 1.0                  # Uploaded outputs / FASTQ input bytes
+CALIBRATION_MIN_BYTES = 16 * 1024 * 1024    # Smaller transfers are dominated by request latency
+SIZE_CONCURRENCY = 16
+MANIFEST_FILE_NAME = 'manifest.json'        # Same as transfer.MANIFEST_FILE_NAME
+MB = 1024 * 1024
+
+
+########################################################################################
+# split_s3_url - (bucket, key) of an s3:// URL, or None
+#
+def split_s3_url(url):
+    if not url or not url.startswith('s3://'):
+        return None
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return (bucket, key) if bucket and key else None
+
+
+########################################################################################
+# resolve_sizes - Size in bytes of the object behind each URL, None if unknown. S3 objects
+#   sharing a parent prefix with other inputs are sized from one listing of the prefix,
+#   the others with concurrent HEAD requests
+#   Returns dict {url: size}
+#
+def resolve_sizes(urls):
+    urls = sorted(set(x for x in urls if x))
+    groups = {}
+    for url in urls:
+        s3_loc = split_s3_url(url)
+        if s3_loc:
+            groups.setdefault((s3_loc[0], s3_loc[1].rsplit('/', 1)[0] + '/'), []).append(url)
+
+    sizes = {}
+    listings = [x for x, members in groups.items() if len(members) > 1]
+
+    def list_prefix(group):
+        try:
+            return dict(('s3://%s/%s' % (group[0], x['Key']), x['Size'])
+                        for x in aws.s3_list_objects(group[0], group[1], region=aws.s3_get_bucket_region(group[0])))
+        except Exception:
+            return {}
+
+    def head_url(url):
+        s3_loc = split_s3_url(url)
+        try:
+            if s3_loc:
+                return url, aws.s3_get_object_info(s3_loc[0], s3_loc[1])['ContentLength']
+            return url, http_transfer.probe_url(url)[0]
+        except Exception:
+            return url, None
+
+    pool = ThreadPool(SIZE_CONCURRENCY)
+    try:
+        for listed in pool.map(list_prefix, listings):
+            sizes.update(listed)
+        sizes.update(pool.map(head_url, [x for x in urls if x not in sizes]))
+    finally:
+        pool.close()
+        pool.join()
+    return dict((x, sizes.get(x)) for x in urls)
+
+
+########################################################################################
+# s3_load_manifests - The most recent job manifests below the history location
+#   Returns list of manifest dicts, newest first
+#
+def s3_load_manifests(history_url, max_manifests=HISTORY_MAX_MANIFESTS):
+    bucket, _, prefix = history_url[len('s3://'):].partition('/')
+    objects = [x for x in aws.s3_list_objects(bucket, prefix, region=aws.s3_get_bucket_region(bucket))
+               if x['Key'].split('/')[-1] == MANIFEST_FILE_NAME]
+    objects.sort(key=lambda x: x['LastModified'], reverse=True)
+
+    manifests = []
+    for obj in objects[:max_manifests]:
+        try:
+            manifests.append(json.loads(aws.s3_get_object_body(bucket, obj['Key']).decode('utf-8')))
+        except Exception:
+            continue
+    return manifests
+
+
+########################################################################################
+# calibrate - Throughput model from past job manifests: aggregate download and upload
+#   rates of the transfers large enough to be bandwidth bound, the output to FASTQ size
+#   ratio and the Dragen seconds per FASTQ GB
+#   Returns dict {'download_mbps', 'upload_mbps', 'output_ratio', 'dragen_secs_per_gb',
+#                 'jobs'}, with defaults for what the manifests do not cover
+#
+def calibrate(manifests):
+    totals = {'download': [0, 0.0], 'upload': [0, 0.0]}
+    output_bytes = fastq_bytes = 0
+    dragen_secs = dragen_fastq_bytes = 0
+    for manifest in manifests:
+        for entry in manifest.get('transfers', []):
+            if entry.get('op') == 'download' and not entry.get('cached') \
+                    and entry.get('bytes', 0) >= CALIBRATION_MIN_BYTES:
+                totals['download'][0] += entry['bytes']
+                totals['download'][1] += entry['seconds']
+        for obj in manifest.get('objects', []):
+            if obj.get('size', 0) >= CALIBRATION_MIN_BYTES and obj.get('upload_seconds'):
+                totals['upload'][0] += obj['size']
+                totals['upload'][1] += obj['upload_seconds']
+        if manifest.get('fastq_bytes') and manifest.get('exit_code') == 0:
+            output_bytes += manifest.get('total_bytes', 0)
+            fastq_bytes += manifest['fastq_bytes']
+            if manifest.get('dragen_seconds'):
+                dragen_secs += manifest['dragen_seconds']
+                dragen_fastq_bytes += manifest['fastq_bytes']
+
+    def rate(op, default):
+        nbytes, seconds = totals[op]
+        return nbytes / MB / seconds if seconds > 0 else default
+
+    return {
+        'download_mbps': rate('download', DEFAULT_DOWNLOAD_MBPS),
+        'upload_mbps': rate('upload', DEFAULT_UPLOAD_MBPS),
+        'output_ratio': output_bytes / fastq_bytes if fastq_bytes else DEFAULT_OUTPUT_RATIO,
+        'dragen_secs_per_gb': dragen_secs / (dragen_fastq_bytes / 1024 ** 3) if dragen_fastq_bytes else None,
+        'jobs': len(manifests)
+    }
+
+
+########################################################################################
+# load_model - calibrate() from the manifests below the HISTORY_ENV_VAR location, or the
+#   default model if it is not set or can not be read
+#
+def load_model(logger=None):
+    history_url = os.environ.get(HISTORY_ENV_VAR)
+    manifests = []
+    if history_url:
+        try:
+            manifests = s3_load_manifests(history_url)
+        except Exception as e:
+            if logger:
+                logger('Warning: could not read past job manifests from %s (%s)' % (history_url, str(e)))
+    return calibrate(manifests)
+
+
+########################################################################################
+# transfer_seconds - Time to move nbytes at mbps MB/s
+#
+def transfer_seconds(nbytes, mbps):
+    return nbytes / MB / mbps if mbps else 0.0
+
+
+########################################################################################
+# get_hourly_cost - Instance price used for the cost estimate, in USD per hour
+#
+def get_hourly_cost():
+    try:
+        return float(os.environ.get(HOURLY_COST_ENV_VAR, DEFAULT_HOURLY_COST))
+    except ValueError:
+        return DEFAULT_HOURLY_COST
+
+
+########################################################################################
+# format_secs - Seconds as h:mm:ss
+#
+def format_secs(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -0,0 +1,111 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Local filesystem helpers for staging large directory trees with few metadata calls:
+# the target directories of a download are created once per distinct directory, trees
+# are walked with os.scandir reusing the stat information of the directory entries, and
+# downloaded files are written to a temp file in the target directory and renamed into
+# place, so that readers never see a partially written file.
+#
+
+from __future__ import division
+
+import os
+import threading
+from contextlib import contextmanager
+
+# CONSTANTS ....
+TEMP_SUFFIX = '.part'
+
+
+########################################################################################
+# make_dirs - Create each distinct directory once, parents first. Raises OSError if a
+#   path exists and is not a directory
+#   Returns the set of directories
+#
+def make_dirs(dir_paths):
+    dirs = set(x.rstrip('/') or '/' for x in dir_paths if x)
+    for path in sorted(dirs):
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+########################################################################################
+# make_parent_dirs - make_dirs for the parent directories of the given file paths
+#
+def make_parent_dirs(file_paths):
+    return make_dirs(os.path.dirname(x) or '.' for x in file_paths)
+
+
+########################################################################################
+# scan_files - Regular files below dir_path, walked with os.scandir. Hidden files are
+#   skipped unless include_hidden is set
+#   follow_symlinks - Include symlinks to files (like os.path.isfile), with their target's stat
+#   recursive       - False to list dir_path only
+#   Returns list of (path, os.stat_result)
+#
+def scan_files(dir_path, include_hidden=False, follow_symlinks=True, recursive=True):
+    files = []
+    pending = [dir_path]
+    while pending:
+        try:
+            it = os.scandir(pending.pop())
+        except (IOError, OSError):
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):     # Like os.walk
+                        if recursive:
+                            pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=follow_symlinks) \
+                            and (include_hidden or not entry.name.startswith('.')):
+                        files.append((entry.path, entry.stat(follow_symlinks=follow_symlinks)))
+                except OSError:
+                    # Removed while walking
+                    continue
+    return files
+
+
+########################################################################################
+# tree_size - Total size of the regular files below dir_path (symlinks not counted), or
+#   of the file at dir_path. 0 if it does not exist
+#
+def tree_size(dir_path):
+    if os.path.isfile(dir_path):
+        return os.path.getsize(dir_path)
+    return sum(st.st_size for _, st in scan_files(dir_path, include_hidden=True, follow_symlinks=False))
+
+
+########################################################################################
+# temp_path - Temp file name next to tgt_path, unique per process and thread
+#
+def temp_path(tgt_path):
+    dir_name, name = os.path.split(tgt_path)
+    return os.path.join(dir_name, '.%s.%d.%d%s' % (name, os.getpid(), threading.current_thread().ident,
+                                                   TEMP_SUFFIX))
+
+
+########################################################################################
+# atomic_path - Context manager yielding the temp path to write tgt_path through. The temp
+#   file is renamed to tgt_path when the block completes, and removed if it raises
+#
+@contextmanager
+def atomic_path(tgt_path):
+    tmp_path = temp_path(tgt_path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, tgt_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -13,27 +13,53 @@
 #
 # Class for logging using syslog or logging timestamps directly to a file.
 #
+# Records are handed to a background writer thread through a queue, so a log call only
+# costs a tuple and a queue put. The writer formats records in batches and flushes the
+# sinks on a schedule (and on error/fatal/close). With structured=True, file records are
+# written as JSON lines carrying the elapsed time, thread name and any extra fields
+# passed to log(), e.g. logger.log('Part done', bytes=8388608, part=3)
+#
 
 from __future__ import print_function
 
 from builtins import object
+import atexit
 import datetime
+import json
+import os
 import sys
 import syslog
+import threading
+import time
 import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# CONSTANTS ....
+FLUSH_INTERVAL_SECS = 1.0           # Max time a record waits in the writer before a flush
+MAX_BATCH_RECORDS = 1024            # Max records formatted per batch
+LOG_FILE_BUFFER_BYTES = 256 * 1024
+
 
 class Logger(object):
     ########################################################################################
     # Constructor - either cfg or logpath must be defined
     #
-    def __init__(self, cfg=None, logpath=None, syslogger=False, procname=None, stdout=False):
+    def __init__(self, cfg=None, logpath=None, syslogger=False, procname=None, stdout=False,
+                 structured=False, async_writer=True, flush_interval=FLUSH_INTERVAL_SECS):
         if cfg:
             self.log_level = cfg.verbose
         else:
             self.log_level = 1
         self.stdout = stdout
         self.syslogger = syslogger
+        self.structured = structured
+        self.flush_interval = flush_interval
+        self.start_time = time.time()
+        self.logpath = None
 
         if procname:
             self.procname = procname
@@ -44,9 +70,10 @@ class Logger(object):
             self.logopt = syslog.LOG_CONS | syslog.LOG_PID | syslog.LOG_NDELAY
             self.facility = syslog.LOG_USER
             self.logfd = None
+            syslog.openlog(self.procname, self.logopt, self.facility)
         elif logpath:
             try:
-                self.logfd = open(logpath, 'w', 0)
+                self.logfd = open(logpath, 'w', LOG_FILE_BUFFER_BYTES)
                 self.logpath = logpath
             except Exception as e:
                 print("ERROR: could not open %s for logging - log output redirected to stdout" % logpath)
@@ -56,41 +83,205 @@ class Logger(object):
             self.logfd = sys.stdout
             self.stdout = True
 
+        # Cached timestamp prefix, reformatted at most once per second
+        self.ts_second = None
+        self.ts_prefix = None
+
+        self.queue = None
+        self.writer = None
+        self.write_lock = threading.Lock()
+        self.pid = os.getpid()
+        if async_writer:
+            self.queue = queue.Queue()
+            self.writer = threading.Thread(target=self.writer_loop, name='logger-writer')
+            self.writer.daemon = True
+            self.writer.start()
+            atexit.register(self.close)
+
     ########################################################################################
-    # log
+    # __getstate__ / __setstate__ - Allow a Logger to be pickled into worker processes
+    #   (i.e. multiprocessing pools). The copy logs synchronously to stdout
     #
-    def log(self, msg, level=1):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('logfd', 'queue', 'writer', 'write_lock'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.syslogger = False
+        self.logfd = sys.stdout
+        self.stdout = True
+        self.queue = None
+        self.writer = None
+        self.write_lock = threading.Lock()
+        self.pid = os.getpid()
+
+    ########################################################################################
+    # check_fork - A forked child (i.e. a multiprocessing fork worker) inherits the queue but
+    #   not the writer thread. Switch the child to synchronous writes, with a fresh lock
+    #   since the parent's may have been held at fork time
+    #
+    def check_fork(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.queue = None
+            self.writer = None
+            self.write_lock = threading.Lock()
+
+    ########################################################################################
+    # log - Queue a record for the writer thread. Extra keyword fields are included in
+    #   structured output
+    #
+    def log(self, msg, level=1, **fields):
         if self.log_level < level:
             return
+        record = (time.time(), msg, threading.current_thread().name, fields)
+        if self.pid != os.getpid():
+            self.check_fork()
+        if self.queue is not None:
+            self.queue.put(record)
+        else:
+            self.write_records([record])
+
+    ########################################################################################
+    # flush - Wait until every record queued so far has been written and flushed
+    #
+    def flush(self):
+        self.check_fork()
+        if self.queue is not None and self.writer.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+        else:
+            self.flush_sinks()
+
+    ########################################################################################
+    # close - Drain the queue and stop the writer thread
+    #
+    def close(self):
+        self.check_fork()
+        if self.queue is not None and self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.flush_sinks()
         if self.syslogger:
-            syslog.openlog(self.procname, self.logopt, self.facility)
-            syslog.syslog(msg)
             syslog.closelog()
 
-        elif self.stdout and self.logfd == sys.stdout:
-            self.logfd.write("%s\n" % msg)
-            self.logfd.flush()
-        else:
-            self.logfd.write("%s %s\n"
-                             % (datetime.datetime.strftime(datetime.datetime.now(), '%b %d %Y %H:%M:%S'),
-                                msg))
-            self.logfd.flush()
-        # Handle case where we want both stdout and logfile or syslog
-        if self.stdout and self.logfd != sys.stdout:
-            sys.stdout.write("%s\n" % msg)
-            sys.stdout.flush()
+    ########################################################################################
+    # writer_loop - Background writer: batch records and flush on a schedule
+    #
+    def writer_loop(self):
+        last_flush = time.time()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.time() - last_flush))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            batch = []
+            waiters = []
+            stop = False
+            while item is not False:
+                if item is None:
+                    stop = True
+                elif isinstance(item, tuple):
+                    batch.append(item)
+                else:
+                    waiters.append(item)
+                if stop or len(batch) >= MAX_BATCH_RECORDS:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = False
+
+            if batch:
+                self.write_records(batch)
+            if waiters or stop or time.time() - last_flush >= self.flush_interval:
+                self.flush_sinks()
+                last_flush = time.time()
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+
+    ########################################################################################
+    # format_timestamp - 'Mon DD YYYY HH:MM:SS' for the record time, cached per second
+    #
+    def format_timestamp(self, ts):
+        second = int(ts)
+        if second != self.ts_second:
+            self.ts_second = second
+            self.ts_prefix = datetime.datetime.fromtimestamp(second).strftime('%b %d %Y %H:%M:%S')
+        return self.ts_prefix
+
+    ########################################################################################
+    # format_structured - One JSON line for the record
+    #
+    def format_structured(self, record):
+        ts, msg, thread, fields = record
+        entry = {
+            'time': '%s.%03d' % (self.format_timestamp(ts), int((ts % 1) * 1000)),
+            'elapsed': round(ts - self.start_time, 3),
+            'thread': thread,
+            'msg': msg
+        }
+        entry.update(fields)
+        return json.dumps(entry)
+
+    ########################################################################################
+    # write_records - Format a batch of records and write them to the sinks
+    #
+    def write_records(self, records):
+        with self.write_lock:
+            if self.syslogger:
+                for record in records:
+                    syslog.syslog(record[1])
+
+            elif self.stdout and self.logfd == sys.stdout:
+                self.logfd.write(''.join("%s\n" % x[1] for x in records))
+
+            elif self.structured:
+                self.logfd.write(''.join("%s\n" % self.format_structured(x) for x in records))
+
+            else:
+                self.logfd.write(''.join("%s %s\n" % (self.format_timestamp(x[0]), x[1]) for x in records))
+
+            # Handle case where we want both stdout and logfile or syslog
+            if self.stdout and self.logfd != sys.stdout:
+                sys.stdout.write(''.join("%s\n" % x[1] for x in records))
+
+            if self.queue is None:
+                self.flush_sinks()
+
+    ########################################################################################
+    # flush_sinks - Flush the log file and stdout
+    #
+    def flush_sinks(self):
+        try:
+            if self.logfd:
+                self.logfd.flush()
+            if self.stdout:
+                sys.stdout.flush()
+        except ValueError:
+            pass    # Sink already closed at interpreter exit
 
     ########################################################################################
     # fatal
     #
     def fatal(self, msg):
         self.log("FATAL: %s" % msg)
+        self.flush()
 
     ########################################################################################
     # error
     #
     def error(self, msg):
         self.log("ERROR: %s" % msg)
+        self.flush()
 
     ########################################################################################
     # warning
@@ -105,3 +296,4 @@ class Logger(object):
         formatted_lines = traceback.format_exc().splitlines()
         for line in formatted_lines:
             self.log(line)
+        self.flush()
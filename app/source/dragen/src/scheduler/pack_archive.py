@@ -0,0 +1,103 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Packing of the small files of an output directory into one indexed archive object.
+# The archive is a plain tar (so 'tar xf' still works on it), uploaded with a JSON index
+# object holding the data offset and size of every member. A single member is read back
+# with one ranged GET, without downloading the archive.
+#
+
+from __future__ import division
+
+import json
+import os
+import tarfile
+import tempfile
+
+from . import aws_utils as aws
+from . import local_fs
+from . import scheduler_utils as utils
+
+# CONSTANTS ....
+PACK_FILE_NAME = 'small_files.tar'
+INDEX_SUFFIX = '.index.json'
+PACK_MAX_FILE_BYTES = 1024 * 1024       # Files below this size are packed
+
+
+########################################################################################
+# find_small_files - Files below max_bytes in the directory tree
+#
+def find_small_files(dir_path, max_bytes=PACK_MAX_FILE_BYTES):
+    return sorted(path for path, st in local_fs.scan_files(dir_path) if st.st_size < max_bytes)
+
+
+########################################################################################
+# build_pack - Write the files into a tar archive at tar_path, named by their path
+#   relative to dir_path. Returns the index: {name: {'offset': data offset, 'size'}}
+#
+def build_pack(dir_path, files, tar_path):
+    with tarfile.open(tar_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+        for path in files:
+            tar.add(path, arcname=os.path.relpath(path, dir_path), recursive=False)
+
+    # The data offsets are only known once the headers are written - read them back
+    with tarfile.open(tar_path, 'r') as tar:
+        return dict((x.name, {'offset': x.offset_data, 'size': x.size}) for x in tar if x.isfile())
+
+
+########################################################################################
+# s3_upload_pack - Pack the files of dir_path into bucket/key (the archive) and upload its
+#   index to key + INDEX_SUFFIX. Return: Number of bytes uploaded
+#   records - optional list to append the aws.s3_object_record of both objects to
+#
+def s3_upload_pack(dir_path, files, bucket, key, priority=aws.PRIORITY_OUTPUT, records=None):
+    fd, tar_path = tempfile.mkstemp(dir=os.path.dirname(dir_path.rstrip('/')) or '.', suffix='.tar')
+    os.close(fd)
+    index_path = tar_path + INDEX_SUFFIX
+    try:
+        index = build_pack(dir_path, files, tar_path)
+        with open(index_path, 'w') as f:
+            json.dump({'archive': os.path.basename(key), 'members': index}, f, indent=1, sort_keys=True)
+        return (aws.s3_upload(tar_path, bucket, key, priority=priority, records=records) +
+                aws.s3_upload(index_path, bucket, key + INDEX_SUFFIX, priority=priority, records=records))
+    finally:
+        for path in (tar_path, index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+########################################################################################
+# s3_get_pack_index - Member index of the archive at bucket/key
+#
+def s3_get_pack_index(bucket, key, client):
+    resp = client.get_object(Bucket=bucket, Key=key + INDEX_SUFFIX)
+    return json.loads(resp['Body'].read().decode('utf-8'))['members']
+
+
+########################################################################################
+# s3_download_member - Fetch one member of the archive at bucket/key with a ranged GET
+#   and write it to tgt_path. Raises KeyError if the archive has no such member
+#   Return: Member size
+#
+def s3_download_member(bucket, key, member, tgt_path, region='us-east-1', nosign=False):
+    client = aws.s3_create_client(region, nosign)
+    entry = s3_get_pack_index(bucket, key, client)[member]
+
+    utils.check_create_dir(os.path.dirname(tgt_path) or '.')
+    with local_fs.atomic_path(tgt_path) as tmp_path:
+        with open(tmp_path, 'wb') as f:
+            if entry['size']:
+                resp = client.get_object(Bucket=bucket, Key=key, Range='bytes=%d-%d'
+                                         % (entry['offset'], entry['offset'] + entry['size'] - 1))
+                f.write(resp['Body'].read())
+    return os.path.getsize(tgt_path)
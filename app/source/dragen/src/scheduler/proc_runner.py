@@ -0,0 +1,275 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Process runner for long running tools (Dragen). The process is started from an argv
+# list (no shell), its stdout and stderr are streamed through pipes into a size-rotated
+# log file (rotated files are gzip compressed) and handed line by line to an optional
+# callback. The runner reaps the process itself with wait4() to report its CPU time and
+# peak RSS, and can sample the live usage from /proc while it runs.
+#
+
+from __future__ import division
+
+import gzip
+import os
+import resource
+import shutil
+import subprocess
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# CONSTANTS ....
+MAX_LOG_BYTES = 256 * 1024 * 1024       # Rotate the log file beyond this size
+LOG_BACKUP_COUNT = 5                    # Number of compressed rotated logs kept
+READER_JOIN_TIMEOUT_SECS = 60           # Grandchildren may keep the pipes open after exit
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = resource.getpagesize()
+
+
+########################################################################################
+# RotatingLog - Thread safe line log rotated by size. log -> log.1.gz -> log.2.gz ...
+#   Writers only rename the full file and reopen a new one; the rotated files are gzip
+#   compressed in order by a single background thread, so the pipe readers never wait
+#   for the compression
+#
+class RotatingLog(object):
+
+    def __init__(self, path, max_bytes=MAX_LOG_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.fd = open(path, 'ab')
+        self.size = self.fd.tell()
+        self.rotations = 0
+        self.pending = queue.Queue()    # Rotated files waiting for compression, None to stop
+        self.compressor = None
+
+    def write(self, data):
+        with self.lock:
+            if self.fd.closed:
+                return
+            if self.size + len(data) > self.max_bytes and self.size:
+                self.rotate()
+            self.fd.write(data)
+            self.size += len(data)
+
+    ########################################################################################
+    # rotate - Move the current file aside and reopen. Caller must hold self.lock
+    #
+    def rotate(self):
+        self.fd.close()
+        self.rotations += 1
+        rotated = '%s.%d.tmp' % (self.path, self.rotations)
+        os.rename(self.path, rotated)
+        self.fd = open(self.path, 'wb')
+        self.size = 0
+
+        if not self.compressor:
+            self.compressor = threading.Thread(target=self.compress_rotated)
+            self.compressor.daemon = True
+            self.compressor.start()
+        self.pending.put(rotated)
+
+    ########################################################################################
+    # compress_rotated - Background thread: compress each rotated file to log.1.gz, shifting
+    #   the older ones up and dropping the oldest beyond backup_count
+    #
+    def compress_rotated(self):
+        while True:
+            rotated = self.pending.get()
+            if rotated is None:
+                return
+            try:
+                with open(rotated, 'rb') as f_in, gzip.open(rotated + '.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                for idx in range(self.backup_count - 1, 0, -1):
+                    src = '%s.%d.gz' % (self.path, idx)
+                    if os.path.exists(src):
+                        os.rename(src, '%s.%d.gz' % (self.path, idx + 1))
+                os.rename(rotated + '.gz', '%s.1.gz' % self.path)
+                os.remove(rotated)
+            except (IOError, OSError):
+                # Keep the uncompressed file rather than lose the log
+                continue
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+        if self.compressor:
+            self.pending.put(None)
+            self.compressor.join()
+
+
+########################################################################################
+# read_proc_usage - Live CPU seconds and RSS bytes of a process from /proc/<pid>/stat,
+#   or None if the process is gone
+#
+def read_proc_usage(pid):
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError, IndexError):
+        return None
+    # Fields after the command name start at 'state' (field 3 of proc(5))
+    utime, stime, cutime, cstime = [int(x) for x in fields[11:15]]
+    return {
+        'cpu_seconds': (utime + stime + cutime + cstime) / CLK_TCK,
+        'rss_bytes': int(fields[21]) * PAGE_SIZE
+    }
+
+
+########################################################################################
+# ProcessRunner - Run one process to completion
+#   argv     - Command and arguments as a list
+#   log_path - File receiving stdout and stderr, rotated by size (None to discard)
+#   on_line  - Optional callback on_line(stream, line), stream is 'stdout' or 'stderr'
+#   cpu_set  - Optional list of CPUs the process (and its children) are pinned to
+#
+class ProcessRunner(object):
+
+    def __init__(self, argv, log_path=None, on_line=None, env=None, cwd=None, cpu_set=None,
+                 max_log_bytes=MAX_LOG_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.argv = [str(x) for x in argv]
+        self.log_path = log_path
+        self.on_line = on_line
+        self.env = env
+        self.cwd = cwd
+        self.cpu_set = cpu_set
+        self.max_log_bytes = max_log_bytes
+        self.backup_count = backup_count
+
+        self.proc = None
+        self.pid = None
+        self.log = None
+        self.readers = []
+        self.returncode = None
+        self.rusage = None
+        self.start_time = None
+        self.end_time = None
+        self.done = threading.Event()
+
+    ########################################################################################
+    # start - Launch the process in its own session (so its whole process group can be
+    #   signalled) and start streaming its output
+    #
+    def start(self):
+        if self.log_path:
+            self.log = RotatingLog(self.log_path, self.max_log_bytes, self.backup_count)
+        self.start_time = time.time()
+        with open(os.devnull, 'rb') as devnull:
+            self.proc = subprocess.Popen(self.argv, stdin=devnull, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, env=self.env, cwd=self.cwd,
+                                         preexec_fn=self.setup_child, close_fds=True)
+        self.pid = self.proc.pid
+        for name, pipe in (('stdout', self.proc.stdout), ('stderr', self.proc.stderr)):
+            t = threading.Thread(target=self.stream_output, args=(name, pipe), name='runner-%s' % name)
+            t.daemon = True
+            t.start()
+            self.readers.append(t)
+        return self
+
+    ########################################################################################
+    # setup_child - Runs in the child before exec: own session, CPU affinity
+    #
+    def setup_child(self):
+        os.setsid()
+        if self.cpu_set:
+            os.sched_setaffinity(0, self.cpu_set)
+
+    ########################################################################################
+    # stream_output - Reader thread: copy one pipe to the log, line by line
+    #
+    def stream_output(self, name, pipe):
+        for line in iter(pipe.readline, b''):
+            if self.log:
+                self.log.write(line)
+            if self.on_line:
+                try:
+                    self.on_line(name, line.decode('utf-8', 'replace').rstrip('\n'))
+                except Exception:
+                    pass    # A broken callback must not stop the log capture
+        pipe.close()
+
+    ########################################################################################
+    # wait - Reap the process, collecting its resource usage, and drain its output.
+    #   Returns the exit code (negative signal number if killed, like Popen)
+    #
+    def wait(self):
+        pid, status, self.rusage = os.wait4(self.pid, 0)
+        self.end_time = time.time()
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        self.proc.returncode = self.returncode      # Keep Popen from waiting on it again
+        self.done.set()
+
+        for t in self.readers:
+            t.join(READER_JOIN_TIMEOUT_SECS)
+        if self.log:
+            self.log.close()
+        return self.returncode
+
+    ########################################################################################
+    # poll - Exit code if the process has been reaped by wait(), otherwise None. Safe to
+    #   call from other threads while wait() is blocked
+    #
+    def poll(self):
+        return self.returncode if self.done.is_set() else None
+
+    ########################################################################################
+    # get_live_usage - CPU seconds and RSS of the running process, or None
+    #
+    def get_live_usage(self):
+        if self.done.is_set():
+            return None
+        return read_proc_usage(self.pid)
+
+    ########################################################################################
+    # get_usage_report - Resource usage of the completed run
+    #
+    def get_usage_report(self):
+        if not self.rusage:
+            return None
+        wall = self.end_time - self.start_time
+        cpu = self.rusage.ru_utime + self.rusage.ru_stime
+        return {
+            'argv0': self.argv[0],
+            'exit_code': self.returncode,
+            'wall_seconds': round(wall, 3),
+            'user_cpu_seconds': round(self.rusage.ru_utime, 3),
+            'system_cpu_seconds': round(self.rusage.ru_stime, 3),
+            'avg_cpu_cores': round(cpu / wall, 2) if wall else None,
+            'peak_rss_kb': self.rusage.ru_maxrss,
+            'major_page_faults': self.rusage.ru_majflt,
+            'block_input_ops': self.rusage.ru_inblock,
+            'block_output_ops': self.rusage.ru_oublock,
+            'voluntary_ctx_switches': self.rusage.ru_nvcsw,
+            'involuntary_ctx_switches': self.rusage.ru_nivcsw
+        }
+
+
+########################################################################################
+# run_process - Run argv to completion with output streamed to log_path / on_line.
+#   Returns (exit code, usage report)
+#
+def run_process(argv, log_path=None, on_line=None, env=None, cwd=None):
+    runner = ProcessRunner(argv, log_path=log_path, on_line=on_line, env=env, cwd=cwd).start()
+    exit_code = runner.wait()
+    return exit_code, runner.get_usage_report()
@@ -0,0 +1,191 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# DRAGEN reference hash table stager. Knows the layout of a DRAGEN reference directory
+# so that small metadata files are fetched first, the multi-GB tables get the most
+# parallel bandwidth, and optional artifacts not used by the current command line are
+# skipped altogether. Files already present locally with the right size are not
+# downloaded again, so staging a reference that is (partially) on disk is cheap.
+#
+
+from __future__ import division
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from boto3.s3.transfer import TransferConfig
+
+from . import aws_utils as aws
+from . import compressed_ref
+from . import local_fs
+
+# CONSTANTS ....
+SMALL_FILE_BYTES = 64 * 1024 * 1024     # Files below this size are staged first
+SMALL_FILE_THREAD_COUNT = 16
+DECOMPRESS_THREAD_COUNT = max(1, (os.cpu_count() or 2) // 2)   # Large .zst files decompressed at once
+LARGE_FILE_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=64 * 1024 * 1024,
+    max_concurrency=32,
+    io_chunksize=2 * 1024 * 1024)
+
+# Files (relative to the reference directory) that DRAGEN reads before anything else
+METADATA_FILES = ['hash_table.cfg', 'hash_table.cfg.bin', 'ref_index.bin', 'reference.bin']
+
+# Optional artifacts: relative path prefix -> (option, values enabling it). The artifact is
+# only staged when the option is present on the Dragen command line with one of the values
+OPTIONAL_ARTIFACTS = {
+    'kmer_cnv.bin': ('--enable-cnv', ['true', '1']),
+    'anchored_rna/': ('--enable-rna', ['true', '1']),
+}
+
+# Artifacts written while building the hash table that DRAGEN never reads at run time
+BUILD_ONLY_ARTIFACTS = ['hash_table_stats.txt', 'streaming_log']
+
+
+########################################################################################
+# get_option_value - Return the (lower cased) value following option in dragen_args,
+#   or None if the option is not present
+#
+def get_option_value(dragen_args, option):
+    for idx, arg in enumerate(dragen_args):
+        if arg == option and idx + 1 < len(dragen_args):
+            return dragen_args[idx + 1].lower()
+        if arg.startswith(option + '='):
+            return arg.split('=', 1)[1].lower()
+    return None
+
+
+########################################################################################
+# classify_ref_file - Classify a file of the reference directory for the given command
+#   dragen_args - Dragen command line, or None to stage every optional artifact
+#   Returns one of 'metadata', 'skip', 'small' or 'large'
+#
+def classify_ref_file(rel_path, size, dragen_args):
+    for artifact in BUILD_ONLY_ARTIFACTS:
+        if rel_path.startswith(artifact):
+            return 'skip'
+
+    for artifact, (option, values) in OPTIONAL_ARTIFACTS.items():
+        if dragen_args is not None and rel_path.startswith(artifact) \
+                and get_option_value(dragen_args, option) not in values:
+            return 'skip'
+
+    if rel_path in METADATA_FILES and size < SMALL_FILE_BYTES:
+        return 'metadata'
+    if size < SMALL_FILE_BYTES:
+        return 'small'
+    return 'large'
+
+
+########################################################################################
+# plan_ref_staging - List the reference prefix and build the staging plan
+#   Returns dict: {'metadata': [...], 'small': [...], 'large': [...], 'skip': [...]}
+#   with each entry a S3 object info dict ('Key', 'Size', ...), large files largest first
+#
+def plan_ref_staging(bucket, ref_prefix, dragen_args, region='us-east-1', nosign=False):
+    ref_prefix = ref_prefix.rstrip('/') + '/'
+    plan = {'metadata': [], 'small': [], 'large': [], 'skip': []}
+    for obj in aws.s3_list_objects(bucket, ref_prefix, region=region, nosign=nosign):
+        if obj['Key'].endswith('/'):
+            continue
+        # Per-file zstd objects are classified by their decompressed name
+        rel_path = compressed_ref.strip_compressed_suffix(obj['Key'][len(ref_prefix):])
+        plan[classify_ref_file(rel_path, obj['Size'], dragen_args)].append(obj)
+
+    plan['metadata'].sort(key=lambda x: METADATA_FILES.index(
+        compressed_ref.strip_compressed_suffix(x['Key'][len(ref_prefix):])))
+    plan['small'].sort(key=lambda x: x['Size'])
+    plan['large'].sort(key=lambda x: x['Size'], reverse=True)
+    return plan
+
+
+########################################################################################
+# stage_ref_tables - Download the DRAGEN reference directory bucket/ref_prefix to
+#   tgt_dir + ref_prefix using the layout-aware plan. dragen_args=None stages every
+#   optional artifact (i.e. node prefetch). Returns the staging report:
+#   {'needed': [<rel paths>], 'skipped': [<rel paths>], 'bytes': <bytes downloaded>,
+#    'seconds': <float>}
+#
+def stage_ref_tables(bucket, ref_prefix, tgt_dir, dragen_args, region='us-east-1', nosign=False,
+                     logger=None):
+    start_time = time.time()
+    ref_prefix = ref_prefix.rstrip('/') + '/'
+    plan = plan_ref_staging(bucket, ref_prefix, dragen_args, region=region, nosign=nosign)
+    client = aws.s3_create_client(region, nosign)    # Shared by all download threads
+
+    def to_req(obj):
+        return {
+            'bucket': bucket,
+            'obj_key': obj['Key'],
+            'tgt_path': tgt_dir.rstrip('/') + '/' + compressed_ref.strip_compressed_suffix(obj['Key']),
+            'region': region
+        }
+
+    def download(obj, config=None):
+        req = to_req(obj)
+        if compressed_ref.is_zstd_key(obj['Key']):
+            # Skip if already decompressed by an earlier job on this host
+            if os.path.isfile(req['tgt_path']):
+                return 0
+            return compressed_ref.s3_download_decompress(bucket, obj['Key'], req['tgt_path'],
+                                                         region=region, nosign=nosign, client=client,
+                                                         make_dir=False)
+        # Skip if already staged by an earlier job on this host
+        if os.path.isfile(req['tgt_path']) and os.path.getsize(req['tgt_path']) == obj['Size']:
+            return 0
+        return aws.s3_download_file(req, nosign=nosign, config=config, client=client, make_dir=False)
+
+    # Create every target directory once up front
+    needed = plan['metadata'] + plan['small'] + plan['large']
+    local_fs.make_parent_dirs(to_req(x)['tgt_path'] for x in needed)
+
+    tot_bytes = 0
+
+    # 1. Metadata DRAGEN reads first, then 2. the remaining small files, in parallel
+    pool = ThreadPool(SMALL_FILE_THREAD_COUNT)
+    try:
+        for phase in ('metadata', 'small'):
+            results = pool.map(download, plan[phase])
+            tot_bytes += sum(results)
+            if logger:
+                logger.log('Staged %d %s reference files (%d bytes)' % (len(results), phase, sum(results)))
+    finally:
+        pool.close()
+        pool.join()
+
+    # 3. Large tables, largest first. Raw files one at a time, each with all of the transfer
+    #    concurrency. Compressed files are decompressed several at a time, since a single
+    #    zstd stream decompresses on one core
+    large_zstd = [x for x in plan['large'] if compressed_ref.is_zstd_key(x['Key'])]
+    pool = ThreadPool(DECOMPRESS_THREAD_COUNT)
+    try:
+        zstd_results = pool.map_async(download, large_zstd)
+        for obj in plan['large']:
+            if obj in large_zstd:
+                continue
+            tot_bytes += download(obj, config=LARGE_FILE_CONFIG)
+            if logger:
+                logger.log('Staged large reference file %s (%d bytes)' % (obj['Key'], obj['Size']))
+        tot_bytes += sum(zstd_results.get())
+    finally:
+        pool.close()
+        pool.join()
+
+    return {
+        'needed': [compressed_ref.strip_compressed_suffix(x['Key'][len(ref_prefix):]) for x in needed],
+        'skipped': [compressed_ref.strip_compressed_suffix(x['Key'][len(ref_prefix):]) for x in plan['skip']],
+        'bytes': tot_bytes,
+        'seconds': round(time.time() - start_time, 3)
+    }
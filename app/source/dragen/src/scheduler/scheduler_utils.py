@@ -16,12 +16,10 @@
 
 from __future__ import print_function
 
+import importlib
 import os
 from datetime import datetime
 
-from dateutil import parser
-from dateutil import tz
-
 
 ########################################################################################
 # parse_iso_datetime_string - Parse and input string that is in ISO-8601 format, i.e.
@@ -30,6 +28,7 @@ from dateutil import tz
 # Returns datetime object
 #
 def parse_iso_datetime_string(dts):
+    from dateutil import parser
     return parser.parse(dts)
 
 
@@ -40,6 +39,8 @@ def parse_iso_datetime_string(dts):
 # Returns the age of utc string in seconds
 #
 def get_age_of_utc_string_in_secs(dts):
+    from dateutil import tz
+
     # First get the current datetime with explicit TZD=0 (since parser result is TZ aware)
     utc_date = datetime.now(tz.tzoffset(None, 0))
 
@@ -81,6 +82,8 @@ def localtime_to_utc(localtime):
     if len(localtime) == 0 or localtime == 'Unknown':
         return ""
 
+    from dateutil import tz
+
     ltime = datetime.strptime(localtime, '%Y-%m-%dT%H:%M:%S')
 
     local_timezone = tz.tzlocal()
@@ -99,3 +102,21 @@ def seconds_to_hr_min_sec(secs):
     m, s = divmod(secs, 60)
     h, m = divmod(m, 60)
     return "%d:%02d:%02d" % (h, m, s)
+
+
+########################################################################################
+# LazyModule - Stand-in for a module that is only imported on first attribute access,
+#   so that entry points do not pay for heavy imports (boto3, requests) on the paths
+#   that never use them. i.e. aws = LazyModule('scheduler.aws_utils')
+#
+class LazyModule(object):
+
+    def __init__(self, name, package=None):
+        self._name = name
+        self._package = package
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name, self._package)
+        return getattr(self._module, attr)
@@ -0,0 +1,516 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Node-local staging daemon shared by all Dragen job containers running on one host.
+# Requests are served over a unix socket under /ephemeral (bind mounted into every job
+# container). Concurrent requests for the same S3 object/prefix or URL are merged into a
+# single transfer, and the data is kept in a shared content cache from which it is
+# hard-linked into each requester's target path.
+#
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from . import http_transfer as http
+from . import local_fs
+from . import scheduler_utils as utils
+
+# boto3 is only needed by the daemon itself, not by the clients of the socket
+aws = utils.LazyModule('.aws_utils', __package__)
+
+# CONSTANTS ....
+DEFAULT_SOCKET_PATH = '/ephemeral/.d_haul/stage.sock'
+DEFAULT_CACHE_DIR = '/ephemeral/.d_haul/cache/'
+CACHE_INDEX_FILE = 'index.json'
+SOCKET_ENV_VAR = 'D_HAUL_STAGE_SOCKET'
+OWNER_ENV_VAR = 'D_HAUL_STAGE_OWNER'
+CACHE_MAX_ENV_VAR = 'D_HAUL_CACHE_MAX_GB'
+DEFAULT_CACHE_MAX_FRACTION = 0.5        # Default cache size limit, as fraction of the volume
+CLIENT_TIMEOUT_SECS = 6 * 3600          # Reference downloads can take a long time
+DIR_DOWNLOAD_THREAD_COUNT = 8
+
+
+########################################################################################
+# get_socket_path - Return the daemon socket path if the daemon appears to be running,
+#   i.e. the socket file exists. Otherwise return None
+#
+def get_socket_path(socket_path=None):
+    if not socket_path:
+        socket_path = os.environ.get(SOCKET_ENV_VAR, DEFAULT_SOCKET_PATH)
+    if os.path.exists(socket_path):
+        return socket_path
+    return None
+
+
+########################################################################################
+# get_owner_id - Return the identifier used to reference count cache entries for the
+#   current job. Set once by dragen_qs and inherited by all d_haul sub-processes
+#
+def get_owner_id():
+    owner = os.environ.get(OWNER_ENV_VAR)
+    if not owner:
+        owner = os.environ.get('AWS_BATCH_JOB_ID', 'pid-%d' % os.getpid())
+    return owner
+
+
+########################################################################################
+# stage_request - Send one JSON request to the staging daemon and return the decoded reply
+#   Raises IOError (socket.error) if the daemon can not be reached
+#
+def stage_request(req, socket_path=None, timeout=CLIENT_TIMEOUT_SECS):
+    if not socket_path:
+        socket_path = get_socket_path()
+    if not socket_path:
+        raise IOError('Staging daemon socket not found')
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(req) + '\n').encode('utf-8'))
+        fd = sock.makefile('rb')
+        line = fd.readline()
+        fd.close()
+    finally:
+        sock.close()
+
+    if not line:
+        raise IOError('Staging daemon closed connection without a reply')
+    return json.loads(line.decode('utf-8'))
+
+
+########################################################################################
+# StageCache - Shared content cache with per-owner reference counting. Entries are keyed
+# by source ('s3://bucket/key', 's3://bucket/prefix/' or the URL without query string).
+# When the cache grows beyond max_bytes, unreferenced entries are evicted LRU first
+#
+class StageCache(object):
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=None):
+        self.cache_dir = cache_dir.rstrip('/') + '/'
+        self.index_path = self.cache_dir + CACHE_INDEX_FILE
+        self.lock = threading.Lock()
+        self.entries = {}
+        utils.check_create_dir(self.cache_dir)
+        if max_bytes is None:
+            max_bytes = get_default_cache_max_bytes(self.cache_dir)
+        self.max_bytes = max_bytes
+        self.load_index()
+
+    ########################################################################################
+    # load_index - Load the persisted index, dropping entries whose data has disappeared
+    #
+    def load_index(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+        for src, entry in entries.items():
+            if os.path.exists(entry['path']):
+                # Owners from a previous daemon instance are gone
+                entry['owners'] = {}
+                self.entries[src] = entry
+
+    ########################################################################################
+    # save_index - Persist the index atomically. Caller must hold self.lock
+    #
+    def save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp_path, self.index_path)
+
+    ########################################################################################
+    # cache_path - Local path in the cache for the given source
+    #
+    def cache_path(self, src):
+        if src.startswith('s3://'):
+            return self.cache_dir + 's3/' + src[len('s3://'):]
+        digest = hashlib.sha1(src.encode('utf-8')).hexdigest()[:16]
+        return self.cache_dir + 'url/' + digest + '/' + src.rstrip('/').split('/')[-1]
+
+    ########################################################################################
+    # lookup - Return the cache entry for the source, or None
+    #
+    def lookup(self, src):
+        with self.lock:
+            return self.entries.get(src)
+
+    ########################################################################################
+    # insert - Add (or refresh) a completed entry and take a reference on it for the owner,
+    #   so that it can not be evicted before the owner has linked it into place
+    #
+    def insert(self, src, path, size, owner):
+        with self.lock:
+            entry = self.entries.get(src, {'owners': {}})
+            entry.update({'path': path, 'size': size, 'last_used': time.time()})
+            entry['owners'][owner] = entry['owners'].get(owner, 0) + 1
+            self.entries[src] = entry
+            self.save_index()
+        return entry
+
+    ########################################################################################
+    # acquire - Take a reference on the entry for the given owner. Returns the entry, or
+    #   None if the source is not in the cache
+    #
+    def acquire(self, src, owner):
+        with self.lock:
+            entry = self.entries.get(src)
+            if not entry:
+                return None
+            entry['owners'][owner] = entry['owners'].get(owner, 0) + 1
+            entry['last_used'] = time.time()
+            self.save_index()
+        return entry
+
+    ########################################################################################
+    # release - Drop all references held by the owner. Returns number of entries released
+    #
+    def release(self, owner):
+        count = 0
+        with self.lock:
+            for entry in self.entries.values():
+                if entry['owners'].pop(owner, None):
+                    count += 1
+            self.save_index()
+        self.trim()
+        return count
+
+    ########################################################################################
+    # evict - Remove an unreferenced entry and its data. Returns bytes freed
+    #
+    def evict(self, src):
+        with self.lock:
+            entry = self.entries.get(src)
+            if not entry or entry['owners']:
+                return 0
+            del self.entries[src]
+            self.save_index()
+        if os.path.isdir(entry['path']):
+            shutil.rmtree(entry['path'], ignore_errors=True)
+        elif os.path.exists(entry['path']):
+            os.remove(entry['path'])
+        return entry['size']
+
+    ########################################################################################
+    # evict_lru - Evict unreferenced entries, least recently used first, until at least
+    #   nbytes have been freed. Returns bytes freed
+    #
+    def evict_lru(self, nbytes):
+        with self.lock:
+            candidates = sorted([(x['last_used'], src) for src, x in self.entries.items() if not x['owners']])
+        freed = 0
+        for last_used, src in candidates:
+            if freed >= nbytes:
+                break
+            freed += self.evict(src)
+        return freed
+
+    ########################################################################################
+    # trim - Evict unreferenced entries until the cache fits in max_bytes again. Entries
+    #   still referenced are kept, so the cache may stay above the limit while they are
+    #   in use. Returns bytes freed
+    #
+    def trim(self):
+        with self.lock:
+            excess = sum(x['size'] for x in self.entries.values()) - self.max_bytes
+        if excess <= 0:
+            return 0
+        return self.evict_lru(excess)
+
+    ########################################################################################
+    # stats - Summary of the cache contents
+    #
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': sum(x['size'] for x in self.entries.values()),
+                'max_bytes': self.max_bytes,
+                'referenced': len([x for x in self.entries.values() if x['owners']])
+            }
+
+
+########################################################################################
+# get_default_cache_max_bytes - Cache size limit: $D_HAUL_CACHE_MAX_GB if set, otherwise
+#   DEFAULT_CACHE_MAX_FRACTION of the volume holding the cache
+#
+def get_default_cache_max_bytes(cache_dir):
+    if os.environ.get(CACHE_MAX_ENV_VAR):
+        return int(float(os.environ[CACHE_MAX_ENV_VAR]) * 1024 ** 3)
+    st = os.statvfs(cache_dir)
+    return int(st.f_blocks * st.f_frsize * DEFAULT_CACHE_MAX_FRACTION)
+
+
+########################################################################################
+# link_into_place - Hard link a cached file or directory tree to the target path, falling
+#   back to a copy if the target is on a different filesystem
+#
+def link_into_place(cache_path, tgt_path):
+    if os.path.isdir(cache_path):
+        links = [(path, os.path.join(tgt_path, os.path.relpath(path, cache_path)))
+                 for path, _ in local_fs.scan_files(cache_path, include_hidden=True)]
+        local_fs.make_parent_dirs([tgt_path.rstrip('/') + '/.'] + [x[1] for x in links])
+        for src, tgt in links:
+            link_into_place(src, tgt)
+        return
+
+    utils.check_create_dir(os.path.dirname(tgt_path) or '.')
+    if os.path.exists(tgt_path):
+        if os.path.samefile(cache_path, tgt_path):
+            return
+        os.remove(tgt_path)
+    try:
+        os.link(cache_path, tgt_path)
+    except OSError:
+        shutil.copy2(cache_path, tgt_path)
+
+
+########################################################################################
+# get_tree_size - Size in bytes of a file or all files below a directory
+#
+def get_tree_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(st.st_size for _, st in local_fs.scan_files(path, include_hidden=True))
+
+
+########################################################################################
+# download_url - Download the given URL to a local file over the daemon's pooled
+#   keep-alive connections, in parallel byte ranges if large. Returns the number of
+#   bytes written
+#
+def download_url(url, tgt_path):
+    return http.download_url(url, tgt_path, http.DEFAULT_THREAD_COUNT)
+
+
+########################################################################################
+# StageDaemon - Serves staging requests, merging concurrent transfers of the same source
+#
+class StageDaemon(object):
+
+    def __init__(self, logger, socket_path=DEFAULT_SOCKET_PATH, cache_dir=DEFAULT_CACHE_DIR,
+                 cache_max_bytes=None):
+        self.logger = logger
+        self.socket_path = socket_path
+        self.cache = StageCache(cache_dir, max_bytes=cache_max_bytes)
+        self.inflight_lock = threading.Lock()
+        self.inflight = {}      # src -> threading.Event set when the transfer completes
+        self.server = None
+
+    ########################################################################################
+    # fetch - Make sure the source is in the cache, performing at most one transfer per
+    #   source regardless of how many requests arrive concurrently. The owner's reference
+    #   is taken together with the lookup or insert, so the entry can not be evicted by
+    #   other requests before it is linked. Returns (cache entry, cached)
+    #
+    def fetch(self, src, req, owner):
+        while True:
+            entry = self.cache.acquire(src, owner)
+            if entry:
+                return entry, True
+
+            with self.inflight_lock:
+                event = self.inflight.get(src)
+                if not event:
+                    event = threading.Event()
+                    self.inflight[src] = event
+                    break
+
+            # Someone else is already transferring this source - wait and re-check cache
+            self.logger.log('Waiting for in-flight transfer of %s' % src)
+            event.wait()
+            if not self.cache.lookup(src):
+                raise IOError('In-flight transfer of %s failed' % src)
+
+        cache_path = self.cache.cache_path(src)
+        try:
+            self.logger.log('Transferring %s to cache %s' % (src, cache_path))
+            try:
+                size = self.transfer(req, cache_path)
+                if not size:
+                    raise IOError('Could not download %s' % src)
+            except Exception:
+                # Do not leave a partial tree for the next request to pick up
+                if os.path.isdir(cache_path):
+                    shutil.rmtree(cache_path, ignore_errors=True)
+                elif os.path.exists(cache_path):
+                    os.remove(cache_path)
+                raise
+            entry = self.cache.insert(src, cache_path, size, owner)
+        finally:
+            with self.inflight_lock:
+                del self.inflight[src]
+            event.set()
+        return entry, False
+
+    ########################################################################################
+    # transfer - Perform the actual download into the cache path
+    #
+    def transfer(self, req, cache_path):
+        nosign = req.get('nosign', False)
+        if req.get('url'):
+            return download_url(req['url'], cache_path)
+        if req['key'].endswith('/') or req.get('dir'):
+            return self.transfer_dir(req, cache_path)
+        obj_info = {
+            "bucket": req['bucket'],
+            "obj_key": req['key'],
+            "tgt_path": cache_path,
+            "region": req.get('region', 'us-east-1')
+        }
+        return aws.s3_download_file(obj_info, nosign=nosign, priority=req.get('priority', aws.PRIORITY_INPUT))
+
+    ########################################################################################
+    # transfer_dir - Download every object below the prefix (paginated listing) into the
+    #   cache path, sharing one S3 client between the download threads
+    #
+    def transfer_dir(self, req, cache_path):
+        region = req.get('region', 'us-east-1')
+        nosign = req.get('nosign', False)
+        priority = req.get('priority', aws.PRIORITY_INPUT)
+        prefix = req['key'].rstrip('/') + '/'
+        client = aws.s3_create_client(region, nosign)
+        objects = [x for x in aws.s3_list_objects(req['bucket'], prefix, region=region, nosign=nosign)
+                   if not x['Key'].endswith('/')]
+
+        reqs = [{
+            'bucket': req['bucket'],
+            'obj_key': x['Key'],
+            'tgt_path': cache_path.rstrip('/') + '/' + x['Key'][len(prefix):],
+            'region': region
+        } for x in objects]
+        local_fs.make_parent_dirs(x['tgt_path'] for x in reqs)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(DIR_DOWNLOAD_THREAD_COUNT)
+        try:
+            pool.map(lambda x: aws.s3_download_file(x, nosign=nosign, client=client, priority=priority,
+                                                    make_dir=False), reqs)
+        finally:
+            pool.close()
+            pool.join()
+        return get_tree_size(cache_path) if reqs else 0
+
+    ########################################################################################
+    # handle_download - Stage the source into the cache and link it to the target path
+    #
+    def handle_download(self, req):
+        if req.get('url'):
+            src = req['url'].split('?')[0]
+        elif req.get('dir') and not req['key'].endswith('/'):
+            src = 's3://%s/%s/' % (req['bucket'], req['key'])
+        else:
+            src = 's3://%s/%s' % (req['bucket'], req['key'])
+
+        entry, cached = self.fetch(src, req, req.get('owner', 'anonymous'))
+        # Make room for the new entry now that it is referenced and can not be evicted itself
+        self.cache.trim()
+
+        if req.get('path'):
+            link_into_place(entry['path'], req['path'])
+        return {'status': 'ok', 'size': entry['size'], 'cached': cached, 'cache_path': entry['path']}
+
+    ########################################################################################
+    # handle_request - Dispatch a decoded request and return the reply dict
+    #
+    def handle_request(self, req):
+        op = req.get('op')
+        try:
+            if op == 'download':
+                return self.handle_download(req)
+            elif op == 'release':
+                return {'status': 'ok', 'released': self.cache.release(req['owner'])}
+            elif op == 'evict':
+                return {'status': 'ok', 'freed': self.cache.evict(req['src'])}
+            elif op == 'evict_lru':
+                return {'status': 'ok', 'freed': self.cache.evict_lru(req['bytes'])}
+            elif op == 'stats':
+                reply = self.cache.stats()
+                reply['status'] = 'ok'
+                return reply
+            return {'status': 'error', 'error': 'Unknown op %s' % op}
+        except Exception as e:
+            self.logger.error('Request %s failed: %s' % (json.dumps(req), str(e)))
+            return {'status': 'error', 'error': str(e)}
+
+    ########################################################################################
+    # prefetch - Stage a list of known references (s3://bucket/prefix/ URLs) into the cache
+    #   in the background so that the first job on the host finds them warm
+    #
+    def prefetch(self, s3_urls):
+        def prefetch_one(s3_url):
+            path = s3_url[len('s3://'):]
+            bucket, key = path.split('/', 1)
+            # Background priority - gives way to the inputs of running jobs
+            req = {'op': 'download', 'bucket': bucket, 'key': key, 'dir': True, 'owner': 'prefetch',
+                   'priority': aws.PRIORITY_PREFETCH}
+            reply = self.handle_request(req)
+            self.cache.release('prefetch')
+            self.logger.log('Prefetch of %s: %s' % (s3_url, json.dumps(reply)))
+
+        for s3_url in s3_urls:
+            t = threading.Thread(target=prefetch_one, args=(s3_url,))
+            t.daemon = True
+            t.start()
+
+    ########################################################################################
+    # serve_forever - Bind the unix socket and serve requests, one thread per connection
+    #
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    return
+                try:
+                    req = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    reply = {'status': 'error', 'error': 'Malformed request'}
+                else:
+                    reply = daemon.handle_request(req)
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        utils.check_create_dir(os.path.dirname(self.socket_path))
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.server = Server(self.socket_path, Handler)
+        os.chmod(self.socket_path, 0o777)
+        self.logger.log('Staging daemon listening on %s (cache %s)' % (self.socket_path, self.cache.cache_dir))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
@@ -0,0 +1,461 @@
+#!/opt/workflow/python/bin/python2.7
+#
+# Copyright 2013-2018 Edico Genome Corporation. All rights reserved.
+#
+# This file contains confidential and proprietary information of the Edico Genome
+# Corporation and is protected under the U.S. and international copyright and other
+# intellectual property laws.
+#
+# $Id$
+# $Author$
+# $Change$
+# $DateTime$
+#
+# Transfer API behind the d_haul utility: download from S3 or a URL (through the
+# node-local staging daemon when one is running), import a URL into S3 and upload to S3.
+# dragen_qs calls it in-process; the d_haul script is a thin command line wrapper.
+# Every transfer returns a TransferResult, and failures raise TransferError.
+#
+
+from __future__ import division
+
+import datetime
+import json
+import os
+import tempfile
+import time
+from urllib.parse import unquote
+
+from . import http_transfer as http
+from . import local_fs
+from . import scheduler_utils as utils
+from . import stage_daemon as stage
+
+# boto3 is only loaded by the transfers that need it
+aws = utils.LazyModule('.aws_utils', __package__)
+compressed_ref = utils.LazyModule('.compressed_ref', __package__)
+pack_archive = utils.LazyModule('.pack_archive', __package__)
+
+# CONSTANTS ....
+DEFAULT_WORK_DIR = '/staging/tmp'
+MANIFEST_FILE_NAME = 'manifest.json'
+
+# Compressed uploads: files of a directory worth compressing, i.e. Dragen logs and metrics
+COMPRESS_SUFFIXES = ['.txt', '.log', '.csv', '.tsv', '.json', '.vcf', '.bed', '.sam']
+COMPRESS_MIN_BYTES = 64 * 1024
+COMPRESS_CONCURRENCY = 4        # Files compressed at once, the cores are shared between them
+
+
+########################################################################################
+# TransferError - A transfer did not complete
+#
+class TransferError(Exception):
+    pass
+
+
+########################################################################################
+# TransferResult - Outcome of one transfer
+#   op     - 'download', 'import' or 'upload'
+#   source - s3://bucket/key or URL transferred from (local path for uploads)
+#   path   - Local path (or s3:// destination for uploads and imports)
+#   nbytes - Bytes transferred
+#   via    - 'direct' or 'daemon' (served by the staging daemon)
+#   cached - True if the staging daemon served it from its cache
+#   objects - Uploads: aws.s3_object_record of every object written
+#
+class TransferResult(object):
+
+    def __init__(self, op, source, path, nbytes, seconds, via='direct', cached=False, objects=None):
+        self.op = op
+        self.source = source
+        self.path = path
+        self.nbytes = nbytes
+        self.seconds = seconds
+        self.via = via
+        self.cached = cached
+        self.objects = objects or []
+
+    @property
+    def mb_per_sec(self):
+        if not self.seconds:
+            return None
+        return self.nbytes / (1024 * 1024) / self.seconds
+
+    def to_dict(self):
+        return {'op': self.op, 'source': self.source, 'path': self.path, 'bytes': self.nbytes,
+                'seconds': round(self.seconds, 3), 'via': self.via, 'cached': self.cached}
+
+    def __repr__(self):
+        return 'TransferResult(%s %s -> %s, %d bytes in %.1fs via %s%s)' % (
+            self.op, self.source, self.path, self.nbytes, self.seconds, self.via, ', cached' if self.cached else '')
+
+
+class DHaul(object):
+
+    ########################################################################################
+    # constructor
+    #   logger       - scheduler.logger.Logger
+    #   work_dir     - Directory for URL downloads given no local path (and for imports)
+    #   nosign       - Anonymous S3 access (public buckets)
+    #   multipart    - Download URLs with parallel byte ranges
+    #   decompress   - Extract .tar.zst archives / decompress .zst objects on download
+    #   stage_socket - Staging daemon socket (default: environment, if the daemon runs)
+    #
+    def __init__(self, logger, work_dir=DEFAULT_WORK_DIR, nosign=False, multipart=False, decompress=False,
+                 stage_socket=None):
+
+        self.logger = logger
+
+        self.multipart_flag = multipart
+        self.nosign_flag = nosign
+        self.decompress_flag = decompress
+        self.work_dir = work_dir
+        self.download_dir = work_dir
+        self.file_name = None
+        self.download_full_path = None
+        self.download_len = 0
+        self.stage_socket = stage.get_socket_path(stage_socket)
+
+    ########################################################################################
+    # download_from_url - Download file from the specified URL to the pre-configured download dir
+    #   Returns the number of bytes downloaded (i.e. file size)
+    #
+    def download_from_url(self, url):
+        url_parts = url.split('?')
+        self.download_len = 0
+
+        # Get the file name from the URL
+        main_url = url_parts[0]
+        self.file_name = main_url.split('/')[-1]
+
+        # Since we are operating on a URL string, we should decode it to remove any percent encodings
+        self.file_name = unquote(self.file_name)
+
+        # Make sure the path exists for the target directory
+        utils.check_create_dir(self.download_dir)
+
+        # Configure the full path of the download file
+        self.download_full_path = self.download_dir + '/' + self.file_name
+
+        # Presigned and public URLs go through the shared keep-alive session of the process
+        thread_count = http.DEFAULT_THREAD_COUNT if self.multipart_flag else 1
+        try:
+            self.download_len = http.download_url(url, self.download_full_path, thread_count)
+        except IOError as e:
+            raise TransferError('Download of %s failed: %s' % (url.split('?')[0], str(e)))
+        return self.download_len
+
+    ########################################################################################
+    # import_url - Import a file from a URL to S3 bucket/key, through the work dir
+    #
+    def import_url(self, url, bucket, key):
+        self.logger.log('Starting d_haul import ...')
+        start_time = time.time()
+        self.download_dir = self.work_dir
+
+        # Download from source URL
+        file_size = self.download_from_url(url)
+        if not file_size:
+            raise TransferError('Could not properly download from %s' % url)
+
+        self.logger.log("Downloaded file with size=%s" % file_size)
+
+        # Upload to cloud S3 Bucket
+        try:
+            upload_size = aws.s3_upload(self.download_full_path, bucket, key)
+        finally:
+            try:
+                os.remove(self.download_full_path)
+            except OSError:
+                self.logger.error("Error deleting temporary file.")
+
+        if not upload_size:
+            raise TransferError('Could not upload file to S3!')
+
+        self.logger.log("Uploaded file to S3 with size=%s" % upload_size)
+        return TransferResult('import', url, 's3://%s/%s' % (bucket, key), upload_size, time.time() - start_time)
+
+    ########################################################################################
+    # download - Download locally from a URL, an S3 directory (path ending with '/') or an
+    #   S3 object (path to the target file)
+    #
+    def download(self, path, bucket=None, key=None, url=None):
+        self.logger.log('Starting d_haul download ...')
+        start_time = time.time()
+        source = url or 's3://%s/%s' % (bucket, key)
+
+        # Figure out if path is dir or object
+        if path.endswith('/'):
+            # Assume local path is directory, 'full' path is not used
+            self.download_dir = path
+            self.download_full_path = None
+        else:
+            # Assume local path points to absolute file location and source is a single object
+            # In this case the download_dir is not use (it is implicit in full path)
+            self.download_full_path = path
+            self.download_dir = None
+
+        # Use the node-local staging daemon if one is running, falling back to a direct transfer
+        if self.stage_socket and not self.decompress_flag:
+            try:
+                tot_size, cached = self.download_via_daemon(bucket, key, url)
+                if tot_size:
+                    self.logger.log("Downloaded %d bytes to location %s" % (tot_size, path))
+                    return TransferResult('download', source, path, tot_size, time.time() - start_time,
+                                          via='daemon', cached=cached)
+            except (IOError, OSError) as e:
+                self.logger.warning('Staging daemon unavailable (%s) - downloading directly' % str(e))
+
+        tot_size = self.download_direct(bucket, key, url)
+        if not tot_size:
+            raise TransferError('Could not properly download to %s' % path)
+
+        self.logger.log("Downloaded %d bytes to location %s" % (tot_size, path))
+        return TransferResult('download', source, path, tot_size, time.time() - start_time)
+
+    ########################################################################################
+    # download_direct - Download the source URL, S3 directory or S3 object in this process
+    #
+    def download_direct(self, bucket, key, url):
+        if url:
+            if not self.download_full_path:
+                # Download from source URL into the directory, keeping the URL file name
+                return self.download_from_url(url)
+
+            # Download from source URL and rename to the requested file
+            tgt_path = self.download_full_path
+            self.download_dir = os.path.dirname(tgt_path) or '.'
+            tot_size = self.download_from_url(url)
+            if tot_size and self.download_full_path != tgt_path:
+                os.rename(self.download_full_path, tgt_path)
+                self.download_full_path = tgt_path
+            return tot_size
+
+        if self.decompress_flag and compressed_ref.is_archive_key(key) and self.download_dir:
+            # Stream and extract a .tar.zst archive into <dir>/<key without suffix>/
+            tgt_dir = self.download_dir.rstrip('/') + '/' + compressed_ref.strip_compressed_suffix(key)
+            return compressed_ref.s3_download_extract(bucket, key, tgt_dir, nosign=self.nosign_flag)
+
+        if self.decompress_flag and compressed_ref.is_zstd_key(key) and self.download_full_path:
+            # Stream and decompress a single .zst object to the target file
+            return compressed_ref.s3_download_decompress(bucket, key, self.download_full_path,
+                                                         nosign=self.nosign_flag)
+
+        if self.decompress_flag and self.download_dir:
+            # Prefix of per-file objects - decompress each .zst object on the fly
+            return compressed_ref.s3_download_dir_decompress(bucket, key, self.download_dir,
+                                                             nosign=self.nosign_flag)
+
+        if self.download_dir:
+            # Call the full bucket download function
+            return aws.s3_download_dir(bucket, key, self.download_dir, nosign=self.nosign_flag)
+
+        # Assume we are only downloading one object
+        obj_info = {
+            "bucket": bucket,
+            "obj_key": key,
+            "tgt_path": self.download_full_path,
+            "region": "us-east-1"
+        }
+        return aws.s3_download_file(obj_info, nosign=self.nosign_flag)
+
+    ########################################################################################
+    # download_via_daemon - Ask the staging daemon to transfer the source (or find it in the
+    #   shared cache) and link it into the requested local path. Returns (bytes, cached)
+    #
+    def download_via_daemon(self, bucket, key, url):
+        req = {'op': 'download', 'owner': stage.get_owner_id(), 'nosign': self.nosign_flag}
+        if url:
+            file_name = unquote(url.split('?')[0].split('/')[-1])
+            req['url'] = url
+            req['path'] = self.download_full_path or self.download_dir.rstrip('/') + '/' + file_name
+        elif self.download_dir:
+            req.update({'bucket': bucket, 'key': key, 'dir': True,
+                        'path': self.download_dir.rstrip('/') + '/' + key.strip('/')})
+        else:
+            req.update({'bucket': bucket, 'key': key, 'path': self.download_full_path})
+
+        reply = stage.stage_request(req, self.stage_socket)
+        if reply['status'] != 'ok':
+            raise IOError(reply['error'])
+        self.logger.log('Staging daemon served %s (cached=%s)' % (req['path'], reply['cached']))
+        return reply['size'], reply['cached']
+
+    ########################################################################################
+    # upload - Upload a local file or directory to S3 bucket/key (used as prefix for a dir)
+    #   compress - Compress the file (or the COMPRESS_SUFFIXES files of the directory) with
+    #              zstd on the way, to <key>.zst
+    #   pack     - Pack the small files of the directory into one indexed archive object
+    #   manifest - Write MANIFEST_FILE_NAME describing the uploaded objects, last
+    #
+    def upload(self, path, bucket, key, compress=False, pack=False, manifest=False):
+        self.logger.log('Starting d_haul upload ...')
+        start_time = time.time()
+        objects = []
+        try:
+            tot_size = 0
+            packed = set()
+            if pack and os.path.isdir(path):
+                tot_size, packed = self.upload_pack(path, bucket, key, records=objects)
+            if compress:
+                tot_size += self.upload_compressed(path, bucket, key, exclude=packed, records=objects)
+            else:
+                tot_size += aws.s3_upload(path, bucket, key, exclude=packed, records=objects)
+        except ValueError as e:
+            raise TransferError(str(e))
+        self.logger.log("Uploaded %d bytes to S3" % tot_size)
+        result = TransferResult('upload', path, 's3://%s/%s' % (bucket, key), tot_size, time.time() - start_time,
+                                objects=objects)
+        if manifest:
+            prefix = key if os.path.isdir(path) or key.endswith('/') else key.rsplit('/', 1)[0]
+            self.upload_manifest(bucket, prefix, objects)
+        return result
+
+    ########################################################################################
+    # upload_manifest - Write the manifest of a set of uploaded objects to
+    #   <prefix>/MANIFEST_FILE_NAME, i.e. once all the outputs of a job are uploaded, so
+    #   that consumers get everything from one GET and know the upload is complete
+    #   objects - aws.s3_object_record of each object
+    #   fields  - Extra top level fields, i.e. the job exit code
+    #
+    def upload_manifest(self, bucket, prefix, objects, **fields):
+        start_time = time.time()
+        manifest = dict(fields)
+        manifest.update({
+            'version': 1,
+            'created': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'bucket': bucket,
+            'object_count': len(objects),
+            'total_bytes': sum(x['size'] for x in objects),
+            'objects': sorted(objects, key=lambda x: x['key'])
+        })
+        manifest_key = prefix.rstrip('/') + '/' + MANIFEST_FILE_NAME
+
+        # A single PUT, so the manifest appears complete or not at all
+        fd, tmp_path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            tot_size = aws.s3_upload(tmp_path, bucket, manifest_key)
+        finally:
+            os.remove(tmp_path)
+        self.logger.log('Wrote manifest of %d objects to s3://%s/%s' % (len(objects), bucket, manifest_key))
+        return TransferResult('upload', MANIFEST_FILE_NAME, 's3://%s/%s' % (bucket, manifest_key), tot_size,
+                              time.time() - start_time)
+
+    ########################################################################################
+    # upload_compressed - Upload with the eligible files compressed on the fly: each is
+    #   read through a multi-threaded zstd compressor straight into a multipart upload, so
+    #   no compressed copy is written to disk. Other files are uploaded as they are.
+    #   exclude - Files of the directory not to upload (i.e. already packed)
+    #   records - Optional list to append the aws.s3_object_record of each object to
+    #   Returns the number of bytes uploaded
+    #
+    def upload_compressed(self, path, bucket, key, exclude=None, records=None):
+        exclude = exclude or set()
+        if os.path.isfile(path):
+            files = [path]
+        elif os.path.isdir(path):
+            files = [x for x, st in local_fs.scan_files(path)
+                     if os.path.splitext(x)[1].lower() in COMPRESS_SUFFIXES
+                     and x not in exclude and st.st_size >= COMPRESS_MIN_BYTES]
+        else:
+            raise ValueError('{0} MUST be either a file or a directory'.format(path))
+
+        client = aws.s3_create_client(aws.s3_get_bucket_region(bucket))
+        threads = max(1, (os.cpu_count() or 1) // min(COMPRESS_CONCURRENCY, len(files) or 1))
+
+        def upload_file(file_path):
+            # Same key layout as aws.s3_upload
+            obj_key = key
+            if os.path.isdir(path) or key.endswith('/'):
+                obj_key = key.rstrip('/') + '/' + os.path.basename(file_path)
+            return compressed_ref.s3_upload_compress(file_path, bucket, obj_key + compressed_ref.ZSTD_SUFFIX,
+                                                     threads=threads, client=client, records=records)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(COMPRESS_CONCURRENCY)
+        try:
+            compressed_size = sum(pool.map(upload_file, files))
+        finally:
+            pool.close()
+            pool.join()
+
+        raw_size = sum(os.path.getsize(x) for x in files)
+        self.logger.log('Compressed %d files from %d to %d bytes on upload' % (len(files), raw_size, compressed_size))
+        if os.path.isfile(path):
+            return compressed_size
+        return compressed_size + aws.s3_upload(path, bucket, key, exclude=exclude | set(files), records=records)
+
+    ########################################################################################
+    # upload_pack - Upload the small files of the directory as one indexed archive object,
+    #   <key>/pack_archive.PACK_FILE_NAME. Returns (bytes uploaded, set of packed files)
+    #
+    def upload_pack(self, path, bucket, key, records=None):
+        files = pack_archive.find_small_files(path)
+        if len(files) < 2:
+            return 0, set()
+        pack_key = key.rstrip('/') + '/' + pack_archive.PACK_FILE_NAME
+        tot_size = pack_archive.s3_upload_pack(path, files, bucket, pack_key, records=records)
+        self.logger.log('Packed %d small files into s3://%s/%s' % (len(files), bucket, pack_key))
+        return tot_size, set(files)
+
+    ########################################################################################
+    # download_member - Download one member of an archive uploaded with pack=True (key is
+    #   the archive object) with a single ranged GET, to path (a file, or a dir ending
+    #   with '/')
+    #
+    def download_member(self, path, bucket, key, member):
+        self.logger.log('Starting d_haul member download ...')
+        start_time = time.time()
+        if path.endswith('/'):
+            path += os.path.basename(member)
+        try:
+            tot_size = pack_archive.s3_download_member(bucket, key, member, path, nosign=self.nosign_flag)
+        except KeyError:
+            raise TransferError('No member %s in archive s3://%s/%s' % (member, bucket, key))
+        self.logger.log("Downloaded %d bytes to location %s" % (tot_size, path))
+        return TransferResult('download', 's3://%s/%s:%s' % (bucket, key, member), path, tot_size,
+                              time.time() - start_time)
+
+    ########################################################################################
+    # delete - Delete every object below bucket/prefix, i.e. a scratch import prefix or the
+    #   partial outputs of a failed run. The prefix is a directory: 'runs/sample1' deletes
+    #   runs/sample1/... but not runs/sample10/...
+    #   older_than_days - Only delete objects last modified more than this many days ago
+    #   dry_run         - Only report what would be deleted
+    #   raw_prefix      - Match the prefix as given, without the trailing '/'
+    #
+    def delete(self, bucket, prefix, older_than_days=None, dry_run=False, raw_prefix=False):
+        if not prefix or not prefix.strip('/'):
+            raise TransferError('Refusing to delete the whole bucket %s - give a prefix' % bucket)
+        if not raw_prefix:
+            prefix = prefix.rstrip('/') + '/'
+        self.logger.log('Starting d_haul delete%s ...' % (' (dry run)' if dry_run else ''))
+        start_time = time.time()
+        modified_before = None
+        if older_than_days is not None:
+            modified_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=older_than_days)
+
+        count, tot_size, errors = aws.s3_delete_prefix(bucket, prefix, modified_before=modified_before,
+                                                       dry_run=dry_run)
+        for key, message in errors[:10]:
+            self.logger.error('Could not delete s3://%s/%s (%s)' % (bucket, key, message))
+        if errors:
+            raise TransferError('%d objects below s3://%s/%s could not be deleted' % (len(errors), bucket, prefix))
+        self.logger.log('%s %d objects (%d bytes) below s3://%s/%s'
+                        % ('Would delete' if dry_run else 'Deleted', count, tot_size, bucket, prefix))
+        return TransferResult('delete', 's3://%s/%s' % (bucket, prefix), None, tot_size, time.time() - start_time)
+
+    ########################################################################################
+    # run_daemon - Run the node-local staging daemon until killed
+    #
+    def run_daemon(self, socket_path=None, cache_dir=stage.DEFAULT_CACHE_DIR, cache_max_bytes=None,
+                   prefetch_urls=None):
+        daemon = stage.StageDaemon(self.logger,
+                                   socket_path=socket_path or stage.DEFAULT_SOCKET_PATH,
+                                   cache_dir=cache_dir,
+                                   cache_max_bytes=cache_max_bytes)
+        if prefetch_urls:
+            daemon.prefetch(prefetch_urls)
+        daemon.serve_forever()